@@ -0,0 +1,372 @@
+"""Local HTTP API for index statistics over an AOI.
+
+A small stdlib HTTP service around the same pipeline the app uses
+(utils.run_analysis on the shared job pool), so other systems can request
+statistics without the Streamlit UI. Results go through the process-wide
+band/result caches, and identical requests that arrive while one is still
+being computed are coalesced: they wait for the in-flight computation and
+share its result instead of starting their own.
+
+Endpoints:
+    POST /analyze   {"geometry": <GeoJSON geometry or Feature>, "date": "2025-01-31",
+                     "indices": ["NDVI", "NDRE"], "expressions": {"MYIDX": "B08 / B04"},
+                     "cloud_cover_max": 15, "days_back": 150, "field_id": "north-plot"}
+                    -> scene, per-index statistics and artifact links (the statistics are also
+                       appended to the history store under field_id, see history.py)
+    GET /artifacts/<result_key>/<index>.tif   clipped index as GeoTIFF
+    GET /artifacts/<result_key>/<index>.png   index map (?profile=compact: 8-bit PNG, 1000 px;
+                                              ?profile=data_saver: WebP, 560 px)
+    GET /history?geometry_hash=<hash>&index=NDVI&start=2025-01-01&end=2025-06-30
+                    stored statistics of earlier analyses, from the history store only
+                    (filter by geometry_hash or field_id; index may be repeated)
+    GET /stats      cache, job, coalescing and read counters (with the read-latency histogram)
+    GET /health
+
+Usage:
+    python api.py [--host 127.0.0.1] [--port 8765]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+os.environ.setdefault('MPLBACKEND', 'Agg')  # Map artifacts are rendered without a display
+
+import cache
+import expressions
+import history
+import jobs
+import reads
+import utils
+
+DEFAULT_PORT = 8765
+
+# Requests give up waiting after this long (the job keeps running and fills the cache)
+REQUEST_TIMEOUT_SECONDS = 600
+
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class BadRequest(ValueError):
+    """Raised for request bodies that cannot be analysed (answered with 400)."""
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one execution.
+
+    The first caller of do(key, fn) runs fn; callers with the same key that arrive
+    before it returns block and receive the same result (or exception). The key is
+    forgotten as soon as the call finishes, so later calls run again (and hit the
+    result cache instead).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Return (result, shared) where shared is True if another caller's execution was reused."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {'executed': self.executed, 'coalesced': self.coalesced, 'in_flight': in_flight}
+
+
+flights = SingleFlight()
+
+
+def parse_request(body):
+    """Validate an /analyze body.
+    Returns (geometry, bbox, date, indices, expressions, bands, options, field_id).
+    """
+    from shapely.geometry import mapping, shape
+
+    if not isinstance(body, dict):
+        raise BadRequest("Body must be a JSON object")
+
+    geometry = body.get('geometry')
+    if isinstance(geometry, dict) and geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry')
+    try:
+        geom = shape(geometry)
+    except Exception:
+        raise BadRequest("'geometry' must be a GeoJSON Polygon or MultiPolygon (lon/lat)") from None
+    if geom.geom_type not in ('Polygon', 'MultiPolygon') or geom.is_empty or not geom.is_valid:
+        raise BadRequest("'geometry' must be a valid GeoJSON Polygon or MultiPolygon (lon/lat)")
+
+    try:
+        target_date = utils._target_datetime(str(body.get('date'))).date()
+    except ValueError:
+        raise BadRequest("'date' must be an ISO date (YYYY-MM-DD)") from None
+
+    custom = body.get('expressions') or {}
+    indices = body.get('indices') or list(custom)
+    if not isinstance(indices, list) or not indices or not isinstance(custom, dict):
+        raise BadRequest("'indices' must be a non-empty list of index names")
+    # Names are hashed (dict.fromkeys) and looked up below: anything but a string is a client error
+    if not all(isinstance(name, str) for name in indices):
+        raise BadRequest("'indices' must be a list of index names (strings)")
+    # Anonymous clients share the job pool: every formula is bounded (length, terms, exponents)
+    # and evaluated once on a single pixel here, before a job is queued
+    for name, expression in custom.items():
+        if not isinstance(expression, str):
+            raise BadRequest(f"{name}: expressions must be strings")
+        try:
+            expressions.probe(expression)
+        except expressions.ExpressionError as e:
+            raise BadRequest(f"{name}: {e}") from None
+    indices = list(dict.fromkeys(indices + [name for name in custom if name not in indices]))
+
+    bands = []
+    for name in indices:
+        try:
+            bands += [b for b in utils.vi_required_bands(name, custom.get(name)) if b not in bands]
+        except ValueError as e:
+            raise BadRequest(f"{name}: {e}") from None
+
+    try:
+        options = {
+            'cloud_cover_max': float(body.get('cloud_cover_max', 15)),
+            'days_back': int(body.get('days_back', 150)),
+        }
+    except (TypeError, ValueError):
+        raise BadRequest("'cloud_cover_max' and 'days_back' must be numbers") from None
+
+    field_id = body.get('field_id')
+    if field_id is not None and not isinstance(field_id, str):
+        raise BadRequest("'field_id' must be a string")
+
+    return mapping(geom), list(geom.bounds), target_date, indices, custom, bands, options, field_id
+
+
+def analyze(body):
+    """Run (or join) the analysis for an /analyze body and build the response dict."""
+    geometry, bbox, target_date, indices, custom, bands, options, field_id = parse_request(body)
+    geometry_hash = utils.geometry_hash(geometry)
+    # field_id only labels history rows; requests that differ only in it share one computation
+    key = cache.make_key('api', geometry_hash, target_date, indices,
+                         {name: custom[name] for name in sorted(custom)}, options)
+
+    def run():
+        job = jobs.manager.submit(
+            utils.run_analysis, bbox, geometry, target_date, indices, bands,
+            expression=custom or None, field_id=field_id, label=f"API {', '.join(indices)}", **options
+        )
+        if not job.wait(REQUEST_TIMEOUT_SECONDS):
+            raise TimeoutError(f"Analysis did not finish within {REQUEST_TIMEOUT_SECONDS} s")
+        if job.state == jobs.FAILED:
+            raise job.exception
+        if job.state != jobs.DONE:
+            raise utils.AnalysisError(f"Analysis was {job.state}")
+        return job.result
+
+    started = time.perf_counter()
+    metadata, coalesced = flights.do(key, run)
+
+    entry = utils.result_data(metadata)
+    if entry is None:
+        # Evicted between the computation and this request (only under heavy memory pressure)
+        raise utils.AnalysisError("Result was evicted from the cache, please retry")
+
+    result_key = metadata['result_key']
+    # Results larger than the whole cache come back with the job; there is nothing to serve artifacts from
+    cached = 'data' not in metadata
+    return {
+        'request_key': key,
+        'result_key': result_key,
+        'geometry_hash': geometry_hash,
+        'item_id': metadata.get('item_id'),
+        'item_date': str(metadata['item_date']),
+        'cloud_cover': metadata['cloud_cover'],
+        'plan': {key: metadata['plan'][key] for key in ('mode', 'overview_level', 'pixels', 'transfer_bytes', 'peak_bytes')},
+        'coalesced': coalesced,
+        'seconds': round(time.perf_counter() - started, 3),
+        'indices': {name: _json_stats(entry['vi_stats'][name]) for name in indices},
+        'artifacts': {
+            name: {'geotiff': f"/artifacts/{result_key}/{name}.tif", 'png': f"/artifacts/{result_key}/{name}.png"}
+            for name in indices
+        } if cached else {},
+    }
+
+
+def _json_stats(stats):
+    """compute_stats() result without the histogram arrays."""
+    if stats['count'] == 0:
+        return {'count': 0}
+    return {
+        'count': stats['count'], 'mean': stats['mean'], 'min': stats['min'], 'max': stats['max'],
+        'std': stats['std'], 'percentiles': {str(q): v for q, v in stats['percentiles'].items()},
+    }
+
+
+def history_rows(params):
+    """Stored statistics matching /history query parameters (lists of values, as from parse_qs)."""
+    store = history.get_history_store()
+    if store is None:
+        raise BadRequest("The history store is disabled (PALANTIR_HISTORY_DIR)")
+    geometry_hash = params.get('geometry_hash', [None])[0]
+    field_id = params.get('field_id', [None])[0]
+    if geometry_hash is None and field_id is None:
+        raise BadRequest("Give 'geometry_hash' or 'field_id'")
+    try:
+        start, end = (utils._target_datetime(params[name][0]).date() if name in params else None
+                      for name in ('start', 'end'))
+    except ValueError:
+        raise BadRequest("'start' and 'end' must be ISO dates (YYYY-MM-DD)") from None
+
+    started = time.perf_counter()
+    frame = store.query(geometry_hash=geometry_hash, field_id=field_id, index=params.get('index'),
+                        start=start, end=end)
+    rows = [{name: (None if value != value else value) for name, value in row.items()}
+            for row in frame.drop(columns='recorded_at', errors='ignore').to_dict('records')]
+    return {'rows': rows, 'count': len(rows), 'seconds': round(time.perf_counter() - started, 4)}
+
+
+def artifact(result_key, filename, profile='full'):
+    """(content type, bytes) of an artifact, or None if the result is no longer cached.
+    profile selects the image delivery profile of maps (utils.IMAGE_PROFILES).
+    """
+    name, _, ext = filename.rpartition('.')
+    entry = cache.shared.get(result_key)
+    if entry is None or name not in entry.get('vis', {}) or ext not in ('tif', 'png'):
+        return None
+    if ext == 'tif':
+        return 'image/tiff', utils.export_geotiff(entry['vis'][name]).getvalue()
+    data, content_type, _ = utils.render_image(
+        (result_key, 'api', name), lambda dpi: utils.create_vi_plot(entry['vis'][name], vi_name=name, dpi=dpi,
+                                                                    stats=entry['vi_stats'][name]),
+        profile=profile, width_in=8)
+    return content_type, data
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "PalantirAPI/1.0"
+
+    def _send(self, status, body, content_type='application/json'):
+        data = json.dumps(body, default=str).encode('utf-8') if content_type == 'application/json' else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        if path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif path == '/stats':
+            self._send(200, {'cache': cache.shared.stats(), 'jobs': jobs.manager.stats(), 'coalescing': flights.stats(),
+                             'reads': reads.reader.stats()})
+        elif path == '/history':
+            try:
+                self._send(200, history_rows(parse_qs(url.query)))
+            except BadRequest as e:
+                self._send(400, {'error': str(e)})
+        elif path.startswith('/artifacts/') and path.count('/') == 3:
+            _, _, result_key, filename = path.split('/')
+            profile = parse_qs(url.query).get('profile', ['full'])[0]
+            if profile not in utils.IMAGE_PROFILES:
+                self._send(400, {'error': f"Unknown profile: {profile} (use {', '.join(utils.IMAGE_PROFILES)})"})
+                return
+            found = artifact(result_key, filename, profile)
+            if found is None:
+                self._send(404, {'error': "Artifact not found (results are kept in the cache for a limited time)"})
+            else:
+                self._send(200, found[1], content_type=found[0])
+        else:
+            self._send(404, {'error': f"Unknown path: {path}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/analyze':
+            self._send(404, {'error': f"Unknown path: {self.path}"})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self._send(413, {'error': "Request body too large"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'null')
+            self._send(200, analyze(body))
+        except (json.JSONDecodeError, BadRequest) as e:
+            self._send(400, {'error': str(e)})
+        except jobs.QueueFull as e:
+            self._send(503, {'error': str(e)})
+        except utils.AnalysisError as e:
+            self._send(422, {'error': str(e)})
+        except TimeoutError as e:
+            self._send(504, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': f"{type(e).__name__}: {e}"})
+
+    def log_message(self, format, *args):
+        if os.environ.get('PALANTIR_API_QUIET') != '1':
+            super().log_message(format, *args)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog (5) drops bursts of concurrent clients into SYN retries
+    request_queue_size = 128
+
+
+def make_server(host='127.0.0.1', port=DEFAULT_PORT):
+    """Threaded HTTP server for the API (port 0 picks a free port)."""
+    return Server((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Project Palantir analysis API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,22 @@
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')  # Non-interactive backend; matplotlib itself is imported lazily
 import streamlit as st
-import leafmap.foliumap as leafmap
-import pandas as pd
-import plotly.express as px
+import folium
 from datetime import date, timedelta
 import utils
+import expressions
+import zoning
+import planner
+import cache
+import history
+import lod
+import jobs
+import time
 import numpy as np
-import folium
-from folium.plugins import Draw
+from folium.plugins import Draw, Fullscreen
 from streamlit_folium import st_folium
-from PIL import Image
 import io
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend
-import matplotlib.pyplot as plt
+import hashlib
 from shapely.geometry import shape as shapely_shape, mapping
 from shapely import wkt
 import json
@@ -28,7 +32,7 @@ st.set_page_config(
 if 'analysis_results' not in st.session_state:
     st.session_state.analysis_results = None
 
-# VI Information Dictionary (Alphabetically sorted - 22 Stable VIs)
+# VI Information Dictionary (Alphabetically sorted - 24 Stable VIs; NBR/NDRE are expression presets)
 VI_INFO = {
     'ARVI': {'bands': ['B02 (10m)', 'B04 (10m)', 'B08 (10m)'], 'formula': '(NIR - (Red - (Blue - Red))) / (NIR + (Red - (Blue - Red)))', 'name': 'Atmospherically Resistant Vegetation Index', 'keywords': ['haze-resistant vegetation signal', 'aerosol-corrected greenness', 'polluted-air environments']},
     'DVI': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': 'NIR - Red', 'name': 'Difference Vegetation Index', 'keywords': ['basic greenness difference', 'coarse vegetation amount', 'simple density check']},
@@ -42,6 +46,8 @@ VI_INFO = {
     'IPVI': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': 'NIR / (NIR + Red)', 'name': 'Infrared Percentage Vegetation Index', 'keywords': ['normalized greenness mapping', 'broad-area vegetation comparison', 'NDVI-style scaling']},
     'MSAVI': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': '(2*NIR + 1 - sqrt((2*NIR + 1)^2 - 8*(NIR - Red))) / 2', 'name': 'Modified Soil Adjusted Vegetation Index', 'keywords': ['bare-soil suppression', 'early-growth crop detection', 'emerging vegetation']},
     'MSR': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': '(NIR/Red - 1) / sqrt(NIR/Red + 1)', 'name': 'Modified Simple Ratio', 'keywords': ['improved SR accuracy', 'better nonlinear response', 'general vegetation monitoring']},
+    'NBR': {'bands': ['B08 (10m)', 'B12 (20m)'], 'formula': '(NIR - SWIR2) / (NIR + SWIR2)', 'name': 'Normalized Burn Ratio', 'keywords': ['burn scar mapping', 'post-fire severity', 'canopy moisture loss']},
+    'NDRE': {'bands': ['B05 (20m)', 'B08 (10m)'], 'formula': '(NIR - RE1) / (NIR + RE1)', 'name': 'Normalized Difference Red Edge Index', 'keywords': ['mid/late-season chlorophyll', 'nitrogen management', 'less saturation than NDVI']},
     'NDVI': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': '(NIR - Red) / (NIR + Red)', 'name': 'Normalized Difference Vegetation Index', 'keywords': ['general vegetation vigor', 'biomass estimate', 'overall plant health']},
     'NDWI': {'bands': ['B03 (10m)', 'B08 (10m)'], 'formula': '(Green - NIR) / (Green + NIR)', 'name': 'Normalized Difference Water Index', 'keywords': ['water body detection', 'vegetation water content', 'moisture mapping']},
     'OSAVI': {'bands': ['B04 (10m)', 'B08 (10m)'], 'formula': '(NIR - Red) / (NIR + Red + 0.16)', 'name': 'Optimized Soil Adjusted Vegetation Index', 'keywords': ['enhanced SAVI', 'better soil isolation', 'open-field crop monitoring']},
@@ -59,17 +65,80 @@ st.sidebar.image("logo.png", use_container_width=True)
 st.sidebar.title("Project Palantir")
 st.sidebar.info("Source: Microsoft Planetary Computer (Sentinel-2 L2A)")
 
+# Analysis Mode
+analysis_mode = st.sidebar.radio(
+    "Analysis Mode",
+    ["Single Date", "Change Detection", "Seasonal Composite"],
+    horizontal=True,
+    help="Change Detection compares the index between an earlier and a later date on one aligned grid. "
+         "Seasonal Composite combines all clear images in the search window pixel by pixel."
+)
+
 # Date Selection
 today = date.today()
-target_date = st.sidebar.date_input("Target Date", today)
+compare_date = None
+if analysis_mode == "Change Detection":
+    compare_date = st.sidebar.date_input("Earlier Date", today - timedelta(days=90))
+target_date = st.sidebar.date_input("Target Date" if compare_date is None else "Later Date", today)
 st.sidebar.caption(f"Searches up to 150 days backward from target date")
 
+composite_method = None
+if analysis_mode == "Seasonal Composite":
+    composite_method = st.sidebar.selectbox(
+        "Composite method",
+        list(utils.COMPOSITE_METHODS),
+        format_func=lambda m: {'max': "Maximum (e.g. max-NDVI)", 'median': "Median", 'mean': "Quality-weighted mean"}[m],
+        help="Cloud and shadow pixels are masked per image before compositing."
+    )
+
+CUSTOM_VI_OPTION = "Custom expression..."
+
+def vi_band_labels(vi_name, expression=None):
+    """Bands used by an index as display labels, e.g. ['B04 (10m)', 'B08 (10m)']."""
+    if expression is None and vi_name in VI_INFO:
+        return VI_INFO[vi_name]['bands']
+    return [f"{band} ({expressions.BANDS[band]}m)" for band in expressions.required_bands(expression)]
+
+def vi_plot_range(vi_name):
+    """Fixed colour scale limits for indices with a known range (None = scale to the data)."""
+    v_min = 0 if vi_name in ['NDVI', 'EVI', 'SAVI'] else None
+    v_max = 1 if vi_name in ['NDVI'] else None
+    return v_min, v_max
+
 # VI Selection
-vi_options = list(VI_INFO.keys())
+vi_options = list(VI_INFO.keys()) + [CUSTOM_VI_OPTION]
 selected_vi = st.sidebar.selectbox("Select Vegetation Index", vi_options)
 
+# User-defined index: a formula over band names, validated before anything runs
+custom_expression = None
+custom_expression_error = None
+if selected_vi == CUSTOM_VI_OPTION:
+    custom_name = st.sidebar.text_input("Index name", value="CUSTOM", max_chars=20)
+    custom_expression = st.sidebar.text_input(
+        "Expression",
+        value="(B08 - B05) / (B08 + B05)",
+        help=f"Bands: {', '.join(expressions.BANDS)}. Operators: + - * / ** (exponent: a number up to {expressions.MAX_EXPONENT}). Functions: {', '.join(expressions.FUNCTIONS)}."
+    )
+    selected_vi = "".join(c for c in custom_name.upper() if c.isalnum() or c in "_-") or "CUSTOM"
+    try:
+        custom_expression = expressions.normalize(custom_expression)
+        st.sidebar.caption(f"Formula: `{custom_expression}`")
+        st.sidebar.caption(f"Bands: {', '.join(vi_band_labels(selected_vi, custom_expression))}")
+    except expressions.ExpressionError as e:
+        custom_expression_error = str(e)
+        st.sidebar.error(custom_expression_error)
+
+# Further indices computed in the same run (one scene search, one download of the union of bands)
+extra_vis = []
+if analysis_mode == "Single Date":
+    extra_vis = st.sidebar.multiselect(
+        "Also calculate",
+        [vi for vi in VI_INFO if vi != selected_vi],
+        help="Compute more indices from the same image in one run. Bands shared by several indices are downloaded once."
+    )
+
 # Display VI Info with full name and keywords
-if selected_vi in VI_INFO:
+if custom_expression is None and selected_vi in VI_INFO:
     info = VI_INFO[selected_vi]
     # Create bullet points for each keyword with HTML for smaller font
     keywords_html = "<small>" + "<br>".join([f"• {kw}" for kw in info['keywords']]) + "</small>"
@@ -80,8 +149,75 @@ if selected_vi in VI_INFO:
     st.sidebar.caption(f"Formula: `{info['formula']}`")
     st.sidebar.caption(f"Bands: {', '.join(info['bands'])}")
 
+# Bands required by the selected VI (e.g., 'B04 (10m)' -> 'B04')
+needed_bands = [] if custom_expression_error else [band.split(' ')[0] for band in vi_band_labels(selected_vi, custom_expression)]
+for vi in extra_vis:
+    needed_bands += [band.split(' ')[0] for band in VI_INFO[vi]['bands'] if band.split(' ')[0] not in needed_bands]
+
+advanced_options = st.sidebar.expander("Advanced Options")
+
+# Mosaic several images for AOIs that cross Sentinel-2 tile boundaries
+mosaic_enabled = advanced_options.checkbox(
+    "Mosaic mode (AOI spans multiple tiles)",
+    value=False,
+    help="Combine all images needed to cover the AOI onto one grid instead of using a single tile."
+)
+mosaic_priority = advanced_options.selectbox(
+    "Mosaic priority",
+    ['cloud', 'date'],
+    format_func=lambda p: {'cloud': "Least cloudy first", 'date': "Nearest date first"}[p],
+    disabled=not mosaic_enabled
+)
+
+# Show a coarse overview-level result first for large AOIs
+progressive_enabled = advanced_options.checkbox(
+    "Progressive preview",
+    value=False,
+    disabled=mosaic_enabled,
+    help="Show a quick low-resolution preview from image overviews while the full-resolution analysis runs."
+) and not mosaic_enabled
+
+# Opt-in speculative prefetch of the scene search while the user is still editing.
+# Only single-scene runs use it; change detection, composites and mosaics do their own searches
+prefetch_available = analysis_mode == "Single Date" and not mosaic_enabled
+prefetch_enabled = advanced_options.checkbox(
+    "Prefetch scene in background",
+    value=False,
+    disabled=not prefetch_available,
+    help="Start searching for the best image as soon as the AOI or date changes, so Run Analysis finds it ready."
+) and prefetch_available
+prefetch_bands = advanced_options.checkbox(
+    "Also prefetch band data",
+    value=False,
+    disabled=not prefetch_enabled,
+    help="Download the bands for the selected index in the background as well (uses more bandwidth)."
+)
+
+# Smaller result images for slow and mobile connections (see utils.IMAGE_PROFILES)
+image_profile = advanced_options.selectbox(
+    "Image delivery",
+    list(utils.IMAGE_PROFILES),
+    index=1 if st.session_state.get('is_mobile', False) else 0,
+    format_func=lambda p: {
+        'full': "Full quality (PNG, 150 dpi)",
+        'compact': "Compact (8-bit PNG, 1000 px)",
+        'data_saver': "Data saver (WebP, 560 px)",
+    }[p],
+    help="Compact and Data saver send maps that are 5-20x smaller, for slow or mobile connections. "
+         "GeoTIFF exports are not affected."
+)
+
+# Label of this AOI in the field history (history.py); rows are matched by boundary either way
+field_id = advanced_options.text_input(
+    "Field ID",
+    value="",
+    help="Name stored with this field's statistics in the field history. "
+         "Defaults to an ID derived from the boundary."
+).strip() or None
+
 st.sidebar.markdown("---")
 run_analysis = st.sidebar.button("Run Analysis", type="primary")
+plan_placeholder = st.sidebar.empty()  # Filled with the pre-flight estimate once the AOI is known
 
 # Add collapse sidebar hint
 st.sidebar.markdown("")
@@ -110,13 +246,21 @@ uploaded_kml = st.file_uploader(
 # Process uploaded KML and show Apply button
 if uploaded_kml is not None:
     kml_content = uploaded_kml.read()
-    geometry = utils.parse_kml_to_geometry(kml_content)
+    # Parsed once per file: the same geometry object on every rerun also reuses its hash (and LOD levels)
+    kml_digest = hashlib.sha1(kml_content).hexdigest()
+    if st.session_state.get('temp_kml_digest') == kml_digest:
+        geometry = st.session_state.temp_kml_geometry
+    else:
+        geometry = utils.parse_kml_to_geometry(kml_content)
     if geometry:
-        from shapely.geometry import shape
-        shp = shape(geometry)
-        # Store temporarily
-        st.session_state.temp_kml_wkt = shp.wkt
-        st.session_state.temp_kml_geometry = geometry
+        # Store temporarily (the text area shows a simplified boundary, the exact one is analysed)
+        if st.session_state.get('temp_kml_digest') != kml_digest:
+            st.session_state.temp_kml_wkt, shown, total = lod.to_wkt(geometry)
+            st.session_state.temp_kml_note = (shown, total) if shown < total else None
+            st.session_state.temp_kml_geometry = geometry
+            st.session_state.temp_kml_digest = kml_digest
+            # Several placemarks: each one can be zoned as its own field (see Management Zones)
+            st.session_state.temp_kml_fields = utils.parse_kml_fields(kml_content)
         
         # Show success and Apply button
         col1, col2 = st.columns([3, 1])
@@ -141,7 +285,13 @@ if uploaded_kml is not None:
             
             if st.button("Apply Coordinates", key="apply_kml_btn", use_container_width=True):
                 st.session_state.aoi_wkt = st.session_state.temp_kml_wkt
+                st.session_state.aoi_wkt_note = st.session_state.temp_kml_note
                 st.session_state.current_geometry = st.session_state.temp_kml_geometry
+                fields = st.session_state.temp_kml_fields
+                # Tied to the boundary they came from: ignored once the AOI is edited or redrawn
+                st.session_state.kml_fields = {
+                    'geometry_hash': utils.geometry_hash(st.session_state.temp_kml_geometry), 'fields': fields
+                } if len(fields) > 1 else None
                 st.rerun()
 
 # Text input for coordinates (shows updated value from Apply)
@@ -152,9 +302,15 @@ coord_input = st.text_area(
     height=80
 )
 
+if st.session_state.get('aoi_wkt_note') and coord_input == st.session_state.aoi_wkt:
+    shown, total = st.session_state.aoi_wkt_note
+    st.caption(f"Showing a simplified boundary ({shown:,} of {total:,} vertices). "
+               f"The exact boundary is used for the analysis unless you edit the coordinates.")
+
 # Parse coordinates if changed
 if coord_input != st.session_state.aoi_wkt:
     st.session_state.aoi_wkt = coord_input
+    st.session_state.aoi_wkt_note = None
     if coord_input.strip():
         try:
             poly = wkt.loads(coord_input)
@@ -172,31 +328,38 @@ if coord_input != st.session_state.aoi_wkt:
 imported_geometry = st.session_state.current_geometry
 
 
-# Map initialization
-m = leafmap.Map(center=[13.7563, 100.5018], zoom=6, draw_control=False)
-m.add_tile_layer(
-    url="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
+# Map initialization (plain folium: leafmap pulled in ipyleaflet/plotly/IPython on every cold start)
+m = folium.Map(location=[13.7563, 100.5018], zoom_start=6, max_zoom=24, control_scale=True)
+Fullscreen().add_to(m)
+folium.TileLayer(
+    tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
     name="Google Hybrid",
-    attribution="Google"
-)
+    attr="Google",
+    overlay=True,
+    max_zoom=24
+).add_to(m)
 
-# Add imported geometry if exists
 # Add imported geometry if exists
 if imported_geometry:
     if isinstance(imported_geometry, dict):
         # If it's a raw geometry, wrap it in a FeatureCollection
         if imported_geometry.get('type') in ['Polygon', 'MultiPolygon', 'Point', 'LineString', 'MultiLineString', 'MultiPoint']:
+            try:
+                # Large boundaries are drawn simplified (cached per geometry, see lod.py)
+                map_geometry = lod.to_geojson(imported_geometry)
+            except Exception:
+                map_geometry = imported_geometry
             imported_geometry = {
                 "type": "FeatureCollection",
                 "features": [{
                     "type": "Feature",
-                    "geometry": imported_geometry,
+                    "geometry": map_geometry,
                     "properties": {}
                 }]
             }
         
         try:
-            m.add_geojson(imported_geometry, layer_name="Imported AOI")
+            folium.GeoJson(imported_geometry, name="Imported AOI").add_to(m)
         except Exception as e:
             st.error(f"Error adding geometry to map: {e}")
     else:
@@ -213,6 +376,7 @@ draw_options = {
     'remove': True
 }
 Draw(export=False, position='topleft', draw_options=draw_options).add_to(m)
+folium.LayerControl().add_to(m)
 
 # Render map
 if 'map_key' not in st.session_state:
@@ -274,78 +438,136 @@ if geometry is None and st.session_state.current_geometry:
 # Calculate bbox
 if geometry:
     try:
-        coords = geometry['coordinates'][0]
-        lons = [c[0] for c in coords]
-        lats = [c[1] for c in coords]
-        bbox = [min(lons), min(lats), max(lons), max(lats)]
+        # Envelope of all parts (MultiPolygon AOIs are read part by part, see utils.read_windows)
+        bbox = list(shapely_shape(geometry).bounds)
     except Exception as e:
         st.error(f"Error: {e}")
 
-# Analysis Logic
+# Pre-flight estimate: how much will be read and whether full resolution fits the budgets
+if bbox and not custom_expression_error:
+    try:
+        plan = utils.plan_analysis(
+            bbox, [selected_vi] + extra_vis, needed_bands,
+            expression={selected_vi: custom_expression} if custom_expression else None,
+            analysis={"Change Detection": 'change', "Seasonal Composite": 'composite'}.get(analysis_mode, 'single'),
+            mosaic=mosaic_enabled, method=composite_method or 'max', geometry=geometry
+        )
+        message = planner.describe(plan)
+        if plan['mode'] == planner.FULL:
+            plan_placeholder.caption(message)
+        elif plan['mode'] == planner.TOO_LARGE:
+            plan_placeholder.error(message)
+        else:
+            plan_placeholder.warning(message)
+    except ValueError as e:
+        plan_placeholder.caption(f"No estimate: {e}")
+
+# Start background prefetch for the current AOI/date (no-op if already started)
+if prefetch_enabled and bbox:
+    utils.prefetch_scene(
+        bbox, target_date, cloud_cover_max=15, days_back=150,
+        bands=needed_bands if prefetch_bands else None, geometry=geometry
+    )
+
+# Analysis Logic: the pipeline runs as a background job; this script only submits and polls it
 if run_analysis:
     if not bbox:
         st.error("Please draw a Rectangle or Polygon on the map first!")
+    elif custom_expression_error:
+        st.error(f"Fix the custom index expression first: {custom_expression_error}")
     else:
-        # Display coordinates being processed
-        st.info(f"**Processing AOI:**\nBounding Box: [{bbox[0]:.4f}, {bbox[1]:.4f}, {bbox[2]:.4f}, {bbox[3]:.4f}]")
+        # Cancel a previous analysis from this session before starting a new one
+        if st.session_state.get('analysis_job_id'):
+            jobs.manager.cancel(st.session_state.analysis_job_id)
+        try:
+            if analysis_mode == "Change Detection":
+                job = jobs.manager.submit(
+                    utils.run_change_detection, bbox, geometry, compare_date, target_date, selected_vi,
+                    needed_bands, cloud_cover_max=15, days_back=150, expression=custom_expression,
+                    label=f"{selected_vi} change detection"
+                )
+            elif analysis_mode == "Seasonal Composite":
+                # Cloudier images still contribute their clear pixels (masked per pixel with SCL)
+                job = jobs.manager.submit(
+                    utils.run_composite, bbox, geometry, target_date, selected_vi, needed_bands,
+                    method=composite_method, cloud_cover_max=60, days_back=150, expression=custom_expression,
+                    label=f"{selected_vi} {composite_method} composite"
+                )
+            elif extra_vis:
+                # All selected indices from one scene search and one band download
+                job = jobs.manager.submit(
+                    utils.run_analysis, bbox, geometry, target_date, [selected_vi] + extra_vis, needed_bands,
+                    cloud_cover_max=15, days_back=150, use_prefetch=prefetch_enabled,
+                    mosaic=mosaic_enabled, mosaic_priority=mosaic_priority, progressive=progressive_enabled,
+                    expression={selected_vi: custom_expression} if custom_expression else None,
+                    field_id=field_id, label=f"{', '.join([selected_vi] + extra_vis)} analysis"
+                )
+            else:
+                job = jobs.manager.submit(
+                    utils.run_analysis, bbox, geometry, target_date, selected_vi, needed_bands,
+                    cloud_cover_max=15, days_back=150, use_prefetch=prefetch_enabled,
+                    mosaic=mosaic_enabled, mosaic_priority=mosaic_priority, progressive=progressive_enabled,
+                    expression=custom_expression, field_id=field_id, label=f"{selected_vi} analysis"
+                )
+            st.session_state.analysis_job_id = job.id
+            st.session_state.analysis_job_bbox = bbox
+            st.session_state.analysis_results = None
+        except jobs.QueueFull:
+            st.error("The server is busy with other analyses. Please try again in a moment.")
+
+poll_analysis_job = False
+analysis_job = jobs.manager.get(st.session_state.get('analysis_job_id'))
+if analysis_job is not None:
+    job_bbox = st.session_state.analysis_job_bbox
+    # Display coordinates being processed
+    st.info(f"**Processing AOI:**\nBounding Box: [{job_bbox[0]:.4f}, {job_bbox[1]:.4f}, {job_bbox[2]:.4f}, {job_bbox[3]:.4f}]")
+    
+    if not analysis_job.done:
+        label = "Waiting for a free worker..." if analysis_job.state == jobs.QUEUED else "Running Analysis..."
+        with st.status(label, expanded=True):
+            for event in analysis_job.events:
+                st.write(event['message'])
+            st.progress(analysis_job.progress)
+            if st.button("Cancel Analysis", key=f"cancel_{analysis_job.id}"):
+                jobs.manager.cancel(analysis_job.id)
         
-        with st.status("Starting Analysis...", expanded=True) as status:
-            try:
-                # 1. Search for best image
-                st.write("Searching for best image (last 150 days)...")
-                item = utils.get_best_item(bbox, target_date, cloud_cover_max=15, days_back=150)
-                
-                if item is None:
-                    status.update(label="Analysis Failed", state="error", expanded=True)
-                    st.error("No suitable images found within 150 days of target date (Cloud Cover < 15%).")
-                    st.session_state.analysis_results = None
-                else:
-                    item_date = item.datetime.date()
-                    st.write(f"Found Image: **{item_date}** (Cloud Cover: {item.properties['eo:cloud_cover']:.1f}%)")
-                    
-                    # 2. Load Bands (bbox clipped)
-                    st.write("Downloading raw band data...")
-                    # Get band names from VI_INFO (e.g., 'B04 (10m)')
-                    bands_with_resolution = VI_INFO[selected_vi]['bands']
-                    # Extract just the band name (e.g., 'B04') by splitting on space
-                    needed_bands = [band.split(' ')[0] for band in bands_with_resolution]
-                    bands_data = utils.load_bands(item, needed_bands, bbox)
-                    
-                    # 3. Calculate VI from bbox-clipped bands
-                    st.write(f"Calculating {selected_vi}...")
-                    vi_data_overall = utils.calculate_vi_single(bands_data, selected_vi)
-                    
-                    if vi_data_overall is None:
-                        status.update(label="Calculation Failed", state="error", expanded=True)
-                        st.error(f"Failed to calculate {selected_vi}. Please check if all required bands are available.")
-                        st.session_state.analysis_results = None
-                    else:
-                        # 4. Clip VI to polygon (if drawn)
-                        if geometry:
-                            st.write("Clipping to polygon boundary...")
-                            vi_data_overall = utils.clip_to_geometry(vi_data_overall, geometry)
-                        
-                        status.update(label="Analysis Complete!", state="complete", expanded=True)
-                        
-                        # Store results in session state
-                        st.session_state.analysis_results = {
-                            'vi_data_overall': vi_data_overall,
-                            'bands_data': bands_data,
-                            'item_date': item_date,
-                            'cloud_cover': item.properties['eo:cloud_cover'],
-                            'selected_vi': selected_vi,
-                            'geometry': geometry  # Store for polygon plotting
-                        }
-
-            except Exception as e:
-                status.update(label="Error Occurred", state="error")
-                st.error(f"An error occurred: {str(e)}")
-                st.exception(e)
-                st.session_state.analysis_results = None
+        # Show the coarse preview (progressive mode) while full resolution is computed
+        if analysis_job.partial is not None:
+            st.session_state.analysis_results = analysis_job.partial
+        
+        # Poll the job state at the end of this run instead of blocking the script thread
+        poll_analysis_job = True
+    else:
+        st.session_state.analysis_job_id = None
+        if analysis_job.state == jobs.DONE:
+            with st.status("Analysis Complete!", state="complete", expanded=True):
+                for event in analysis_job.events:
+                    st.write(event['message'])
+            st.session_state.analysis_results = analysis_job.result
+        elif analysis_job.state == jobs.CANCELLED:
+            st.info("Analysis cancelled.")
+            st.session_state.analysis_results = None
+        else:
+            with st.status("Analysis Failed", state="error", expanded=True):
+                for event in analysis_job.events:
+                    st.write(event['message'])
+            st.error(analysis_job.error)
+            if not isinstance(analysis_job.exception, utils.AnalysisError):
+                st.exception(analysis_job.exception)
+            st.session_state.analysis_results = None
 
-# Display Results from Session State
+# Resolve results for this session from the shared cache (or the job, if too large for it)
+results = None
 if st.session_state.analysis_results:
-    results = st.session_state.analysis_results
+    result_data = utils.result_data(st.session_state.analysis_results)
+    if result_data is None:
+        st.warning("These results were removed from the shared cache to stay within the memory budget. Please run the analysis again.")
+        st.session_state.analysis_results = None
+    else:
+        results = {**st.session_state.analysis_results, **result_data}
+
+# Display Results from Session State
+if results:
     
     # Calculate and display area before results
     if results.get('geometry'):
@@ -356,19 +578,56 @@ if st.session_state.analysis_results:
         )
     
     st.write("### 2. Analysis Results")
-    st.caption(f"Image Date: {results['item_date']} | Cloud Cover: {results['cloud_cover']:.1f}%")
+    if results.get('mode') == 'change':
+        st.caption(
+            f"Earlier Image: {results['item_date_before']} (Cloud Cover: {results['cloud_cover_before']:.1f}%) | "
+            f"Later Image: {results['item_date_after']} (Cloud Cover: {results['cloud_cover_after']:.1f}%)"
+        )
+    elif results.get('mode') == 'composite':
+        st.caption(
+            f"{results['method'].capitalize()} composite of {results['scene_count']} images "
+            f"from {results['item_dates'][0]} to {results['item_dates'][-1]}"
+        )
+    elif results.get('scene_count', 1) > 1:
+        st.caption(
+            f"Mosaic of {results['scene_count']} images: {', '.join(str(d) for d in results['item_dates'])} | "
+            f"Max Cloud Cover: {results['cloud_cover']:.1f}%"
+        )
+    else:
+        st.caption(f"Image Date: {results['item_date']} | Cloud Cover: {results['cloud_cover']:.1f}%")
+    plan = results.get('plan')
+    if plan is not None and plan['mode'] != planner.FULL:
+        st.info(planner.describe(plan))
+    elif results.get('overview_level') is not None:
+        st.warning("Preview at reduced resolution. Full-resolution results will replace it when ready.")
+    
+    def deliver_plot(kind, render, dpi=150, width_in=10):
+        """(bytes, mime, extension) of a plot in the selected image delivery profile, cached per result"""
+        return utils.render_image((results.get('result_key'), kind), render, profile=image_profile,
+                                  dpi=dpi, width_in=width_in)
+    
+    def show_image(image, caption=None):
+        if image[1] == 'image/webp':
+            # st.image would re-encode WebP as JPEG; send the small file as is
+            import base64
+            st.markdown(f'<img src="data:image/webp;base64,{base64.b64encode(image[0]).decode()}" '
+                        f'style="width: 100%">', unsafe_allow_html=True)
+            if caption:
+                st.caption(caption)
+        else:
+            st.image(image[0], caption=caption, use_container_width=True, output_format='PNG')
     
     # Helper function to create polygon plot (cached)
     @st.cache_data
-    def create_polygon_plot(geometry_coords):
-        """Create a matplotlib plot of the polygon boundary"""
+    def create_polygon_plot(rings, dpi=100):
+        """Create a matplotlib plot of the polygon boundary (one exterior ring per part)"""
         import matplotlib.pyplot as plt
         
-        x, y = zip(*geometry_coords)
-        
         fig, ax = plt.subplots(figsize=(6, 6), facecolor='white')
-        ax.plot(x, y, 'b-', linewidth=2)
-        ax.fill(x, y, 'skyblue', alpha=0.5)
+        for ring in rings:
+            x, y = zip(*ring)
+            ax.plot(x, y, 'b-', linewidth=2)
+            ax.fill(x, y, 'skyblue', alpha=0.5)
         ax.set_title("Polygon from Coordinates", fontsize=14, fontweight='bold')
         ax.set_xlabel("Longitude", fontsize=12)
         ax.set_ylabel("Latitude", fontsize=12)
@@ -376,26 +635,27 @@ if st.session_state.analysis_results:
         ax.set_aspect('equal')
         
         buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
+        plt.savefig(buf, format='png', dpi=dpi, bbox_inches='tight')
         plt.close(fig)
         buf.seek(0)
         return buf.getvalue()
     
     # Helper function to display VI section
-    def display_vi_section(title, vi_data, key_suffix):
+    def display_vi_section(title, vi_data, key_suffix, stats=None, vi_name=None):
+        vi_name = vi_name or results['selected_vi']
         st.markdown(f"#### {title}")
         
-        # Check if data has any valid values
-        valid_count = int((~np.isnan(vi_data.values)).sum())
+        # One fused statistics pass (stored with the result), shared by the metrics and the plot scaling
+        stats = stats if stats is not None else utils.compute_stats(vi_data)
+        valid_count = stats['count']
         
         if valid_count == 0:
             st.warning(f"No valid data for {title}. The area may not contain the required land cover type.")
             return
         
-        # Compute statistics
-        mean_val = float(np.nanmean(vi_data.values))
-        min_val = float(np.nanmin(vi_data.values))
-        max_val = float(np.nanmax(vi_data.values))
+        mean_val = stats['mean']
+        min_val = stats['min']
+        max_val = stats['max']
         
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("Mean", f"{mean_val:.4f}")
@@ -410,44 +670,44 @@ if st.session_state.analysis_results:
         with st.container():
             st.markdown("##### 1. Area of Interest Boundary")
             if results.get('geometry'):
-                from shapely.geometry import shape as shapely_shape
-                geom = shapely_shape(results['geometry'])
-                coords = list(geom.exterior.coords)
-                polygon_img_bytes = create_polygon_plot(coords)
-                st.image(polygon_img_bytes, use_container_width=True)
+                # Simplified rings (lod.py): the plot is ~600 px wide, more vertices cannot show
+                polygon_image = deliver_plot(('polygon', utils.geometry_hash(results['geometry'])),
+                                             lambda dpi: create_polygon_plot(lod.rings(results['geometry']), dpi),
+                                             dpi=100, width_in=6)
+                show_image(polygon_image)
                 st.download_button(
                     label="Download Polygon Plot",
-                    data=polygon_img_bytes,
-                    file_name=f'polygon_{results["item_date"]}.png',
-                    mime='image/png',
+                    data=polygon_image[0],
+                    file_name=f'polygon_{results["item_date"]}.{polygon_image[2]}',
+                    mime=polygon_image[1],
                     key=f'dl_polygon_{key_suffix}'
                 )
             
             # 2. VI Map
             with st.container():
-                st.markdown(f"##### 2. {results['selected_vi']} Map")
+                st.markdown(f"##### 2. {vi_name} Map")
                 
-                v_min = 0 if results['selected_vi'] in ['NDVI', 'EVI', 'SAVI'] else None
-                v_max = 1 if results['selected_vi'] in ['NDVI'] else None
+                v_min, v_max = vi_plot_range(vi_name)
                 
                 # Create matplotlib plot with colorbar (white background)
-                vi_plot_bytes = utils.create_vi_plot(
+                vi_image = deliver_plot(('map', key_suffix, vi_name), lambda dpi: utils.create_vi_plot(
                     vi_data, 
-                    vi_name=results['selected_vi'],
+                    vi_name=vi_name,
                     min_val=v_min, 
                     max_val=v_max,
                     figsize=(10, 8),
-                    dpi=150
-                )
+                    dpi=dpi,
+                    stats=stats
+                ))
                 
-                st.image(vi_plot_bytes, caption=f"{results['selected_vi']} Map with Colorbar", use_container_width=True)
+                show_image(vi_image, caption=f"{vi_name} Map with Colorbar")
                 
                 # Download button for the plot
                 st.download_button(
-                    label=f"Download {results['selected_vi']} Map",
-                    data=vi_plot_bytes,
-                    file_name=f'{results["selected_vi"]}_map_{key_suffix}_{results["item_date"]}.png',
-                    mime='image/png',
+                    label=f"Download {vi_name} Map",
+                    data=vi_image[0],
+                    file_name=f'{vi_name}_map_{key_suffix}_{results["item_date"]}.{vi_image[2]}',
+                    mime=vi_image[1],
                     key=f'dl_map_{key_suffix}'
                 )
             
@@ -459,7 +719,7 @@ if st.session_state.analysis_results:
                 st.download_button(
                     label=f"Download GeoTIFF",
                     data=tiff_bytes,
-                    file_name=f'{results["selected_vi"]}_{key_suffix}_{results["item_date"]}.tif',
+                    file_name=f'{vi_name}_{key_suffix}_{results["item_date"]}.tif',
                     mime='image/tiff',
                     key=f'dl_tiff_{key_suffix}'
                 )
@@ -467,25 +727,29 @@ if st.session_state.analysis_results:
             # 4. Raw Data Export (Clipped Bands)
             with st.container():
                 st.markdown("##### 4. Raw Data Export (Clipped Bands)")
-                st.caption(f"Download individual bands used for {results['selected_vi']}, clipped to the AOI.")
+                st.caption(f"Download individual bands used for {vi_name}, clipped to the AOI.")
                 
                 # Prepare clipped bands
                 # Extract band name without resolution info
-                bands_to_export_raw = VI_INFO[results['selected_vi']]['bands']
+                bands_to_export_raw = vi_band_labels(vi_name, results.get('expressions', {}).get(vi_name))
                 bands_to_export = [band.split(' ')[0] for band in bands_to_export_raw]  # Remove (10m), (20m)
                 
                 # Check if we have the bands in results
-                if 'bands_data' in results and 'geometry' in results:
+                if results.get('plan', {}).get('mode') == planner.CHUNKED:
+                    st.info("Raw bands are not kept for large areas computed chunk by chunk.")
+                elif 'bands_data' in results and 'geometry' in results:
                     # Create individual download buttons for each band
                     cols = st.columns(len(bands_to_export))
                     for idx, (band, band_display) in enumerate(zip(bands_to_export, bands_to_export_raw)):
                         if band in results['bands_data']:
                             with cols[idx]:
-                                # Clip band to AOI
-                                clipped_band = utils.clip_to_geometry(results['bands_data'][band], results['geometry'])
-                                
-                                # Export single band as GeoTIFF
-                                band_tiff = utils.export_geotiff(clipped_band)
+                                # Clipping to the exact boundary is slow for large AOIs; the files are reused across reruns
+                                band_key = cache.make_key('band_export', results['result_key'], band)
+                                band_tiff = cache.shared.get(band_key)
+                                if band_tiff is None:
+                                    clipped_band = utils.clip_to_geometry(results['bands_data'][band], results['geometry'])
+                                    band_tiff = utils.export_geotiff(clipped_band).getvalue()
+                                    cache.shared.put(band_key, band_tiff)
                                 
                                 # Download button for this band
                                 st.download_button(
@@ -507,15 +771,15 @@ if st.session_state.analysis_results:
                 if 'geometry' in results and results['geometry']:
                     kml_content = utils.geometry_to_kml(
                         results['geometry'],
-                        name=f"{results['selected_vi']} AOI",
-                        description=f"Area of Interest for {results['selected_vi']} analysis on {results['item_date']}"
+                        name=f"{vi_name} AOI",
+                        description=f"Area of Interest for {vi_name} analysis on {results['item_date']}"
                     )
                     
                     if kml_content:
                         st.download_button(
                             label="Download KML Boundary",
                             data=kml_content,
-                            file_name=f'boundary_{results["selected_vi"]}_{results["item_date"]}.kml',
+                            file_name=f'boundary_{vi_name}_{results["item_date"]}.kml',
                             mime='application/vnd.google-earth.kml+xml',
                             key=f'dl_kml_{key_suffix}',
                             use_container_width=True
@@ -533,14 +797,14 @@ if st.session_state.analysis_results:
                 if 'geometry' in results and results['geometry']:
                     shp_buffer = utils.geometry_to_shapefile(
                         results['geometry'],
-                        name=f"boundary_{results['selected_vi']}"
+                        name=f"boundary_{vi_name}"
                     )
                     
                     if shp_buffer:
                         st.download_button(
                             label="Download Shapefile (ZIP)",
                             data=shp_buffer,
-                            file_name=f'boundary_{results["selected_vi"]}_{results["item_date"]}.zip',
+                            file_name=f'boundary_{vi_name}_{results["item_date"]}.zip',
                             mime='application/zip',
                             key=f'dl_shp_{key_suffix}',
                             use_container_width=True
@@ -549,12 +813,299 @@ if st.session_state.analysis_results:
                         st.error("Could not generate Shapefile.")
                 else:
                     st.warning("No geometry available for Shapefile export.")
+            
+            # 7. Management Zones
+            with st.container():
+                st.markdown("##### 7. Management Zones")
+                st.caption("Classify the index into zones for variable-rate application and export them as polygons")
+                
+                if st.checkbox("Create management zones", key=f'zones_on_{key_suffix}'):
+                    col_n, col_method, col_area = st.columns(3)
+                    n_zones = col_n.slider("Number of zones", 2, 8, 5, key=f'zones_n_{key_suffix}')
+                    zone_method = col_method.selectbox(
+                        "Class breaks", list(zoning.ZONING_METHODS),
+                        format_func=lambda m: {'quantile': "Quantile (equal area)", 'jenks': "Natural breaks (Jenks)"}[m],
+                        key=f'zones_method_{key_suffix}'
+                    )
+                    min_area_ha = col_area.number_input(
+                        "Minimum zone patch (ha)", min_value=0.0, max_value=10.0, value=0.1, step=0.05,
+                        help="Patches smaller than this are merged into the surrounding zone",
+                        key=f'zones_area_{key_suffix}'
+                    )
+                    
+                    # A KML with several placemarks can be zoned field by field, each on its own breaks
+                    kml_fields = st.session_state.get('kml_fields')
+                    fields = None
+                    if kml_fields and kml_fields['geometry_hash'] == utils.geometry_hash(results['geometry']):
+                        if st.checkbox(f"Zone each field separately ({len(kml_fields['fields'])} fields in the KML)",
+                                       value=True, key=f'zones_per_field_{key_suffix}'):
+                            fields = kml_fields['fields']
+                    
+                    # Zoning is cheap but the polygons are reused across reruns (downloads, widgets)
+                    zones_key = cache.make_key('zones', results['result_key'], key_suffix, vi_name, n_zones, zone_method,
+                                               min_area_ha, fields is not None)
+                    zone_result = cache.shared.get(zones_key)
+                    if zone_result is None:
+                        if fields is None:
+                            zone_result = zoning.zone_field(vi_data, n_zones=n_zones, method=zone_method,
+                                                            min_area_m2=min_area_ha * 10000, stats=stats)
+                        else:
+                            field_results, features = zoning.zone_fields(vi_data, fields, n_zones=n_zones, method=zone_method,
+                                                                         min_area_m2=min_area_ha * 10000)
+                            zone_result = {'zones': zoning.merge_zones(vi_data, field_results), 'breaks': None,
+                                           'features': features}
+                        cache.shared.put(zones_key, zone_result)
+                    
+                    zone_image = deliver_plot(('zones', zones_key), lambda dpi: utils.create_zone_plot(
+                        zone_result['zones'], vi_name, zone_result['breaks'], figsize=(10, 8), dpi=dpi, n_zones=n_zones))
+                    show_image(zone_image, caption=f"{vi_name} Management Zones")
+                    st.dataframe(
+                        [f['properties'] for f in zone_result['features']['features']],
+                        use_container_width=True, hide_index=True
+                    )
+                    
+                    col_kml, col_shp, col_tif = st.columns(3)
+                    with col_kml:
+                        st.download_button(
+                            label="Download Zones KML",
+                            data=utils.geometry_to_kml(zone_result['features'], name=f"{vi_name} Zones"),
+                            file_name=f'zones_{vi_name}_{results["item_date"]}.kml',
+                            mime='application/vnd.google-earth.kml+xml',
+                            key=f'dl_zones_kml_{key_suffix}',
+                            use_container_width=True
+                        )
+                    with col_shp:
+                        st.download_button(
+                            label="Download Zones Shapefile (ZIP)",
+                            data=utils.geometry_to_shapefile(zone_result['features'], name=f"zones_{vi_name}"),
+                            file_name=f'zones_{vi_name}_{results["item_date"]}.zip',
+                            mime='application/zip',
+                            key=f'dl_zones_shp_{key_suffix}',
+                            use_container_width=True
+                        )
+                    with col_tif:
+                        st.download_button(
+                            label="Download Zones GeoTIFF",
+                            data=utils.export_geotiff(zone_result['zones']),
+                            file_name=f'zones_{vi_name}_{results["item_date"]}.tif',
+                            mime='image/tiff',
+                            key=f'dl_zones_tiff_{key_suffix}',
+                            use_container_width=True
+                        )
 
 
 
     
+    # Helper function to display several indices computed in one run
+    def display_multi_vi_section(vi_names):
+        st.markdown("#### Analysis Results")
+        
+        # All indices side by side
+        cols = st.columns(min(len(vi_names), 3))
+        for idx, name in enumerate(vi_names):
+            with cols[idx % len(cols)]:
+                stats = results['vi_stats'][name]
+                if stats['count'] == 0:
+                    st.warning(f"No valid data for {name}.")
+                    continue
+                v_min, v_max = vi_plot_range(name)
+                image = deliver_plot(('map', name), lambda dpi: utils.create_vi_plot(
+                    results['vis'][name], vi_name=name, min_val=v_min, max_val=v_max, figsize=(6, 5), dpi=dpi,
+                    stats=stats), dpi=100, width_in=6)
+                show_image(image, caption=f"{name} (mean {stats['mean']:.4f})")
+        
+        # All indices in one multi-band GeoTIFF (one band per index)
+        st.download_button(
+            label="Download All Indices (multi-band GeoTIFF)",
+            data=utils.export_bands_geotiff(results['vis']),
+            file_name=f'{"_".join(vi_names)}_{results["item_date"]}.tif',
+            mime='image/tiff',
+            key='dl_multi_tiff'
+        )
+        
+        st.write("---")
+        
+        # Details and exports per index
+        for tab, name in zip(st.tabs(vi_names), vi_names):
+            with tab:
+                display_vi_section(f"{name} Results", results['vis'][name], f"overall_{name}",
+                                   stats=results['vi_stats'][name], vi_name=name)
+    
+    # Helper function to display change detection results
+    def display_change_section(title, key_suffix):
+        st.markdown(f"#### {title}")
+        
+        stats = results['stats']
+        if stats['valid_count'] == 0:
+            st.warning(f"No valid data for {title}. The two images do not overlap with valid pixels in the AOI.")
+            return
+        
+        vi_name = results['selected_vi']
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Mean Change", f"{stats['mean']:+.4f}")
+        col2.metric("Increased", f"{stats['increased_pct']:.1f}%")
+        col3.metric("Decreased", f"{stats['decreased_pct']:.1f}%")
+        col4.metric("Valid Pixels", f"{stats['valid_count']:,}")
+        st.caption(
+            f"Change = {vi_name} on {results['item_date_after']} minus {vi_name} on {results['item_date_before']}. "
+            f"Pixels within ±{stats['threshold']} count as stable ({stats['stable_pct']:.1f}%). "
+            f"Range: {stats['min']:+.4f} to {stats['max']:+.4f}, std {stats['std']:.4f}."
+        )
+        
+        st.write("---")
+        
+        # 1. Change map
+        with st.container():
+            st.markdown(f"##### 1. {vi_name} Change Map")
+            change_image = deliver_plot(('change', key_suffix), lambda dpi: utils.create_change_plot(
+                results['diff'], vi_name, figsize=(10, 8), dpi=dpi, stats=stats))
+            show_image(change_image, caption=f"{vi_name} Change (red = decrease, green = increase)")
+            st.download_button(
+                label=f"Download {vi_name} Change Map",
+                data=change_image[0],
+                file_name=f'{vi_name}_change_{results["item_date_before"]}_{results["item_date_after"]}.{change_image[2]}',
+                mime=change_image[1],
+                key=f'dl_change_map_{key_suffix}'
+            )
+        
+        # 2. Both dates side by side
+        with st.container():
+            st.markdown(f"##### 2. {vi_name} on Both Dates")
+            v_min, v_max = vi_plot_range(vi_name)
+            col_before, col_after = st.columns(2)
+            for col, data_key, date_key in ((col_before, 'vi_before', 'item_date_before'), (col_after, 'vi_after', 'item_date_after')):
+                with col:
+                    image = deliver_plot((data_key, key_suffix), lambda dpi: utils.create_vi_plot(
+                        results[data_key], vi_name=vi_name, min_val=v_min, max_val=v_max, dpi=dpi), width_in=8)
+                    show_image(image, caption=f"{vi_name} on {results[date_key]}")
+        
+        # 3. GeoTIFF exports
+        with st.container():
+            st.markdown("##### 3. GeoTIFF Export (with georeferencing)")
+            st.caption("Download the difference and ratio rasters for use in GIS software")
+            col_diff, col_ratio = st.columns(2)
+            with col_diff:
+                st.download_button(
+                    label="Download Difference GeoTIFF",
+                    data=utils.export_geotiff(results['diff']),
+                    file_name=f'{vi_name}_difference_{results["item_date_before"]}_{results["item_date_after"]}.tif',
+                    mime='image/tiff',
+                    key=f'dl_diff_tiff_{key_suffix}',
+                    use_container_width=True
+                )
+            with col_ratio:
+                st.download_button(
+                    label="Download Ratio GeoTIFF",
+                    data=utils.export_geotiff(results['ratio']),
+                    file_name=f'{vi_name}_ratio_{results["item_date_before"]}_{results["item_date_after"]}.tif',
+                    mime='image/tiff',
+                    key=f'dl_ratio_tiff_{key_suffix}',
+                    use_container_width=True
+                )
+    
+    # Helper function to display seasonal composite results
+    def display_composite_section(title, key_suffix):
+        st.markdown(f"#### {title}")
+        
+        stats = results['stats']
+        if stats['count'] == 0:
+            st.warning(f"No valid data for {title}. No clear pixels were found in the AOI.")
+            return
+        
+        vi_name = results['selected_vi']
+        clear_stats = utils.compute_stats(results['clear_count'])
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Mean", f"{stats['mean']:.4f}")
+        col2.metric("Min", f"{stats['min']:.4f}")
+        col3.metric("Max", f"{stats['max']:.4f}")
+        col4.metric("Clear Observations", f"{clear_stats['mean']:.1f} avg" if clear_stats['count'] else "0")
+        
+        st.write("---")
+        
+        # 1. Composite map
+        with st.container():
+            st.markdown(f"##### 1. {vi_name} {results['method'].capitalize()} Composite Map")
+            v_min, v_max = vi_plot_range(vi_name)
+            composite_image = deliver_plot(('composite', key_suffix), lambda dpi: utils.create_vi_plot(
+                results['vi_data_overall'], vi_name=vi_name, min_val=v_min, max_val=v_max, figsize=(10, 8),
+                dpi=dpi, stats=stats))
+            show_image(composite_image, caption=f"{vi_name} {results['method']} composite")
+            st.download_button(
+                label=f"Download {vi_name} Composite Map",
+                data=composite_image[0],
+                file_name=f'{vi_name}_{results["method"]}_composite_{results["item_date"]}.{composite_image[2]}',
+                mime=composite_image[1],
+                key=f'dl_composite_map_{key_suffix}'
+            )
+        
+        # 2. GeoTIFF exports
+        with st.container():
+            st.markdown("##### 2. GeoTIFF Export (with georeferencing)")
+            st.caption("Download the composite and the number of clear observations per pixel")
+            col_vi, col_count = st.columns(2)
+            with col_vi:
+                st.download_button(
+                    label="Download Composite GeoTIFF",
+                    data=utils.export_geotiff(results['vi_data_overall']),
+                    file_name=f'{vi_name}_{results["method"]}_composite_{results["item_date"]}.tif',
+                    mime='image/tiff',
+                    key=f'dl_composite_tiff_{key_suffix}',
+                    use_container_width=True
+                )
+            with col_count:
+                st.download_button(
+                    label="Download Clear Observations GeoTIFF",
+                    data=utils.export_geotiff(results['clear_count']),
+                    file_name=f'{vi_name}_clear_observations_{results["item_date"]}.tif',
+                    mime='image/tiff',
+                    key=f'dl_clear_count_tiff_{key_suffix}',
+                    use_container_width=True
+                )
+    
     # Display Results
-    display_vi_section("Analysis Results", results['vi_data_overall'], "overall")
+    if results.get('mode') == 'change':
+        display_change_section("Change Detection Results", "change")
+    elif results.get('mode') == 'composite':
+        display_composite_section("Seasonal Composite Results", "composite")
+    elif len(results.get('selected_vis', [])) > 1:
+        display_multi_vi_section(results['selected_vis'])
+    else:
+        display_vi_section("Analysis Results", results['vi_data_overall'], "overall", stats=results.get('stats'))
+
+# Field history: statistics of earlier analyses of this AOI, answered from the history store
+# (history.py) without reading any imagery; Run Analysis adds the selected date to it
+history_store = history.get_history_store()
+if geometry and history_store is not None and analysis_mode == "Single Date":
+    history_vis = [selected_vi] + extra_vis
+    history_started = time.perf_counter()
+    try:
+        history_frame = history_store.query(geometry_hash=utils.geometry_hash(geometry), index=history_vis)
+    except Exception as e:
+        history_frame = None
+        st.caption(f"Field history unavailable: {e}")
+    history_ms = (time.perf_counter() - history_started) * 1000
+    
+    if history_frame is not None:
+        st.write("### Field History")
+        if history_frame.empty:
+            st.caption(f"No stored {', '.join(history_vis)} statistics for this area yet. "
+                       f"Every completed analysis adds one point per index.")
+        else:
+            st.caption(f"{len(history_frame)} stored result{'s' if len(history_frame) != 1 else ''} for {', '.join(history_vis)} "
+                       f"(read in {history_ms:.0f} ms, no imagery downloaded). Run the analysis for "
+                       f"another date to add it.")
+            st.line_chart(history_frame.pivot_table(index='date', columns='index', values='mean'))
+            with st.expander("History table"):
+                history_columns = ['date', 'index', 'mean', 'min', 'max', 'std', 'p25', 'p50', 'p75',
+                                   'count', 'cloud_cover', 'item_id', 'field_id']
+                st.dataframe(history_frame[history_columns], hide_index=True, use_container_width=True)
+                st.download_button(
+                    label="Download History (CSV)",
+                    data=history_frame[history_columns].to_csv(index=False),
+                    file_name=f"{history_frame['field_id'].iloc[-1]}_history.csv",
+                    mime='text/csv',
+                    key='dl_field_history'
+                )
 
 # Footer Section
 st.markdown("---")
@@ -632,3 +1183,7 @@ Copyright 2025 Nattakit Namsungneon | Project Palantir | Built with Streamlit &
 """, unsafe_allow_html=True)
     
 
+# Keep polling the background analysis job (after the whole page has rendered)
+if poll_analysis_job:
+    time.sleep(1.0 if st.session_state.analysis_results else 0.5)
+    st.rerun()
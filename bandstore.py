@@ -0,0 +1,197 @@
+"""On-disk store of decoded, clipped band windows.
+
+The in-memory cache (cache.py) is lost on restart and evicts under memory
+pressure, after which a band has to be fetched and decoded again. This store
+keeps every decoded window as a raw ``.npy`` file keyed by (item id, band,
+window, resolution), with a small SQLite index holding georeferencing metadata
+and last access times. Reads are memory-mapped, so switching index or
+re-exporting loads pixels lazily from the page cache instead of the decoder.
+
+The store is off unless PALANTIR_BAND_STORE (location, default
+~/.cache/palantir/bands) or PALANTIR_BAND_STORE_MB (size limit, default 2048;
+0 disables it) is set. Least recently used windows are deleted first.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'palantir', 'bands')
+DEFAULT_BUDGET_MB = 2048
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS windows (
+    key TEXT PRIMARY KEY,
+    item_id TEXT NOT NULL,
+    band TEXT NOT NULL,
+    window TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    nbytes INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_windows_last_access ON windows (last_access);
+"""
+
+
+def _json_attrs(attrs):
+    """Keep the attributes that survive a JSON round trip (scale, offset, nodata, ...)."""
+    kept = {}
+    for name, value in attrs.items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, (str, int, float, bool)):
+            kept[name] = value
+    return kept
+
+
+class BandStore:
+    """Memory-mapped .npy files of 2-D band windows with an LRU size limit."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        os.makedirs(root, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread (bands are read on worker threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        """Return the stored window as a DataArray backed by a read-only memmap, or None."""
+        import xarray as xr
+        import rioxarray  # noqa: F401  (registers the .rio accessor)
+
+        conn = self._connect()
+        row = conn.execute("SELECT meta FROM windows WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            data = np.load(self._path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            # File removed behind our back (e.g. by another process evicting it)
+            with conn:
+                conn.execute("DELETE FROM windows WHERE key = ?", (key,))
+            return None
+        with conn:
+            conn.execute("UPDATE windows SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        meta = json.loads(row[0])
+        da = xr.DataArray(data, dims=('y', 'x'), coords={'y': meta['y'], 'x': meta['x']}, attrs=meta['attrs'])
+        if meta['crs']:
+            # In place: the default deep copy would pull the whole memmap into memory
+            da.rio.write_crs(meta['crs'], inplace=True)
+        return da
+
+    def __contains__(self, key):
+        return self._connect().execute("SELECT 1 FROM windows WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key, da, item_id, band, window, resolution=None):
+        """Write a 2-D DataArray (dims y, x) under key. Returns False if it was not stored
+        (wrong shape or larger than the whole store).
+        """
+        values = np.asarray(da.values)
+        if values.ndim != 2 or values.nbytes > self.max_bytes:
+            return False
+
+        crs = da.rio.crs if hasattr(da, 'rio') else None
+        meta = {
+            'y': da['y'].values.tolist(),
+            'x': da['x'].values.tolist(),
+            'crs': crs.to_wkt() if crs is not None else None,
+            'attrs': _json_attrs(da.attrs),
+        }
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per process and thread, so concurrent writers never share a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, values)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO windows (key, item_id, band, window, resolution, nbytes, meta, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, item_id, band, json.dumps(window), str(resolution), values.nbytes, json.dumps(meta), time.time())
+            )
+        self._evict()
+        return True
+
+    def _evict(self):
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM windows").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, nbytes in conn.execute("SELECT key, nbytes FROM windows ORDER BY last_access").fetchall():
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # Still mapped (Windows refuses to delete open files): keep its row so the
+                    # file stays accounted for and is retried on the next eviction
+                    continue
+                with conn:
+                    conn.execute("DELETE FROM windows WHERE key = ?", (key,))
+                total -= nbytes
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self):
+        count, total = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM windows").fetchone()
+        return {'windows': count, 'bytes': total, 'max_bytes': self.max_bytes}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_band_store():
+    """Store configured through PALANTIR_BAND_STORE / PALANTIR_BAND_STORE_MB, or None if disabled.
+
+    Opt-in: without either variable nothing is written to disk.
+    """
+    global _store
+    if 'PALANTIR_BAND_STORE' not in os.environ and 'PALANTIR_BAND_STORE_MB' not in os.environ:
+        return None
+    try:
+        budget_mb = float(os.environ.get('PALANTIR_BAND_STORE_MB', DEFAULT_BUDGET_MB))
+    except ValueError:
+        budget_mb = DEFAULT_BUDGET_MB
+    if budget_mb <= 0:
+        return None
+    root = os.environ.get('PALANTIR_BAND_STORE', DEFAULT_ROOT)
+    with _store_lock:
+        if _store is None or _store.root != root:
+            try:
+                _store = BandStore(root, budget_mb * 1024 * 1024)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Band store unavailable at {root}: {e}")
+                return None
+        return _store
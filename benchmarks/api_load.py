@@ -0,0 +1,177 @@
+"""Local load test for the analysis API (api.py).
+
+Builds a synthetic Sentinel-2 scene (tiled COGs in a temporary mirror directory,
+indexed in a temporary local catalog, see catalog.py), starts the API on a free
+port in this process and sends bursts of concurrent /analyze requests. Nothing
+is fetched from the network.
+
+Reported per phase: latency percentiles, throughput, and how many requests were
+computed vs. coalesced onto an in-flight computation. Fails if identical
+concurrent requests were computed more than once.
+
+Usage:
+    python benchmarks/api_load.py [--clients 16] [--requests 64] [--fields 4] [--size-km 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Synthetic scene: UTM zone 47N around lon 100.5, lat 13.7
+CRS = 'EPSG:32647'
+X0, Y0 = 650000, 1530000
+SCENE_DATE = '2025-01-10'
+BANDS = {'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10, 'B05': 20, 'B11': 20, 'B12': 20, 'SCL': 20}
+
+
+def build_scene(workdir, size_km):
+    """Write COGs for one synthetic scene and index it. Returns the scene footprint (lon/lat bounds)."""
+    import numpy as np
+    import pystac
+    import rasterio
+    from pyproj import Transformer
+    from rasterio.transform import from_origin
+
+    import catalog
+
+    item_id = 'S2_API_LOAD'
+    size_m = int(size_km * 1000)
+    rng = np.random.default_rng(0)
+    item_dir = os.path.join(workdir, 'mirror', item_id)
+    os.makedirs(item_dir, exist_ok=True)
+    for band, res in BANDS.items():
+        n = size_m // res
+        if band == 'SCL':
+            data = np.full((n, n), 4, dtype='uint8')
+        else:
+            data = (rng.random((n, n)) * 3000 + 500).astype('uint16')
+        profile = dict(driver='GTiff', width=n, height=n, count=1, dtype=data.dtype, crs=CRS,
+                       transform=from_origin(X0, Y0, res, res), tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate')
+        with rasterio.open(os.path.join(item_dir, f'{band}.tif'), 'w', **profile) as dst:
+            dst.write(data, 1)
+            dst.build_overviews([2, 4, 8])
+
+    to_lonlat = Transformer.from_crs(CRS, 'EPSG:4326', always_xy=True)
+    corners = [to_lonlat.transform(x, y) for x, y in
+               [(X0, Y0), (X0 + size_m, Y0), (X0 + size_m, Y0 - size_m), (X0, Y0 - size_m)]]
+    lons, lats = [c[0] for c in corners], [c[1] for c in corners]
+    item = pystac.Item(
+        id=item_id, geometry={'type': 'Polygon', 'coordinates': [corners + [corners[0]]]},
+        bbox=[min(lons), min(lats), max(lons), max(lats)],
+        datetime=pystac.utils.str_to_datetime(f'{SCENE_DATE}T03:30:00Z'),
+        properties={'eo:cloud_cover': 3.0}, collection=catalog.COLLECTION,
+    )
+    for band in BANDS:
+        # Remote-looking hrefs; the catalog resolves them to the mirrored files
+        item.add_asset(band, pystac.Asset(href=f'https://example.invalid/{item_id}/{band}.tif'))
+
+    local = catalog.LocalCatalog(os.path.join(workdir, 'scenes.db'), os.path.join(workdir, 'mirror'))
+    local.add_items([item])
+    return max(lons[0], lons[3]), max(lats[2], lats[3]), min(lons[1], lons[2]), min(lats[0], lats[1])
+
+
+def field_geometries(bounds, count):
+    """count small square fields spread over the scene."""
+    minx, miny, maxx, maxy = bounds
+    step = min(maxx - minx, maxy - miny) / (count + 1)
+    size = step * 0.6
+    fields = []
+    for i in range(count):
+        x, y = minx + step * (i + 0.5), miny + step * (i + 0.5)
+        fields.append({'type': 'Polygon', 'coordinates': [[
+            [x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]
+        ]]})
+    return fields
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        payload = json.load(response)
+    return time.perf_counter() - started, payload
+
+
+def run_phase(name, url, bodies, clients):
+    import api
+
+    before = api.flights.stats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda body: post(url, body), bodies))
+    elapsed = time.perf_counter() - started
+    after = api.flights.stats()
+
+    latencies = sorted(seconds for seconds, _ in results)
+    quantiles = statistics.quantiles(latencies, n=20) if len(latencies) > 1 else latencies * 19
+    executed = after['executed'] - before['executed']
+    coalesced = after['coalesced'] - before['coalesced']
+    print(f"{name:<28} {len(bodies):>4} req  {len(bodies) / elapsed:7.1f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:7.0f} ms  p95 {quantiles[18] * 1000:7.0f} ms  "
+          f"computed {executed:>3}  coalesced {coalesced:>3}")
+    return executed, coalesced, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help="Concurrent client threads")
+    parser.add_argument('--requests', type=int, default=64, help="Requests per phase")
+    parser.add_argument('--fields', type=int, default=4, help="Distinct fields in the mixed phase")
+    parser.add_argument('--size-km', type=float, default=10, help="Synthetic scene size")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Fully local: scene index and mirror in the temp dir, fresh band store
+        os.environ['PALANTIR_CATALOG_DB'] = os.path.join(workdir, 'scenes.db')
+        os.environ['PALANTIR_MIRROR_DIR'] = os.path.join(workdir, 'mirror')
+        os.environ['PALANTIR_BAND_STORE'] = os.path.join(workdir, 'bands')
+        os.environ['PALANTIR_API_QUIET'] = '1'
+
+        print(f"Building {args.size_km:g} km synthetic scene...")
+        bounds = build_scene(workdir, args.size_km)
+        fields = field_geometries(bounds, args.fields)
+
+        import api
+
+        server = api.make_server('127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/analyze"
+
+        def body(geometry):
+            return {'geometry': geometry, 'date': '2025-01-31', 'indices': ['NDVI', 'NDRE', 'NBR']}
+
+        try:
+            # 1. One burst of identical concurrent requests for a field nobody has computed yet
+            executed, _, results = run_phase("identical, cold", url, [body(fields[0])] * args.clients, args.clients)
+            # 2. Same request again: served from the result cache
+            run_phase("identical, cached", url, [body(fields[0])] * args.requests, args.clients)
+            # 3. Several fields interleaved (bands of the scene window are shared via the caches)
+            mixed = [body(fields[i % len(fields)]) for i in range(args.requests)]
+            run_phase("mixed fields", url, mixed, args.clients)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        ndvi = results[0][1]['indices']['NDVI']
+        print(f"NDVI mean {ndvi['mean']:.4f} over {ndvi['count']:,} pixels; "
+              f"cache: {api.cache.shared.stats()}")
+
+    if executed != 1:
+        print(f"FAIL: identical concurrent requests were computed {executed} times")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Whole-array vs. tiled index computation (compute.py) on synthetic bands.
+
+Builds random in-memory Sentinel-2 bands (10 m and 20 m) for a square AOI and
+computes the same indices with the whole-array formulas (one NumPy expression
+over full-size arrays, as the lazy path does) and with utils.calculate_vis,
+which evaluates them tile by tile on the compute pool. Nothing is read from
+disk or the network.
+
+Reported per path: best wall time of several runs and the peak of memory
+allocated during one run (tracemalloc). Fails if the tiled results differ from
+the whole-array ones.
+
+Usage:
+    python benchmarks/index_compute.py [--size 4000] [--indices MSAVI,GARI,NDVI,NDRE] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CRS = 'EPSG:32647'
+X0, Y0 = 650000, 1530000
+BANDS = {'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10, 'B05': 20, 'B07': 20, 'B11': 20, 'B12': 20}
+
+
+def make_bands(size):
+    """Random uint16 bands over size x size 10 m pixels, as load_bands returns them."""
+    import numpy as np
+    import rioxarray  # noqa: F401 (registers .rio)
+    import xarray as xr
+
+    rng = np.random.default_rng(0)
+    bands = {}
+    for band, res in BANDS.items():
+        n = size * 10 // res
+        data = (rng.random((n, n)) * 4000).astype('uint16')
+        coords = {'y': Y0 - res / 2 - np.arange(n) * res, 'x': X0 + res / 2 + np.arange(n) * res}
+        bands[band] = xr.DataArray(data, coords=coords, dims=('y', 'x')).rio.write_crs(CRS)
+    return bands
+
+
+def measure(fn, repeat):
+    fn()  # Warm-up (kernel compilation, thread pool start)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=4000, help="AOI edge length in 10 m pixels")
+    parser.add_argument('--indices', default='MSAVI,GARI,NDVI,NDRE', help="Comma-separated index names")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per path")
+    args = parser.parse_args()
+
+    import numpy as np
+
+    import compute
+    import utils
+
+    names = args.indices.split(',')
+    bands = make_bands(args.size)
+    print(f"{args.size} x {args.size} pixels, {', '.join(names)}; {compute.threads()} compute threads, "
+          f"tiles of {compute.TILE_PIXELS:,} pixels")
+
+    timings = {}
+    results = {}
+    for label, fn in (("whole-array", lambda: utils._calculate_vis_lazy(bands, names)),
+                      ("tiled", lambda: utils.calculate_vis(bands, names))):
+        seconds, peak, results[label] = measure(fn, args.repeat)
+        timings[label] = seconds
+        print(f"{label:<12} {seconds * 1000:8.0f} ms  peak {peak / 2 ** 20:7.0f} MB")
+    print(f"speed-up {timings['whole-array'] / timings['tiled']:.1f}x")
+
+    differing = [name for name in names if not np.array_equal(
+        np.asarray(results['whole-array'][name]), np.asarray(results['tiled'][name]), equal_nan=True)]
+    if differing:
+        print(f"FAIL: tiled results differ for {', '.join(differing)}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Tail latency of COG window reads with and without hedging/retries (reads.py).
+
+Writes a tiled COG to a temporary directory and serves it from a local HTTP
+server that supports range requests and injects faults: the first request of
+every Nth read stalls for a few seconds, and that of another share of reads
+fails with 503 (later attempts of a read, with their distinct URLs, are
+served normally, like requests that land on a healthy storage node). The
+same random window reads (utils._read_window, as load_bands does them) are
+timed through a plain reader (no hedging, no retries) and through the default
+reader settings. Nothing is fetched from the network.
+
+Reported per phase: latency percentiles, failed reads, and the hedges and
+retries issued. Fails if the hedged reader does not cut p99 latency, loses
+reads to injected errors, or if a read that stalls past its deadline does not
+raise ReadTimeout.
+
+Usage:
+    python benchmarks/read_hedging.py [--reads 200] [--concurrency 8] [--stall-every 50]
+                                      [--stall-seconds 3] [--error-every 50]
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# GDAL must not list the server's "directory" on open, and must not retry on its own
+os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+os.environ['GDAL_HTTP_MAX_RETRY'] = '0'
+
+CRS = 'EPSG:32647'
+X0, Y0 = 650000, 1530000
+SIZE = 4096  # pixels (10 m)
+WINDOW_M = 3000
+
+
+class FaultyHandler(BaseHTTPRequestHandler):
+    """Static files with Range support. The first GET of a read's original URL
+    (?read=<phase>-<n>, no attempt parameter) stalls or fails per the server's fault settings.
+    """
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        server = self.server
+        match = re.search(r'read=[\w]+-(\d+)$', self.path)
+        with server.lock:
+            first = match is not None and self.path not in server.seen
+            server.seen.add(self.path)
+        if first and server.stall_every and int(match.group(1)) % server.stall_every == 0:
+            time.sleep(server.stall_seconds)
+        elif first and server.error_every and int(match.group(1)) % server.error_every == server.error_every // 2:
+            self.send_error(503, "Injected failure")
+            return
+        self._serve(body=True)
+
+    def _serve(self, body):
+        path = os.path.join(self.server.directory, os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        ranged = self.headers.get('Range', '').startswith('bytes=')
+        if ranged:
+            first, _, last = self.headers['Range'][6:].partition('-')
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+        try:
+            self.send_response(206 if ranged else 200)
+            self.send_header('Content-Type', 'image/tiff')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if ranged:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if body:
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    self.wfile.write(f.read(end - start + 1))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client gave up on a stalled request (or a hedge won)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FaultyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # The default backlog (5) adds 1 s SYN retries under concurrency
+
+    def handle_error(self, request, client_address):
+        pass  # Clients abandon stalled requests (deadlines, hedges won)
+
+
+def write_cog(path):
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    data = (np.random.default_rng(0).random((SIZE, SIZE)) * 3000 + 500).astype('uint16')
+    profile = dict(driver='GTiff', width=SIZE, height=SIZE, count=1, dtype='uint16', crs=CRS,
+                   transform=from_origin(X0, Y0, 10, 10), tiled=True, blockxsize=256, blockysize=256,
+                   compress='deflate')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+        dst.build_overviews([2, 4, 8])
+
+
+def windows(count, seed=1):
+    """count random lon/lat windows of WINDOW_M metres inside the scene."""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    rng = random.Random(seed)
+    extent = SIZE * 10 - WINDOW_M
+    boxes = []
+    for _ in range(count):
+        x, y = X0 + rng.uniform(0, extent), Y0 - WINDOW_M - rng.uniform(0, extent)
+        boxes.append(box(x, y, x + WINDOW_M, y + WINDOW_M))
+    return [gpd.GeoDataFrame(geometry=[b], crs=CRS).to_crs('EPSG:4326') for b in boxes]
+
+
+def run_phase(name, reader, url, gdfs, concurrency, warmup):
+    import utils
+
+    tag = re.sub(r'\W+', '', name)
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def read(gdf):
+        with lock:
+            n = next(counter)
+        # A unique query string per read, so GDAL's per-URL block cache never answers
+        started = time.perf_counter()
+        try:
+            reader.call(utils._read_window, f"{url}?read={tag}-{n}", gdf)
+            return time.perf_counter() - started, None
+        except Exception as e:
+            return time.perf_counter() - started, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Warm-up reads fill the latency histogram the hedge threshold is taken from
+        list(pool.map(read, gdfs[:warmup]))
+        before = dict(reader.counters)
+        results = list(pool.map(read, gdfs[warmup:]))
+
+    latencies = sorted(seconds for seconds, _ in results)
+    failed = sum(1 for _, error in results if error is not None)
+    q = statistics.quantiles(latencies, n=100)
+    counts = {k: reader.counters[k] - before[k] for k in ('hedges', 'hedge_wins', 'retries')}
+    print(f"{name:<24} {len(results):>4} reads  p50 {q[49] * 1000:6.0f} ms  p95 {q[94] * 1000:6.0f} ms  "
+          f"p99 {q[98] * 1000:6.0f} ms  max {latencies[-1] * 1000:6.0f} ms  failed {failed:>3}  "
+          f"hedges {counts['hedges']:>3} (won {counts['hedge_wins']:>3})  retries {counts['retries']:>3}")
+    return q[98], failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reads', type=int, default=200, help="Timed reads per phase")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent reads")
+    parser.add_argument('--stall-every', type=int, default=50, help="Every Nth read has a stalled request")
+    parser.add_argument('--stall-seconds', type=float, default=3.0, help="How long a stalled request hangs")
+    parser.add_argument('--error-every', type=int, default=50, help="Every Nth read has a request failing with 503")
+    args = parser.parse_args()
+
+    import reads
+    import utils
+
+    with tempfile.TemporaryDirectory() as workdir:
+        write_cog(os.path.join(workdir, 'B04.tif'))
+        server = FaultyServer(('127.0.0.1', 0), FaultyHandler)
+        server.directory = workdir
+        server.lock, server.seen = threading.Lock(), set()
+        server.stall_every, server.stall_seconds, server.error_every = 0, args.stall_seconds, 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/B04.tif"
+
+        warmup = reads.MIN_HEDGE_SAMPLES + args.concurrency
+        gdfs = windows(warmup + args.reads)
+        try:
+            run_phase("no faults", reads.Reader(hedge_percentile=0, retries=0), url, gdfs,
+                      args.concurrency, warmup)
+            server.stall_every, server.error_every = args.stall_every, args.error_every
+            plain_p99, _ = run_phase("faults, plain", reads.Reader(hedge_percentile=0, retries=0), url, gdfs,
+                                     args.concurrency, warmup)
+            hedged = reads.Reader()
+            hedged_p99, hedged_failed = run_phase("faults, hedged+retry", hedged, url, gdfs,
+                                                  args.concurrency, warmup)
+            print(f"hedge threshold {hedged.stats()['hedge_delay_ms']:.0f} ms; "
+                  f"latency histogram: {hedged.stats()['latency']['buckets_ms']}")
+
+            # Every request stalls: the read must give up at its deadline
+            server.stall_every, server.error_every = 1, 0
+            started = time.perf_counter()
+            try:
+                reads.Reader(deadline=1, hedge_percentile=0).call(utils._read_window, f"{url}?read=deadline-0",
+                                                                  gdfs[0])
+                timed_out = False
+            except reads.ReadTimeout:
+                timed_out = True
+            print(f"deadline 1 s, server stalled: {'ReadTimeout' if timed_out else 'no timeout'} "
+                  f"after {time.perf_counter() - started:.2f} s")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    failures = []
+    if hedged_p99 >= plain_p99:
+        failures.append(f"hedged p99 {hedged_p99 * 1000:.0f} ms is not below plain p99 {plain_p99 * 1000:.0f} ms")
+    if hedged_failed:
+        failures.append(f"{hedged_failed} reads failed with retries enabled")
+    if not timed_out:
+        failures.append("stalled read did not raise ReadTimeout")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
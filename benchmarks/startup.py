@@ -0,0 +1,88 @@
+"""Cold-start import benchmark for Project Palantir.
+
+Imports ``utils`` (and the top-level imports of ``app.py``) in fresh
+interpreters, reports the median import time and fails when it exceeds the
+configured budget or when a heavy dependency is imported eagerly.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--utils-budget-ms 300] [--app-budget-ms 2500]
+"""
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported on first use, never by `import utils`
+HEAVY_MODULES = [
+    'pystac_client', 'planetary_computer', 'rioxarray', 'rasterio', 'xarray',
+    'geopandas', 'pandas', 'matplotlib', 'plotly', 'stackstac', 'dask',
+]
+
+
+def _app_imports():
+    """Return the import statements at the top level of app.py."""
+    with open(os.path.join(ROOT, 'app.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def _time_import(code):
+    """Run code in a fresh interpreter and return (seconds, modules loaded)."""
+    probe = (
+        "import sys, time\n"
+        "t0 = time.perf_counter()\n"
+        f"{code}\n"
+        "dt = time.perf_counter() - t0\n"
+        f"print(dt, ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', probe], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout.strip().splitlines()[-1]
+    seconds, _, loaded = out.partition(' ')
+    return float(seconds), [m for m in loaded.split(',') if m]
+
+
+def measure(label, code, runs):
+    """Median import time in milliseconds over several cold runs."""
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        seconds, loaded = _time_import(code)
+        timings.append(seconds * 1000)
+    median_ms = statistics.median(timings)
+    print(f"{label:<6} median {median_ms:8.1f} ms  (min {min(timings):.1f}, max {max(timings):.1f})")
+    return median_ms, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--utils-budget-ms', type=float, default=300.0)
+    parser.add_argument('--app-budget-ms', type=float, default=2500.0)
+    args = parser.parse_args()
+
+    failures = []
+
+    utils_ms, eager = measure('utils', 'import utils', args.runs)
+    if utils_ms > args.utils_budget_ms:
+        failures.append(f"import utils took {utils_ms:.1f} ms (budget {args.utils_budget_ms:.0f} ms)")
+    if eager:
+        failures.append(f"import utils eagerly loaded: {', '.join(eager)}")
+
+    app_ms, _ = measure('app', '\n'.join(_app_imports()), args.runs)
+    if app_ms > args.app_budget_ms:
+        failures.append(f"app.py imports took {app_ms:.1f} ms (budget {args.app_budget_ms:.0f} ms)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: within import-time budget")
+
+
+if __name__ == '__main__':
+    main()
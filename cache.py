@@ -0,0 +1,134 @@
+"""Process-wide in-memory cache shared by all Streamlit sessions.
+
+Band arrays and analysis results are stored once per server process and looked
+up by key, so several users analysing the same fields share one copy. The cache
+is bounded by a memory budget (PALANTIR_CACHE_MB, default 512) and evicts the
+least recently used entries first.
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_BUDGET_MB = 512
+
+
+def estimate_nbytes(value, _seen=None):
+    """Approximate memory footprint of a cached value in bytes. An array referenced from
+    several places in the value (e.g. a result's first index and its 'vis' entry) is counted once.
+    """
+    if value is None:
+        return 0
+    if _seen is None:
+        _seen = set()
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray) or (hasattr(value, 'nbytes') and hasattr(value, 'dims')):
+        # numpy array or xarray DataArray / Dataset
+        if id(value) in _seen:
+            return 0
+        _seen.add(id(value))
+        return int(value.nbytes)
+    if hasattr(value, 'getbuffer'):
+        # io.BytesIO
+        return value.getbuffer().nbytes
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v, _seen) for v in value.values()) + sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(v, _seen) for v in value) + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+
+def make_key(*parts):
+    """Build a short, stable cache key from JSON-serialisable parts."""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class SharedCache:
+    """Thread-safe LRU cache bounded by total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key (marking it recently used), or default."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value, nbytes=None):
+        """Store value under key, evicting least recently used entries to stay in budget.
+        Returns False if the value alone is larger than the whole budget (not cached).
+        """
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return False
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.current_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Return a dict with entry count, size accounting and hit/miss counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _budget_from_env():
+    try:
+        return float(os.environ.get('PALANTIR_CACHE_MB', DEFAULT_BUDGET_MB)) * 1024 * 1024
+    except ValueError:
+        return DEFAULT_BUDGET_MB * 1024 * 1024
+
+
+# Single cache instance per server process (module state is shared by all sessions)
+shared = SharedCache(_budget_from_env())
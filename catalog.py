@@ -0,0 +1,292 @@
+"""Local Sentinel-2 L2A scene index for offline or mirrored archives.
+
+Item metadata is kept in SQLite with an R-tree on item footprints (bounding
+boxes) and indexes on acquisition datetime and cloud cover, so scene lookups
+for any AOI/date take milliseconds. Asset hrefs are resolved to local COG files
+in the mirror directory (``<mirror>/<item id>/<asset>.tif``) when they exist.
+
+API syncs record the period each bbox has been synced for (synced_areas), so
+later syncs of the same area continue where the last one ended and a new area
+is indexed from the start of the archive.
+
+The app uses this catalog when PALANTIR_CATALOG_DB points at a database
+(mirror directory: PALANTIR_MIRROR_DIR): searches inside an area synced up to
+the end of the search window are answered locally; others query the Planetary
+Computer and fall back to the local index when it fails or times out.
+
+Usage:
+    python catalog.py sync --db scenes.db --bbox 100.4 13.6 100.7 13.9 --start 2024-01-01
+    python catalog.py sync --db scenes.db --stac-dir /data/s2/items
+    python catalog.py sync --db scenes.db --mirror /data/s2 --bbox ... --download B04 B08 SCL
+    python catalog.py stats --db scenes.db
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+STAC_API_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+COLLECTION = "sentinel-2-l2a"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    collection TEXT,
+    datetime TEXT NOT NULL,
+    cloud_cover REAL,
+    item_json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_items_datetime ON items (datetime);
+CREATE INDEX IF NOT EXISTS idx_items_cloud_cover ON items (cloud_cover);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_rtree USING rtree (rowid, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS synced_areas (
+    minx REAL, miny REAL, maxx REAL, maxy REAL,
+    synced_from TEXT NOT NULL,
+    synced_until TEXT NOT NULL,
+    PRIMARY KEY (minx, miny, maxx, maxy)
+);
+"""
+
+ARCHIVE_START = '2015-06-23T00:00:00Z'  # Sentinel-2A launch
+
+
+def _iso_utc(dt):
+    """Normalise a datetime (or ISO string) to a sortable UTC string."""
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class LocalCatalog:
+    """SQLite-backed index of STAC item metadata with R-tree footprint lookup."""
+
+    def __init__(self, db_path, mirror_root=None):
+        self.db_path = db_path
+        self.mirror_root = mirror_root
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread (analyses run on worker threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def local_asset_path(self, item_id, asset_key):
+        """Path of the mirrored COG for an asset, or None if it is not mirrored."""
+        if not self.mirror_root:
+            return None
+        path = os.path.join(self.mirror_root, item_id, f"{asset_key}.tif")
+        return path if os.path.exists(path) else None
+
+    def add_items(self, items):
+        """Insert STAC items (pystac.Item or dicts); existing ids are skipped.
+        Returns the number of new items.
+        """
+        added = 0
+        conn = self._connect()
+        with conn:
+            for item in items:
+                d = item.to_dict() if hasattr(item, 'to_dict') else item
+                props = d.get('properties', {})
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO items (id, collection, datetime, cloud_cover, item_json) VALUES (?, ?, ?, ?, ?)",
+                    (d['id'], d.get('collection'), _iso_utc(props['datetime']), props.get('eo:cloud_cover'), json.dumps(d))
+                )
+                if cursor.rowcount:
+                    minx, miny, maxx, maxy = d['bbox'][:4]
+                    conn.execute(
+                        "INSERT INTO items_rtree (rowid, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+                        (cursor.lastrowid, minx, maxx, miny, maxy)
+                    )
+                    added += 1
+        return added
+
+    def search(self, bbox, start, end, cloud_cover_max=None):
+        """Items whose footprint bbox intersects bbox, acquired between start and end,
+        with cloud cover below cloud_cover_max. Returns pystac.Items whose asset hrefs
+        point at mirrored local files where available.
+        """
+        import pystac
+
+        sql = (
+            "SELECT i.item_json FROM items_rtree r JOIN items i ON i.rowid = r.rowid "
+            "WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ? "
+            "AND i.datetime BETWEEN ? AND ?"
+        )
+        params = [bbox[2], bbox[0], bbox[3], bbox[1], _iso_utc(start), _iso_utc(end)]
+        if cloud_cover_max is not None:
+            sql += " AND i.cloud_cover < ?"
+            params.append(cloud_cover_max)
+
+        return [self.localize(pystac.Item.from_dict(json.loads(item_json)))
+                for (item_json,) in self._connect().execute(sql, params)]
+
+    def localize(self, item):
+        """Point the asset hrefs of an item at mirrored local files where available."""
+        for key, asset in item.assets.items():
+            local_path = self.local_asset_path(item.id, key)
+            if local_path:
+                asset.href = local_path
+        return item
+
+    _CONTAINS = "minx <= ? AND miny <= ? AND maxx >= ? AND maxy >= ?"
+
+    def synced_until(self, bbox):
+        """End of the latest sync of an area containing bbox (UTC ISO string), or None."""
+        row = self._connect().execute(f"SELECT MAX(synced_until) FROM synced_areas WHERE {self._CONTAINS}",
+                                      [float(v) for v in bbox]).fetchone()
+        return row[0]
+
+    def covers(self, bbox, start, end):
+        """True if an area containing bbox was synced for the whole period start..end."""
+        row = self._connect().execute(
+            f"SELECT 1 FROM synced_areas WHERE {self._CONTAINS} AND synced_from <= ? AND synced_until >= ? LIMIT 1",
+            [*(float(v) for v in bbox), _iso_utc(start), _iso_utc(end)]
+        ).fetchone()
+        return row is not None
+
+    def mark_synced(self, bbox, start, end):
+        """Record that every item over bbox acquired between start and end has been indexed.
+        Extends the recorded period of bbox when the two overlap; a period after a gap does not
+        replace it (the gap is still missing).
+        """
+        key = [float(v) for v in bbox]
+        start, end = _iso_utc(start), _iso_utc(end)
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT synced_from, synced_until FROM synced_areas "
+                               "WHERE minx = ? AND miny = ? AND maxx = ? AND maxy = ?", key).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO synced_areas VALUES (?, ?, ?, ?, ?, ?)", [*key, start, end])
+            elif start <= row[1] and end >= row[0]:
+                conn.execute("UPDATE synced_areas SET synced_from = ?, synced_until = ? "
+                             "WHERE minx = ? AND miny = ? AND maxx = ? AND maxy = ?",
+                             [min(start, row[0]), max(end, row[1]), *key])
+
+    def stats(self):
+        conn = self._connect()
+        count, first, last = conn.execute("SELECT COUNT(*), MIN(datetime), MAX(datetime) FROM items").fetchone()
+        return {'items': count, 'first': first, 'last': last}
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_local_catalog():
+    """Catalog configured through PALANTIR_CATALOG_DB / PALANTIR_MIRROR_DIR, or None."""
+    global _catalog
+    db_path = os.environ.get('PALANTIR_CATALOG_DB')
+    if not db_path:
+        return None
+    with _catalog_lock:
+        if _catalog is None or _catalog.db_path != db_path:
+            _catalog = LocalCatalog(db_path, os.environ.get('PALANTIR_MIRROR_DIR'))
+        return _catalog
+
+
+def _download_assets(item, asset_keys, mirror_root):
+    """Copy the given assets of a (remote) item into the mirror directory."""
+    import shutil
+    import urllib.request
+    import reads
+    import signing
+
+    for key in asset_keys:
+        if key not in item.assets:
+            continue
+        path = os.path.join(mirror_root, item.id, f"{key}.tif")
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".part"
+        href = signing.sign_href(item.assets[key].href, item.collection_id or COLLECTION)
+        # A stalled download fails after the read deadline (PALANTIR_READ_DEADLINE_S) without data
+        with urllib.request.urlopen(href, timeout=reads.reader.deadline) as response, open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(response, f)
+        os.replace(tmp_path, path)
+
+
+def sync(catalog, bbox=None, start=None, end=None, stac_dir=None, download=None):
+    """Add new items to the catalog, either from a directory of STAC item JSON files
+    or from the Planetary Computer STAC API for bbox (required). API syncs are incremental:
+    unless start is given they start from the watermark of a synced area containing bbox,
+    or from the start of the archive for a new area. Returns items added.
+    """
+    if stac_dir:
+        items = []
+        for path in sorted(glob.glob(os.path.join(stac_dir, '**', '*.json'), recursive=True)):
+            with open(path, encoding='utf-8') as f:
+                d = json.load(f)
+            if d.get('type') == 'Feature':
+                items.append(d)
+        return catalog.add_items(items)
+
+    import pystac_client
+
+    if bbox is None:
+        raise ValueError("A bbox is required to sync from the STAC API")
+    if start is None:
+        start = catalog.synced_until(bbox) or ARCHIVE_START
+    end = end or datetime.now(timezone.utc).isoformat()
+    client = pystac_client.Client.open(STAC_API_URL)
+    search = client.search(collections=[COLLECTION], bbox=bbox, datetime=f"{_iso_utc(start)}/{_iso_utc(end)}")
+
+    added = 0
+    batch = []
+    for item in search.items():
+        batch.append(item)
+        if download and catalog.mirror_root:
+            _download_assets(item, download, catalog.mirror_root)
+        if len(batch) >= 500:
+            added += catalog.add_items(batch)
+            batch = []
+    added += catalog.add_items(batch)
+    catalog.mark_synced(bbox, start, end)
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Sentinel-2 scene index")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help="Add new items to the index")
+    sync_parser.add_argument('--db', required=True)
+    sync_parser.add_argument('--mirror', help="Directory with mirrored COGs (<mirror>/<item id>/<asset>.tif)")
+    sync_parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                             help="Area to sync (required unless --stac-dir is given)")
+    sync_parser.add_argument('--start', help="ISO date; default: where the last sync of this bbox ended, "
+                                             "or the start of the archive")
+    sync_parser.add_argument('--end', help="ISO date; default: now")
+    sync_parser.add_argument('--stac-dir', help="Index STAC item JSON files from this directory instead of the API")
+    sync_parser.add_argument('--download', nargs='+', metavar='ASSET', help="Also mirror these assets (e.g. B04 B08 SCL)")
+
+    stats_parser = subparsers.add_parser('stats', help="Show index size and date range")
+    stats_parser.add_argument('--db', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'sync' and args.bbox is None and not args.stac_dir:
+        # Without a bbox the API sync would crawl (and --download mirror) the whole global archive
+        parser.error("sync from the STAC API requires --bbox")
+    if args.command == 'sync':
+        catalog = LocalCatalog(args.db, args.mirror)
+        added = sync(catalog, bbox=args.bbox, start=args.start, end=args.end,
+                     stac_dir=args.stac_dir, download=args.download)
+        print(f"Added {added} items")
+        print(catalog.stats())
+    else:
+        print(LocalCatalog(args.db).stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Tiled, multi-threaded evaluation of index formulas over in-memory bands.
+
+Written as whole-array NumPy expressions, an index formula runs on one core and
+allocates a full-size temporary for every sub-expression (MSAVI makes half a
+dozen, each as large as the AOI). run() splits the aligned bands into row
+blocks of about TILE_PIXELS pixels instead, so the inputs and temporaries of a
+block stay in CPU cache, and evaluates the formula block by block on a shared
+thread pool. NumPy ufuncs (and numexpr) release the GIL while they work, so
+blocks of a large AOI run on all cores. Each block's result is written into a
+preallocated output array; the temporaries alive at any time are bounded by
+threads x tile size, not by the AOI.
+
+Lazy (dask) bands do not come through here: dask already works chunk by chunk.
+
+Settings: PALANTIR_COMPUTE_THREADS (default: number of CPUs).
+"""
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Pixels per block: 512 KB per float64 temporary, so a formula's working set fits in L2/L3 cache
+TILE_PIXELS = 64 * 1024
+
+_pool = None
+_lock = threading.Lock()
+
+
+def threads():
+    """Worker threads of the compute pool (PALANTIR_COMPUTE_THREADS, default: CPUs)."""
+    try:
+        return max(1, int(os.environ.get('PALANTIR_COMPUTE_THREADS', 0)) or os.cpu_count() or 1)
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+def _executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=threads(), thread_name_prefix="compute")
+        return _pool
+
+
+def row_blocks(shape, tile_pixels=TILE_PIXELS):
+    """Index expressions for the row blocks of an array of this shape (whole rows, about
+    tile_pixels pixels each). 0-d arrays are one block.
+    """
+    if not shape:
+        return [Ellipsis]
+    rows = max(1, tile_pixels // max(1, math.prod(shape[1:])))
+    return [slice(start, min(start + rows, shape[0])) for start in range(0, shape[0], rows)] or [Ellipsis]
+
+
+def run(kernel, arrays, names, dtype=np.float64, tile_pixels=TILE_PIXELS):
+    """Evaluate kernel(blocks) block by block and assemble the outputs.
+
+    arrays maps names to arrays of one shape; kernel receives the same row block of each
+    and returns {output name: block result} for every name in names. Returns
+    {name: array of dtype}. Exceptions raised by the kernel propagate.
+    """
+    shape = next(iter(arrays.values())).shape
+    outputs = {name: np.empty(shape, dtype=dtype) for name in names}
+
+    def block(rows):
+        for name, value in kernel({key: a[rows] for key, a in arrays.items()}).items():
+            outputs[name][rows] = value
+
+    blocks = row_blocks(shape, tile_pixels)
+    if len(blocks) == 1 or threads() == 1:
+        for rows in blocks:
+            block(rows)
+    else:
+        # map() re-raises the first kernel error here
+        list(_executor().map(block, blocks))
+    return outputs
@@ -0,0 +1,211 @@
+"""User-defined index expressions over Sentinel-2 band names.
+
+An expression such as ``(B08 - B05) / (B08 + B05)`` is parsed once with ``ast``,
+checked against a small whitelist (band names, numbers, + - * / **, and the
+functions in FUNCTIONS; exponents must be small number literals) and compiled into a single vectorized kernel. Kernels
+are cached by normalised expression text, so the same formula typed with
+different spacing compiles once. numexpr is used for the kernel when it is
+installed (one fused pass, multi-threaded); otherwise the kernel is evaluated
+with numpy.
+"""
+import ast
+from functools import lru_cache
+
+import numpy as np
+
+# Sentinel-2 L2A bands and their native resolution in metres
+BANDS = {
+    'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 'B06': 20,
+    'B07': 20, 'B08': 10, 'B8A': 20, 'B09': 60, 'B11': 20, 'B12': 20,
+}
+
+# Digital numbers are converted to reflectance like the built-in indices do
+REFLECTANCE_SCALE = 10000.0
+
+# name -> (numpy function, number of arguments)
+FUNCTIONS = {
+    'sqrt': (np.sqrt, 1),
+    'abs': (np.abs, 1),
+    'log': (np.log, 1),
+    'exp': (np.exp, 1),
+    'min': (np.minimum, 2),
+    'max': (np.maximum, 2),
+}
+
+# Named expressions offered next to the built-in indices
+PRESETS = {
+    'NBR': '(B08 - B12) / (B08 + B12)',
+    'NDRE': '(B08 - B05) / (B08 + B05)',
+}
+
+MAX_LENGTH = 500
+MAX_NODES = 200  # Syntax tree nodes (bands, numbers, operators, calls)
+
+# Largest |exponent| of **. Exponents are number literals: 9**9**9 would be evaluated as an
+# exact integer power and never finish
+MAX_EXPONENT = 8
+
+_SYMBOLS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.Pow: '**'}
+_OPERATORS = tuple(_SYMBOLS)
+
+
+class ExpressionError(ValueError):
+    """Raised for expressions that do not parse or use something outside the whitelist."""
+
+
+def _literal(node):
+    """Value of a number literal, optionally signed (e.g. -2), or None."""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _literal(node.operand)
+        return None if value is None else (-value if isinstance(node.op, ast.USub) else value)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    return None
+
+
+def _check(node):
+    if isinstance(node, ast.Expression):
+        _check(node.body)
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, _OPERATORS):
+            raise ExpressionError(f"Operator not allowed: {type(node.op).__name__}")
+        if isinstance(node.op, ast.Pow):
+            exponent = _literal(node.right)
+            if exponent is None or abs(exponent) > MAX_EXPONENT:
+                raise ExpressionError(f"Exponents must be numbers between -{MAX_EXPONENT} and {MAX_EXPONENT}")
+        _check(node.left)
+        _check(node.right)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, (ast.USub, ast.UAdd)):
+            raise ExpressionError(f"Operator not allowed: {type(node.op).__name__}")
+        _check(node.operand)
+    elif isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ExpressionError(f"Only numbers are allowed as constants, got {node.value!r}")
+    elif isinstance(node, ast.Name):
+        if node.id not in BANDS:
+            raise ExpressionError(f"Unknown band: {node.id} (use {', '.join(BANDS)})")
+    elif isinstance(node, ast.Call):
+        name = node.func.id if isinstance(node.func, ast.Name) else None
+        if name not in FUNCTIONS:
+            raise ExpressionError(f"Function not allowed: {name or ast.unparse(node.func)} (use {', '.join(FUNCTIONS)})")
+        if node.keywords or len(node.args) != FUNCTIONS[name][1]:
+            raise ExpressionError(f"{name}() takes {FUNCTIONS[name][1]} argument(s)")
+        for arg in node.args:
+            _check(arg)
+    else:
+        raise ExpressionError(f"Not allowed in an expression: {type(node).__name__}")
+
+
+def parse(expression):
+    """Parse and validate an expression; returns its ast.Expression tree."""
+    if not isinstance(expression, str) or not expression.strip():
+        raise ExpressionError("Expression is empty")
+    if len(expression) > MAX_LENGTH:
+        raise ExpressionError(f"Expression is longer than {MAX_LENGTH} characters")
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError(f"Invalid expression: {e.msg}") from None
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise ExpressionError(f"Expression has more than {MAX_NODES} terms")
+    _check(tree)
+    if not _band_names(tree):
+        raise ExpressionError("Expression does not use any band")
+    return tree
+
+
+def _band_names(tree):
+    return sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id in BANDS})
+
+
+def normalize(expression):
+    """Canonical text of an expression (same formula, same text regardless of spacing)."""
+    return ast.unparse(parse(expression))
+
+
+def required_bands(expression):
+    """Sorted band names used by an expression."""
+    return _band_names(parse(expression))
+
+
+class _Scale(ast.NodeTransformer):
+    """Rewrite every band name B to (B / REFLECTANCE_SCALE) so scaling is fused into the kernel."""
+
+    def visit_Call(self, node):
+        # Leave the function name alone, scale only its arguments
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Name(self, node):
+        return ast.BinOp(left=node, op=ast.Div(), right=ast.Constant(REFLECTANCE_SCALE))
+
+
+def _numexpr_source(node):
+    # numexpr has no minimum/maximum; express them with where()
+    if isinstance(node, ast.Call) and node.func.id in ('min', 'max'):
+        a, b = (_numexpr_source(arg) for arg in node.args)
+        op = '<' if node.func.id == 'min' else '>'
+        return f"where(({a}) {op} ({b}), {a}, {b})"
+    if isinstance(node, ast.Call):
+        return f"{node.func.id}({_numexpr_source(node.args[0])})"
+    if isinstance(node, ast.BinOp):
+        return f"({_numexpr_source(node.left)} {_SYMBOLS[type(node.op)]} {_numexpr_source(node.right)})"
+    if isinstance(node, ast.UnaryOp):
+        return f"({'-' if isinstance(node.op, ast.USub) else '+'}{_numexpr_source(node.operand)})"
+    return ast.unparse(node)
+
+
+class Kernel:
+    """Compiled expression: call with {band: array of digital numbers} to get a float64 index.
+    Division by zero and other invalid pixels come out as NaN.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        tree = _Scale().visit(parse(source))
+        ast.fix_missing_locations(tree)
+        self.bands = _band_names(tree)
+        self._code = compile(tree, '<expression>', 'eval')
+        self._namespace = {'__builtins__': {}, **{name: fn for name, (fn, _) in FUNCTIONS.items()}}
+        try:
+            import numexpr
+            self._numexpr = numexpr
+            self._numexpr_source = _numexpr_source(tree.body)
+        except ImportError:
+            self._numexpr = None
+
+    def __call__(self, arrays):
+        local = {band: arrays[band] for band in self.bands}
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if self._numexpr is not None:
+                # numexpr has no unsigned integer types (bands are uint16)
+                local = {band: a if a.dtype.kind == 'f' else a.astype('float32') for band, a in local.items()}
+                out = self._numexpr.evaluate(self._numexpr_source, local_dict=local)
+            else:
+                out = eval(self._code, self._namespace, local)
+            out = np.asarray(out, dtype='float64')
+            out[~np.isfinite(out)] = np.nan
+        return out
+
+
+@lru_cache(maxsize=128)
+def _compile(source):
+    return Kernel(source)
+
+
+def compile_expression(expression):
+    """Validated, compiled Kernel for an expression (cached by normalised text)."""
+    return _compile(normalize(expression))
+
+
+def probe(expression):
+    """Compile an expression and evaluate it on one pixel, so formulas that cannot be evaluated
+    are refused before any imagery is read. Returns the Kernel; raises ExpressionError.
+    """
+    kernel = compile_expression(expression)
+    try:
+        kernel({band: np.full(1, REFLECTANCE_SCALE / 10, dtype=np.uint16) for band in kernel.bands})
+    except Exception as e:
+        raise ExpressionError(f"Expression cannot be evaluated: {e}") from None
+    return kernel
@@ -0,0 +1,214 @@
+"""Append-only history of per-field, per-date index statistics.
+
+Analysis results live in the in-memory caches and the Streamlit session, so a
+trend over a field's past analyses used to mean reading the imagery again.
+Every finished single-scene (or mosaic) analysis appends one row per index
+here: field id, geometry hash, scene id and date, index and the summary
+statistics of compute_stats().
+
+Rows are Parquet files partitioned by scene month (month=YYYY-MM/*.parquet).
+Every append writes a new small file; once a month has more than
+MAX_FILES_PER_MONTH of them they are merged into one file sorted by geometry
+hash, index and date. Queries filter on the month partition (only the months
+in range are opened) and push the geometry hash, index and date predicates
+down to the Parquet row-group statistics, so a field's time series is read in
+milliseconds without touching the rest of the store.
+
+Nothing is ever updated in place: analysing the same scene again appends
+another row, and query() keeps the most recent row per (geometry, scene, index).
+
+Location: PALANTIR_HISTORY_DIR (default ~/.cache/palantir/history; empty
+disables the store). Needs pyarrow.
+"""
+import datetime
+import glob
+import os
+import threading
+import time
+import uuid
+
+DEFAULT_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'palantir', 'history')
+
+MAX_FILES_PER_MONTH = 32
+ROW_GROUP_SIZE = 4096  # Rows; small groups let the sorted geometry hash prune most of a month
+
+# compute_stats() percentiles kept per row (utils.STATS_PERCENTILES)
+PERCENTILES = (2, 5, 25, 50, 75, 95, 98)
+
+# Identity of a row; query() keeps the latest recorded_at per key
+KEY_COLUMNS = ('geometry_hash', 'item_id', 'index')
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('field_id', pa.string()),
+        ('geometry_hash', pa.string()),
+        ('item_id', pa.string()),
+        ('date', pa.date32()),
+        ('index', pa.string()),
+        ('expression', pa.string()),
+        ('count', pa.int64()),
+        ('mean', pa.float64()),
+        ('min', pa.float64()),
+        ('max', pa.float64()),
+        ('std', pa.float64()),
+        *[(f'p{q}', pa.float64()) for q in PERCENTILES],
+        ('cloud_cover', pa.float64()),
+        ('overview_level', pa.int8()),
+        ('recorded_at', pa.timestamp('ms', tz='UTC')),
+    ])
+
+
+def _month(date):
+    return f"{date.year:04d}-{date.month:02d}"
+
+
+class HistoryStore:
+    """Month-partitioned Parquet files of index statistics (see module doc)."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def append(self, rows):
+        """Append rows (dicts with the schema's columns; missing ones are null). Returns the row count."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = _schema()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(_month(row['date']), []).append({'recorded_at': now, **row})
+
+        for month, month_rows in by_month.items():
+            directory = os.path.join(self.root, f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pylist(month_rows, schema=schema)
+            name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+            # Written under a hidden name and renamed, so readers never see a partial file
+            tmp_path = os.path.join(directory, f".{name}")
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, os.path.join(directory, name))
+            if len(glob.glob(os.path.join(directory, '*.parquet'))) > MAX_FILES_PER_MONTH:
+                self.compact(month)
+        return sum(len(month_rows) for month_rows in by_month.values())
+
+    def compact(self, month):
+        """Merge the files of one month into a single file sorted by geometry hash, index and date,
+        so the row-group statistics of those columns are tight. No rows are dropped.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        directory = os.path.join(self.root, f"month={month}")
+        with self._lock:
+            paths = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+            if len(paths) < 2:
+                return
+            table = pa.concat_tables([pq.read_table(path, schema=_schema()) for path in paths])
+            table = table.sort_by([('geometry_hash', 'ascending'), ('index', 'ascending'),
+                                   ('date', 'ascending')])
+            name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+            tmp_path = os.path.join(directory, f".{name}")
+            pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE)
+            os.replace(tmp_path, os.path.join(directory, name))
+            for path in paths:
+                os.remove(path)
+
+    def query(self, geometry_hash=None, field_id=None, index=None, start=None, end=None, columns=None):
+        """Rows matching all given filters (dates inclusive) as a pandas DataFrame sorted by date,
+        with only the latest row per (geometry hash, scene, index). index may be a name or a list.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+
+        conditions = []
+        if geometry_hash is not None:
+            conditions.append(pc.field('geometry_hash') == geometry_hash)
+        if field_id is not None:
+            conditions.append(pc.field('field_id') == field_id)
+        if index is not None:
+            conditions.append(pc.field('index').isin([index] if isinstance(index, str) else list(index)))
+        # The month partition prunes whole directories; date prunes row groups within them
+        if start is not None:
+            conditions.append((pc.field('month') >= _month(start)) & (pc.field('date') >= start))
+        if end is not None:
+            conditions.append((pc.field('month') <= _month(end)) & (pc.field('date') <= end))
+        predicate = None
+        for condition in conditions:
+            predicate = condition if predicate is None else predicate & condition
+
+        schema = _schema().append(pa.field('month', pa.string()))
+        partitioning = ds.partitioning(pa.schema([schema.field('month')]), flavor='hive')
+        names = None if columns is None else list(dict.fromkeys([*KEY_COLUMNS, 'date', 'recorded_at', *columns]))
+        for attempt in range(2):
+            try:
+                dataset = ds.dataset(self.root, schema=schema, format='parquet', partitioning=partitioning)
+                table = dataset.to_table(columns=names, filter=predicate)
+                break
+            except FileNotFoundError:
+                # A concurrent compaction replaced the files between listing and reading
+                if attempt:
+                    raise
+        frame = table.to_pandas().drop(columns='month', errors='ignore')
+        if frame.empty:
+            return frame
+        frame = frame.sort_values('recorded_at').drop_duplicates(list(KEY_COLUMNS), keep='last')
+        return frame.sort_values(['date', 'index']).reset_index(drop=True)
+
+    def stats(self):
+        paths = glob.glob(os.path.join(self.root, 'month=*', '*.parquet'))
+        return {
+            'months': len({os.path.dirname(path) for path in paths}),
+            'files': len(paths),
+            'bytes': sum(os.path.getsize(path) for path in paths),
+        }
+
+
+def rows_from_result(metadata, vi_stats, geometry_hash, field_id=None, overview_level=None):
+    """History rows for an analysis result: run_analysis() metadata and {index: compute_stats()}."""
+    expressions = metadata.get('expressions') or {}
+    rows = []
+    for name, stats in vi_stats.items():
+        row = {
+            'field_id': field_id or geometry_hash[:12],
+            'geometry_hash': geometry_hash,
+            'item_id': metadata['item_id'],
+            'date': metadata['item_date'],
+            'index': name,
+            'expression': expressions.get(name),
+            'count': stats['count'],
+            'cloud_cover': metadata.get('cloud_cover'),
+            'overview_level': overview_level,
+        }
+        if stats['count']:
+            row.update({key: stats[key] for key in ('mean', 'min', 'max', 'std')})
+            row.update({f'p{q}': stats['percentiles'].get(q) for q in PERCENTILES})
+        rows.append(row)
+    return rows
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """Store configured through PALANTIR_HISTORY_DIR, or None if disabled or pyarrow is missing."""
+    global _store
+    root = os.environ.get('PALANTIR_HISTORY_DIR', DEFAULT_ROOT)
+    if not root:
+        return None
+    with _store_lock:
+        if _store is None or _store.root != root:
+            try:
+                import pyarrow  # noqa: F401
+                _store = HistoryStore(root)
+            except (ImportError, OSError) as e:
+                print(f"History store disabled: {e}")
+                return None
+        return _store
@@ -0,0 +1,164 @@
+"""Background job queue for analyses.
+
+Analyses run on a bounded, process-wide worker pool instead of the Streamlit
+script thread. Each job has an id, a list of progress events and a cancel flag;
+the worker function receives ``progress(stage, message, fraction)`` and the job
+is cancelled cooperatively the next time it reports progress.
+
+Limits per server process: PALANTIR_MAX_JOBS concurrent jobs (default 2) and
+PALANTIR_MAX_QUEUED jobs waiting or running (default 8).
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Finished jobs are forgotten after this many seconds
+JOB_TTL_SECONDS = 15 * 60
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+
+class QueueFull(RuntimeError):
+    """Raised by submit() when the server already has too many jobs in flight."""
+
+
+class Job:
+    """State of one submitted job. Updated by the worker, read by the UI."""
+
+    def __init__(self, label):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.state = QUEUED
+        self.events = []
+        self.progress = 0.0
+        self.result = None
+        self.partial = None
+        self.error = None
+        self.exception = None
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+        self._future = None
+
+    @property
+    def done(self):
+        return self.state in FINISHED_STATES
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def report(self, stage, message, fraction=None, partial=None):
+        """Record a progress event; raises JobCancelled if the job was cancelled.
+        partial publishes an intermediate result (e.g. a preview) before the job finishes.
+        """
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+        if fraction is not None:
+            self.progress = max(0.0, min(1.0, float(fraction)))
+        if partial is not None:
+            self.partial = partial
+        self.events.append({'time': time.time(), 'stage': stage, 'message': message, 'progress': self.progress})
+
+    def wait(self, timeout=None):
+        """Block until the job has finished; returns False if timeout (seconds) ran out first."""
+        futures.wait([self._future], timeout=timeout)
+        return self.done
+
+    def cancel(self):
+        self._cancel.set()
+        # Jobs that have not started yet are dropped from the pool directly
+        if self._future is not None and self._future.cancel():
+            self.state = CANCELLED
+            self.finished = time.time()
+
+
+class JobManager:
+    """Bounded worker pool with a registry of jobs by id."""
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, label="Analysis", **kwargs):
+        """Queue fn(*args, progress=job.report, **kwargs) and return its Job.
+        Raises QueueFull when max_pending jobs are already queued or running.
+        """
+        with self._lock:
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if not job.done)
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} analyses are already queued or running on this server")
+            job = Job(label)
+            self._jobs[job.id] = job
+            job._future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_requested:
+            job.state = CANCELLED
+            job.finished = time.time()
+            return
+        job.state = RUNNING
+        try:
+            job.result = fn(*args, progress=job.report, **kwargs)
+            job.state = DONE
+        except JobCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            job.exception = e
+            job.state = FAILED
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def stats(self):
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+        return {state: states.count(state) for state in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+
+    def _prune(self):
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.done and j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+
+def _int_from_env(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+# Single pool per server process, shared by all sessions
+manager = JobManager(
+    max_workers=_int_from_env('PALANTIR_MAX_JOBS', 2),
+    max_pending=_int_from_env('PALANTIR_MAX_QUEUED', 8),
+)
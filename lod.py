@@ -0,0 +1,83 @@
+"""Level-of-detail versions of AOI geometries for display.
+
+Boundaries imported from KML can have tens of thousands of vertices, and
+every Streamlit rerun used to serialize all of them into the folium map,
+draw them point by point in the boundary plot and print them as WKT in the
+coordinates text area. simplified() instead returns the most detailed version
+of a geometry that fits a vertex budget. Versions are simplified at
+increasing tolerances (LEVELS, fractions of the bbox diagonal; each from the
+previous one, with topology preserved) only as far as a budget needs, and are
+kept in the shared cache under the geometry hash, so later reruns reuse them.
+
+Display only: clipping, areas, read windows and result keys always use the
+exact geometry.
+"""
+import cache
+import utils
+
+# Simplification tolerances as fractions of the bbox diagonal, finest first
+LEVELS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+# Vertex budgets of the display paths
+MAP_MAX_VERTICES = 5000
+PLOT_MAX_VERTICES = 2000  # The 6-inch boundary plot is ~600 px wide
+TEXT_MAX_VERTICES = 1000
+
+WKT_DECIMALS = 7  # ~1 cm, the precision geometry_hash() rounds to
+
+_BYTES_PER_VERTEX = 16
+
+
+def simplified(geometry, max_vertices):
+    """(shapely geometry, its vertex count, exact vertex count) for a GeoJSON geometry:
+    the exact geometry if it fits max_vertices, otherwise the finest level that does
+    (or the coarsest level).
+    """
+    import shapely
+    from shapely.geometry import shape
+
+    key = cache.make_key('lod', utils.geometry_hash(geometry))
+    levels = cache.shared.get(key)
+    if levels is None:
+        exact = shape(geometry)
+        levels = [(exact, shapely.get_num_coordinates(exact))]
+    exact_vertices = levels[0][1]
+
+    for geom, vertices in levels:
+        if vertices <= max_vertices:
+            return geom, vertices, exact_vertices
+
+    levels = list(levels)  # The cached list may be read by other sessions meanwhile
+    minx, miny, maxx, maxy = levels[0][0].bounds
+    diagonal = ((maxx - minx) ** 2 + (maxy - miny) ** 2) ** 0.5
+    for fraction in LEVELS[len(levels) - 1:]:
+        if diagonal == 0:
+            break
+        geom = shapely.simplify(levels[-1][0], fraction * diagonal, preserve_topology=True)
+        levels.append((geom, shapely.get_num_coordinates(geom)))
+        if levels[-1][1] <= max_vertices:
+            break
+    cache.shared.put(key, levels, nbytes=sum(vertices for _, vertices in levels) * _BYTES_PER_VERTEX)
+    return levels[-1][0], levels[-1][1], exact_vertices
+
+
+def to_geojson(geometry, max_vertices=MAP_MAX_VERTICES):
+    """GeoJSON geometry for the folium map."""
+    from shapely.geometry import mapping
+
+    geom, vertices, exact_vertices = simplified(geometry, max_vertices)
+    return geometry if vertices == exact_vertices else mapping(geom)
+
+
+def rings(geometry, max_vertices=PLOT_MAX_VERTICES):
+    """Exterior ring coordinates of each part, for the boundary plot."""
+    geom = simplified(geometry, max_vertices)[0]
+    return [list(part.exterior.coords) for part in getattr(geom, 'geoms', [geom])]
+
+
+def to_wkt(geometry, max_vertices=TEXT_MAX_VERTICES):
+    """(WKT text, vertices shown, exact vertices) for the coordinates text area."""
+    import shapely
+
+    geom, vertices, exact_vertices = simplified(geometry, max_vertices)
+    return shapely.to_wkt(geom, rounding_precision=WKT_DECIMALS), vertices, exact_vertices
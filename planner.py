@@ -0,0 +1,224 @@
+"""Pre-flight cost estimates and resolution planning.
+
+Before anything is searched or read, the AOI bounding box and the native
+resolution of each band give the number of pixels a run will read, roughly how
+many bytes that is over the network, and the peak memory of the in-memory
+pipeline (raw bands, index, clip and the per-tile temporaries of compute.py). plan()
+compares these with the configured budgets and picks how to run:
+
+- 'full':      full resolution, everything in memory (the normal path)
+- 'chunked':   full resolution, bands read and the index computed chunk by chunk
+               with dask; only the float32 index is held in memory
+- 'overview':  the finest COG overview level that fits the budgets
+- 'too_large': nothing fits; the run is refused before any I/O
+
+Multi-part AOIs whose parts are read as separate windows (utils.read_windows)
+transfer only the bytes of those windows; the in-memory grid is still the bbox.
+
+Budgets: PALANTIR_MEMORY_BUDGET_MB (default 2048) for peak memory and
+PALANTIR_TRANSFER_BUDGET_MB (default 2048) for bytes read per run. The result
+(arrays kept for display and downloads) must also fit the shared cache
+(PALANTIR_CACHE_MB, see cache.py), or it could not be kept after the run.
+"""
+import math
+import os
+
+import cache
+import compute
+import expressions
+
+FULL = 'full'
+CHUNKED = 'chunked'
+OVERVIEW = 'overview'
+TOO_LARGE = 'too_large'
+
+DEFAULT_MEMORY_BUDGET_MB = 2048
+DEFAULT_TRANSFER_BUDGET_MB = 2048
+
+# Sentinel-2 COGs have overviews at 1/2 ... 1/32 of full resolution (levels 0-4)
+MAX_OVERVIEW_LEVEL = 4
+
+# Native resolution (m) and sample size (bytes) of the assets load_bands() reads
+BAND_RESOLUTION = {**expressions.BANDS, 'SCL': 20}
+BAND_BYTES = {'SCL': 1}
+DEFAULT_BAND_BYTES = 2  # uint16 digital numbers
+
+# Deflate-compressed COG bytes per raw byte (approximate, for transfer estimates)
+COMPRESSION_RATIO = 0.6
+
+# Whole-array formulas (chunks of the chunked path), bytes per pixel: float64 reflectance copy
+# of each band (raw bands count separately) ...
+FULL_BYTES_PER_BAND_PIXEL = 8
+# ... and per index pixel: float64 result, clipped copy and formula temporaries
+FULL_BYTES_PER_INDEX_PIXEL = 32
+# In-memory path (tiled, compute.py), per index pixel: float64 result and clipped copy;
+# reflectance and temporaries only exist for the tiles in flight, TILE_BYTES_PER_PIXEL each
+TILED_BYTES_PER_INDEX_PIXEL = 16
+TILE_BYTES_PER_PIXEL = 128
+# Chunked path keeps float32 chunk results and the assembled float32 index,
+# plus the clip mask and the float64 copy made by compute_stats
+CHUNKED_BYTES_PER_INDEX_PIXEL = 9
+CHUNKED_BYTES_PER_PIXEL = 9
+# Cached result per index pixel: the clipped float64 index (the raw bands are kept as well),
+# or the float32 index of the chunked path
+RESULT_BYTES_PER_INDEX_PIXEL = 8
+CHUNKED_RESULT_BYTES_PER_INDEX_PIXEL = 4
+
+# Chunk edge length (pixels) of the chunked path and the number of chunks in flight
+CHUNK_SIZE = 2048
+CHUNK_WORKERS = 4
+
+METERS_PER_DEGREE = 111320.0
+
+
+def _budget_from_env(name, default_mb):
+    try:
+        return int(float(os.environ.get(name, default_mb)) * 1024 * 1024)
+    except ValueError:
+        return default_mb * 1024 * 1024
+
+
+def memory_budget():
+    return _budget_from_env('PALANTIR_MEMORY_BUDGET_MB', DEFAULT_MEMORY_BUDGET_MB)
+
+
+def transfer_budget():
+    return _budget_from_env('PALANTIR_TRANSFER_BUDGET_MB', DEFAULT_TRANSFER_BUDGET_MB)
+
+
+def bbox_size_m(bbox):
+    """Approximate (width, height) of a lon/lat bbox in metres (no projection needed)."""
+    minx, miny, maxx, maxy = bbox
+    mid_lat = math.radians((miny + maxy) / 2)
+    return (maxx - minx) * METERS_PER_DEGREE * math.cos(mid_lat), (maxy - miny) * METERS_PER_DEGREE
+
+
+def estimate(bbox, bands, n_indices=1, scenes=1, overview_level=None, extra_bytes_per_pixel=0, windows=None,
+             result_bytes_per_pixel=None):
+    """Pixel, transfer, peak-memory and cached-result estimates for reading bands (plus SCL) over bbox.
+    scenes scales the estimates for runs that hold several scenes at once (change detection,
+    composites); extra_bytes_per_pixel adds per-output-pixel state (e.g. composite reducers).
+    result_bytes_per_pixel sizes results other than indices plus raw bands (run_analysis).
+    windows (lon/lat boxes, see utils.read_windows) limits the bytes read to those boxes;
+    memory is still that of the whole bbox grid. 'envelope_transfer_bytes' is the transfer
+    for reading all of bbox (the chunked path).
+    """
+    width_m, height_m = bbox_size_m(bbox)
+    read_fraction = 1.0
+    if windows and width_m * height_m > 0:
+        read_fraction = min(1.0, sum(w * h for w, h in map(bbox_size_m, windows)) / (width_m * height_m))
+    scale = 1 if overview_level is None else 2 ** (overview_level + 1)
+
+    band_pixels = {}
+    for band in dict.fromkeys(list(bands) + ['SCL']):
+        resolution = BAND_RESOLUTION.get(band, 10) * scale
+        band_pixels[band] = math.ceil(width_m / resolution) * math.ceil(height_m / resolution)
+    # Indices come out on the grid of the finest band they use
+    pixels = max(band_pixels[band] for band in bands) if bands else band_pixels['SCL']
+
+    raw_bytes = sum(n * BAND_BYTES.get(band, DEFAULT_BAND_BYTES) for band, n in band_pixels.items())
+    # Coarser bands an index uses are resampled onto its grid before the tiled pass
+    aligned_bytes = sum(pixels * BAND_BYTES.get(band, DEFAULT_BAND_BYTES)
+                        for band in bands if band_pixels[band] < pixels)
+    tile_bytes = min(pixels, compute.TILE_PIXELS * compute.threads()) * TILE_BYTES_PER_PIXEL
+    full_peak = scenes * (
+        raw_bytes + aligned_bytes + tile_bytes
+        + pixels * n_indices * TILED_BYTES_PER_INDEX_PIXEL
+    ) + pixels * extra_bytes_per_pixel
+    chunk_pixels = min(pixels, CHUNK_SIZE * CHUNK_SIZE * CHUNK_WORKERS)
+    chunked_peak = scenes * (
+        pixels * (n_indices * CHUNKED_BYTES_PER_INDEX_PIXEL + CHUNKED_BYTES_PER_PIXEL)
+        + chunk_pixels * (len(band_pixels) * (DEFAULT_BAND_BYTES + FULL_BYTES_PER_BAND_PIXEL)
+                          + n_indices * FULL_BYTES_PER_INDEX_PIXEL)
+    ) + pixels * extra_bytes_per_pixel
+    if result_bytes_per_pixel is None:
+        result_bytes = raw_bytes + pixels * n_indices * RESULT_BYTES_PER_INDEX_PIXEL
+    else:
+        result_bytes = pixels * result_bytes_per_pixel
+    return {
+        'overview_level': overview_level,
+        'width_m': width_m,
+        'height_m': height_m,
+        'pixels': pixels,
+        'band_pixels': band_pixels,
+        'read_fraction': read_fraction,
+        'transfer_bytes': int(scenes * raw_bytes * COMPRESSION_RATIO * read_fraction),
+        'envelope_transfer_bytes': int(scenes * raw_bytes * COMPRESSION_RATIO),
+        'peak_bytes': int(full_peak),
+        'chunked_peak_bytes': int(chunked_peak),
+        'result_bytes': int(result_bytes),
+        'chunked_result_bytes': int(pixels * n_indices * CHUNKED_RESULT_BYTES_PER_INDEX_PIXEL),
+    }
+
+
+def plan(bbox, bands, n_indices=1, scenes=1, extra_bytes_per_pixel=0, allow_chunked=True,
+         memory_budget_bytes=None, transfer_budget_bytes=None, windows=None, result_bytes_per_pixel=None,
+         result_budget_bytes=None):
+    """Choose full resolution, the chunked path or an overview level for a run (see module doc).
+    Returns the chosen estimate with 'mode', 'reason', the budgets and the native-resolution
+    estimate under 'native'. allow_chunked=False for pipelines without a chunked path.
+    windows are the per-part read windows of a multi-part AOI (see estimate()).
+    result_budget_bytes defaults to the size of the shared cache.
+    """
+    memory_limit = memory_budget() if memory_budget_bytes is None else memory_budget_bytes
+    transfer_limit = transfer_budget() if transfer_budget_bytes is None else transfer_budget_bytes
+    result_limit = cache.shared.max_bytes if result_budget_bytes is None else result_budget_bytes
+    native = estimate(bbox, bands, n_indices, scenes, extra_bytes_per_pixel=extra_bytes_per_pixel, windows=windows,
+                      result_bytes_per_pixel=result_bytes_per_pixel)
+
+    def decide(mode, chosen, reason):
+        return {**chosen, 'mode': mode, 'reason': reason, 'native': native,
+                'memory_budget': memory_limit, 'transfer_budget': transfer_limit, 'result_budget': result_limit}
+
+    fits_transfer = native['transfer_bytes'] <= transfer_limit
+    fits_memory = native['peak_bytes'] <= memory_limit
+    if fits_transfer and fits_memory and native['result_bytes'] <= result_limit:
+        return decide(FULL, native, "fits the memory, transfer and cache budgets")
+    in_memory_over = (f"in-memory peak {format_bytes(native['peak_bytes'])} exceeds the "
+                      f"{format_bytes(memory_limit)} memory budget" if not fits_memory else
+                      f"the {format_bytes(native['result_bytes'])} result exceeds the "
+                      f"{format_bytes(result_limit)} cache budget")
+    # The chunked path reads the whole envelope
+    if (allow_chunked and native['envelope_transfer_bytes'] <= transfer_limit
+            and native['chunked_peak_bytes'] <= memory_limit and native['chunked_result_bytes'] <= result_limit):
+        return decide(CHUNKED, {**native, 'peak_bytes': native['chunked_peak_bytes'],
+                                'transfer_bytes': native['envelope_transfer_bytes'],
+                                'result_bytes': native['chunked_result_bytes']},
+                      in_memory_over)
+
+    over = (f"{format_bytes(native['transfer_bytes'])} to read exceeds the {format_bytes(transfer_limit)} "
+            f"transfer budget" if not fits_transfer else
+            f"peak memory {format_bytes(native['peak_bytes'])} exceeds the {format_bytes(memory_limit)} budget"
+            if not fits_memory else in_memory_over)
+    for level in range(MAX_OVERVIEW_LEVEL + 1):
+        coarse = estimate(bbox, bands, n_indices, scenes, overview_level=level,
+                          extra_bytes_per_pixel=extra_bytes_per_pixel, windows=windows,
+                          result_bytes_per_pixel=result_bytes_per_pixel)
+        if (coarse['transfer_bytes'] <= transfer_limit and coarse['peak_bytes'] <= memory_limit
+                and coarse['result_bytes'] <= result_limit):
+            return decide(OVERVIEW, coarse, over)
+    return decide(TOO_LARGE, native, over)
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def describe(p):
+    """One-line summary of a plan for progress messages and the UI."""
+    size = (f"{p['native']['pixels'] / 1e6:.1f} M pixels, ~{format_bytes(p['native']['transfer_bytes'])} to read, "
+            f"~{format_bytes(p['native']['peak_bytes'])} peak memory at full resolution")
+    if p['mode'] == FULL:
+        return f"Full resolution ({size})"
+    if p['mode'] == CHUNKED:
+        return f"Full resolution, chunked ({size}; chunked peak ~{format_bytes(p['peak_bytes'])})"
+    if p['mode'] == OVERVIEW:
+        factor = 2 ** (p['overview_level'] + 1)
+        return (f"Reduced resolution: overview 1/{factor} ({size}; {p['reason']}; "
+                f"~{format_bytes(p['transfer_bytes'])} to read, ~{format_bytes(p['peak_bytes'])} peak)")
+    return (f"Area too large ({size}; {p['reason']} even at the coarsest overview). "
+            f"Draw a smaller area or raise PALANTIR_MEMORY_BUDGET_MB / PALANTIR_TRANSFER_BUDGET_MB / "
+            f"PALANTIR_CACHE_MB.")
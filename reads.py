@@ -0,0 +1,264 @@
+"""Deadlines, retries and hedged requests for remote raster reads.
+
+Band windows are read with rioxarray/GDAL as HTTP range requests to blob
+storage, and one stalled response holds up the whole analysis. Reader.call()
+wraps such a read:
+
+Reads are calls fn(href, ...). Duplicates and retries of a remote href get a
+distinct URL (an extra query parameter), because GDAL shares in-flight
+downloads and cached failures between handles of the same URL: a duplicate of
+the same URL would wait for the stalled request it is meant to overtake.
+
+- deadline: the read fails with ReadTimeout when no attempt has succeeded in
+  time (a stalled attempt is abandoned; GDAL_HTTP_TIMEOUT ends it eventually)
+- hedging: when an attempt is still running after the HEDGE_PERCENTILE latency
+  of recent reads, a duplicate is started and whichever finishes first wins
+- retries: transient failures (timeouts, dropped connections, 5xx responses)
+  are retried with exponential backoff and full jitter
+
+The latency of every successful attempt goes into a histogram (stats(), also
+served by the API's /stats endpoint).
+
+Settings: PALANTIR_READ_DEADLINE_S (default 120), PALANTIR_READ_RETRIES
+(default 2) and PALANTIR_READ_HEDGE_PERCENTILE (default 95, 0 disables hedging).
+"""
+import bisect
+import collections
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import signing
+
+DEFAULT_DEADLINE_SECONDS = 120
+DEFAULT_RETRIES = 2
+DEFAULT_HEDGE_PERCENTILE = 95
+
+# Hedge on the recent latency percentile once this many reads were timed, before that after
+# FALLBACK_HEDGE_SECONDS; never sooner than MIN_HEDGE_SECONDS (cache hits would double every read)
+MIN_HEDGE_SAMPLES = 20
+FALLBACK_HEDGE_SECONDS = 5.0
+MIN_HEDGE_SECONDS = 0.05
+MAX_HEDGES = 1
+
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_MAX_SECONDS = 5.0
+
+# Attempts of all reads in the process (bands x AOI parts x jobs, plus hedges)
+MAX_ATTEMPT_WORKERS = 64
+
+# Histogram buckets (upper bounds): 1 ms to ~4 min, four per doubling
+BUCKETS = tuple(0.001 * 2 ** (i / 4) for i in range(72))
+RECENT_SAMPLES = 1000
+
+# Failures that retrying cannot fix (auth errors are re-signed by the caller, see signing.py).
+# Not "not recognized as being in a supported format": GDAL also reports a 5xx on open that way
+_PERMANENT_STATUSES = (404,)
+_PERMANENT_MARKERS = ('Not Found', 'No such file', 'does not exist')
+_TRANSIENT_STATUSES = (500, 502, 503, 504)
+_TRANSIENT_MARKERS = ('timed out', 'Timeout', 'Connection', 'reset by peer')
+
+
+class ReadTimeout(TimeoutError):
+    """Raised when no attempt of a read finished before its deadline."""
+
+
+def is_remote(href):
+    return href.startswith(('http://', 'https://', '/vsicurl/'))
+
+
+def attempt_href(href, attempt):
+    """href for the attempt-th attempt of a read (0: href itself). Later attempts of remote
+    hrefs get a distinct query parameter (see module doc); storage ignores it.
+    """
+    if attempt == 0 or not is_remote(href):
+        return href
+    return f"{href}{'&' if '?' in href else '?'}attempt={attempt}"
+
+
+def is_transient(exc):
+    """True for read failures worth retrying (timeouts, connection errors, 5xx)."""
+    # Without the href: its dates (e.g. 20240403) would read as status codes
+    message = signing.error_text(exc)
+    if isinstance(exc, ReadTimeout) or signing.is_auth_error(exc):
+        return False
+    if signing.http_status(exc, *_PERMANENT_STATUSES) or any(marker in message for marker in _PERMANENT_MARKERS):
+        return False
+    # rasterio's RasterioIOError is an OSError
+    if isinstance(exc, (TimeoutError, ConnectionError, OSError)):
+        return True
+    return signing.http_status(exc, *_TRANSIENT_STATUSES) or any(marker in message for marker in _TRANSIENT_MARKERS)
+
+
+class LatencyHistogram:
+    """Read latencies: cumulative log-spaced buckets for reporting, and the most recent
+    samples for the percentile that triggers hedging.
+    """
+
+    def __init__(self, buckets=BUCKETS, recent=RECENT_SAMPLES):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot: slower than the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self._recent = collections.deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+            self._recent.append(seconds)
+
+    def percentile(self, q, min_samples=1):
+        """q-th percentile (seconds) of the recent samples, or None with fewer than min_samples."""
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def snapshot(self):
+        """Counts per bucket (upper bound in ms, empty buckets omitted) and recent p50/p90/p99."""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        labels = [f"{b * 1000:.4g}" for b in self.buckets] + ['+Inf']
+        recent = {f"p{q}_ms": self.percentile(q) for q in (50, 90, 99)}
+        return {
+            'count': count,
+            'mean_ms': total / count * 1000 if count else None,
+            **{name: None if v is None else v * 1000 for name, v in recent.items()},
+            'buckets_ms': {label: n for label, n in zip(labels, counts) if n},
+        }
+
+
+class Reader:
+    """Runs reads with a deadline, hedged duplicate attempts and jittered retries (see module doc)."""
+
+    def __init__(self, deadline=DEFAULT_DEADLINE_SECONDS, retries=DEFAULT_RETRIES,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE, max_workers=MAX_ATTEMPT_WORKERS):
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+        self.max_workers = max_workers
+        self.latency = LatencyHistogram()
+        self.counters = dict.fromkeys(('reads', 'attempts', 'hedges', 'hedge_wins', 'retries', 'timeouts',
+                                       'failures'), 0)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="read")
+            return self._pool
+
+    def hedge_delay(self):
+        """Seconds after which a duplicate attempt is started, or None if hedging is off."""
+        if not self.hedge_percentile:
+            return None
+        threshold = self.latency.percentile(self.hedge_percentile, MIN_HEDGE_SAMPLES)
+        return max(MIN_HEDGE_SECONDS, FALLBACK_HEDGE_SECONDS if threshold is None else threshold)
+
+    def _attempt(self, fn, href, args, kwargs, timeout):
+        import rasterio
+
+        self._count('attempts')
+        started = time.perf_counter()
+        # Stalled HTTP requests give up at the deadline instead of holding a worker forever
+        with rasterio.Env(GDAL_HTTP_TIMEOUT=max(1, math.ceil(timeout))):
+            result = fn(href, *args, **kwargs)
+        self.latency.record(time.perf_counter() - started)
+        return result
+
+    def _hedged(self, fn, href, args, kwargs, end, attempts):
+        pool = self._executor()
+        started = time.monotonic()
+        primary = pool.submit(self._attempt, fn, attempt_href(href, next(attempts)), args, kwargs, end - started)
+        pending = {primary}
+        # Local files do not stall the way blob storage does
+        delay = self.hedge_delay() if is_remote(href) else None
+        hedge_at = None if delay is None else started + delay
+        hedges = 0
+        error = None
+
+        while pending:
+            wake = end if hedge_at is None else min(end, hedge_at)
+            done, pending = wait(pending, timeout=max(0.0, wake - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is not primary:
+                        self._count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+
+            now = time.monotonic()
+            if pending and now >= end:
+                for other in pending:
+                    other.cancel()
+                raise ReadTimeout()
+            if pending and hedge_at is not None and now >= hedge_at:
+                pending.add(pool.submit(self._attempt, fn, attempt_href(href, next(attempts)), args, kwargs,
+                                        end - now))
+                self._count('hedges')
+                hedges += 1
+                hedge_at = None if hedges >= MAX_HEDGES else now + delay
+        raise error
+
+    def call(self, fn, href, *args, deadline=None, **kwargs):
+        """fn(href, *args, **kwargs) with a deadline (seconds), hedging and retries.
+        Raises ReadTimeout when the deadline passes, or the last error of fn.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        end = time.monotonic() + deadline
+        self._count('reads')
+        attempts = itertools.count()
+        attempt = 0
+        while True:
+            try:
+                return self._hedged(fn, href, args, kwargs, end, attempts)
+            except ReadTimeout:
+                self._count('timeouts')
+                raise ReadTimeout(f"Read did not finish within {deadline:g} s") from None
+            except Exception as e:
+                remaining = end - time.monotonic()
+                if attempt >= self.retries or remaining <= 0 or not is_transient(e):
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                # Full jitter: concurrent reads that failed together do not retry together
+                time.sleep(min(remaining, random.uniform(0, min(BACKOFF_MAX_SECONDS,
+                                                                 BACKOFF_BASE_SECONDS * 2 ** attempt))))
+                attempt += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        delay = self.hedge_delay()
+        return {**counters, 'hedge_delay_ms': None if delay is None else delay * 1000,
+                'latency': self.latency.snapshot()}
+
+
+def _number_from_env(name, default, cast=float):
+    try:
+        return max(0, cast(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+# Single reader per process, shared by all sessions and jobs
+reader = Reader(
+    deadline=_number_from_env('PALANTIR_READ_DEADLINE_S', DEFAULT_DEADLINE_SECONDS) or DEFAULT_DEADLINE_SECONDS,
+    retries=_number_from_env('PALANTIR_READ_RETRIES', DEFAULT_RETRIES, int),
+    hedge_percentile=_number_from_env('PALANTIR_READ_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE),
+)
@@ -0,0 +1,96 @@
+"""SAS token signing for Planetary Computer blob storage assets.
+
+Instead of signing every item of every search result, one SAS token per
+collection is fetched and cached until shortly before it expires. Only the
+asset hrefs that are actually read get the token appended, and readers call
+``tokens.invalidate()`` and re-sign once when storage answers 403.
+"""
+import json
+import os
+import re
+import threading
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+TOKEN_URL = "https://planetarycomputer.microsoft.com/api/sas/v1/token/{collection}"
+
+# Refresh tokens this long before they expire so reads never start with a stale one
+REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def is_blob_href(href):
+    """True for Azure blob storage URLs (the only hrefs that need a SAS token)."""
+    return urlparse(href).netloc.endswith('.blob.core.windows.net')
+
+
+_URL = re.compile(r'(?:/vsicurl/|https?://)\S+')
+
+
+def error_text(exc):
+    """Message of a read error with URLs removed: Sentinel-2 hrefs are full of dates and
+    timestamps (e.g. 20240403T033529) that would otherwise look like HTTP status codes.
+    """
+    return _URL.sub('<url>', str(exc))
+
+
+def http_status(exc, *statuses):
+    """True if exc reports one of the HTTP statuses, as an attribute (urllib's HTTPError) or in
+    its message outside any URL (GDAL/rasterio errors).
+    """
+    status = getattr(exc, 'status', None) or getattr(exc, 'code', None)
+    if isinstance(status, int):
+        return status in statuses
+    message = error_text(exc)
+    return any(re.search(rf'\b{status}\b', message) for status in statuses)
+
+
+def is_auth_error(exc):
+    """True if a read failed because the SAS token was rejected or expired."""
+    message = error_text(exc)
+    return http_status(exc, 403) or 'Forbidden' in message or 'AuthenticationFailed' in message
+
+
+class TokenCache:
+    """Collection-level SAS tokens cached until shortly before expiry."""
+
+    def __init__(self):
+        self._tokens = {}  # collection -> (token, expiry)
+        self._lock = threading.Lock()
+
+    def get(self, collection):
+        with self._lock:
+            cached = self._tokens.get(collection)
+            if cached is not None and cached[1] - REFRESH_MARGIN > datetime.now(timezone.utc):
+                return cached[0]
+            # Fetch under the lock so concurrent readers share a single token request
+            token, expiry = self._fetch(collection)
+            self._tokens[collection] = (token, expiry)
+            return token
+
+    def invalidate(self, collection):
+        with self._lock:
+            self._tokens.pop(collection, None)
+
+    def _fetch(self, collection):
+        request = urllib.request.Request(TOKEN_URL.format(collection=collection))
+        subscription_key = os.environ.get('PC_SDK_SUBSCRIPTION_KEY')
+        if subscription_key:
+            request.add_header('Ocp-Apim-Subscription-Key', subscription_key)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            payload = json.load(response)
+        expiry = datetime.fromisoformat(payload['msft:expiry'].replace('Z', '+00:00'))
+        return payload['token'], expiry
+
+
+# Shared by all sessions in this process
+tokens = TokenCache()
+
+
+def sign_href(href, collection):
+    """Return href with the collection's SAS token; non-blob hrefs (e.g. local mirror paths)
+    are returned unchanged. Any existing query string (an older token) is replaced.
+    """
+    if not is_blob_href(href):
+        return href
+    return f"{href.split('?', 1)[0]}?{tokens.get(collection)}"
@@ -0,0 +1,31 @@
+import pytest
+
+import api
+
+BODY = {
+    'geometry': {'type': 'Polygon', 'coordinates': [[[100.0, 13.0], [100.01, 13.0], [100.01, 13.01],
+                                                     [100.0, 13.01], [100.0, 13.0]]]},
+    'date': '2025-01-31',
+}
+
+
+@pytest.mark.parametrize('expression', ['B08 * 9**9**9**9', 'B08' + ' + B04' * 100, 42])
+def test_unbounded_expressions_are_refused(expression):
+    with pytest.raises(api.BadRequest):
+        api.parse_request({**BODY, 'expressions': {'X': expression}})
+
+
+def test_custom_expression_is_accepted():
+    _, _, _, indices, custom, bands, _, _ = api.parse_request({**BODY, 'expressions': {'X': 'B08 / B04'}})
+    assert indices == ['X'] and bands == ['B04', 'B08']
+
+
+@pytest.mark.parametrize('indices', [['NDVI', ['x']], [{'a': 1}], ['NDVI', 3], 'NDVI', []])
+def test_index_names_must_be_a_list_of_strings(indices):
+    with pytest.raises(api.BadRequest):
+        api.parse_request({**BODY, 'indices': indices})
+
+
+def test_unknown_index_is_a_bad_request():
+    with pytest.raises(api.BadRequest, match='NOPE'):
+        api.parse_request({**BODY, 'indices': ['NDVI', 'NOPE']})
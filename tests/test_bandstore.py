@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+import rioxarray  # noqa: F401
+import xarray as xr
+
+import bandstore
+
+
+def _window(value, size=10):
+    da = xr.DataArray(np.full((size, size), value, dtype=np.uint16), dims=('y', 'x'),
+                      coords={'y': np.arange(size) * -10.0, 'x': np.arange(size) * 10.0},
+                      attrs={'scale_factor': np.float64(0.0001), 'nodata': 0})
+    return da.rio.write_crs('EPSG:32647')
+
+
+def test_window_round_trips_as_a_read_only_memmap(tmp_path):
+    store = bandstore.BandStore(str(tmp_path), max_bytes=10_000)
+    assert store.put('ab12', _window(7), 'S2_ITEM', 'B04', [100.0, 14.0, 100.1, 14.1])
+
+    da = store.get('ab12')
+    assert isinstance(da.data, np.memmap) and not da.data.flags.writeable
+    assert (da.values == 7).all() and da.rio.crs.to_epsg() == 32647
+    assert da.attrs == {'scale_factor': 0.0001, 'nodata': 0}
+    np.testing.assert_array_equal(da.x.values, _window(7).x.values)
+    assert store.get('missing') is None
+    assert not [name for name in os.listdir(tmp_path / 'ab') if name.endswith('.part')]
+
+
+def test_least_recently_used_windows_are_evicted(tmp_path):
+    store = bandstore.BandStore(str(tmp_path), max_bytes=500)  # two 200-byte windows
+    store.put('aa01', _window(1), 'S2_ITEM', 'B04', [0, 0, 1, 1])
+    store.put('bb02', _window(2), 'S2_ITEM', 'B08', [0, 0, 1, 1])
+    store.get('aa01')  # 'bb02' is now the least recently used
+    store.put('cc03', _window(3), 'S2_ITEM', 'SCL', [0, 0, 1, 1])
+
+    assert 'bb02' not in store and 'aa01' in store and 'cc03' in store
+    assert not os.path.exists(store._path('bb02'))
+    assert store.stats() == {'windows': 2, 'bytes': 400, 'max_bytes': 500}
+
+
+def test_window_whose_file_cannot_be_removed_stays_indexed(tmp_path, monkeypatch):
+    store = bandstore.BandStore(str(tmp_path), max_bytes=500)
+    store.put('aa01', _window(1), 'S2_ITEM', 'B04', [0, 0, 1, 1])
+    store.put('bb02', _window(2), 'S2_ITEM', 'B08', [0, 0, 1, 1])
+
+    def locked(path):
+        raise PermissionError(13, 'The process cannot access the file', path)
+
+    monkeypatch.setattr(bandstore.os, 'remove', locked)
+    store.put('cc03', _window(3), 'S2_ITEM', 'SCL', [0, 0, 1, 1])
+    assert all(key in store for key in ('aa01', 'bb02', 'cc03'))
+    assert store.stats()['bytes'] == 600
+
+
+@pytest.mark.parametrize('env, enabled', [
+    ({}, False),
+    ({'PALANTIR_BAND_STORE_MB': '64'}, True),
+    ({'PALANTIR_BAND_STORE_MB': '0'}, False),
+    ({'PALANTIR_BAND_STORE': 'bands'}, True),
+])
+def test_store_is_opt_in(tmp_path, monkeypatch, env, enabled):
+    monkeypatch.delenv('PALANTIR_BAND_STORE', raising=False)
+    monkeypatch.delenv('PALANTIR_BAND_STORE_MB', raising=False)
+    monkeypatch.setattr(bandstore, 'DEFAULT_ROOT', str(tmp_path / 'default'))
+    monkeypatch.setattr(bandstore, '_store', None)
+    for name, value in env.items():
+        monkeypatch.setenv(name, str(tmp_path / value) if name == 'PALANTIR_BAND_STORE' else value)
+    assert (bandstore.get_band_store() is not None) == enabled
@@ -0,0 +1,39 @@
+import numpy as np
+
+import cache
+
+
+def test_least_recently_used_entries_are_evicted_first():
+    shared = cache.SharedCache(max_bytes=3000)
+    for key in 'abc':
+        assert shared.put(key, np.zeros(1000, dtype=np.uint8))
+    shared.get('a')  # 'b' is now the least recently used
+    shared.put('d', np.zeros(1000, dtype=np.uint8))
+    assert 'b' not in shared and all(key in shared for key in 'acd')
+    assert shared.current_bytes == 3000 and shared.stats()['evictions'] == 1
+
+
+def test_entry_larger_than_the_budget_is_refused():
+    shared = cache.SharedCache(max_bytes=1000)
+    shared.put('small', b'x' * 10)
+    assert not shared.put('big', np.zeros(2000, dtype=np.uint8))
+    assert 'big' not in shared and 'small' in shared
+
+
+def test_replacing_a_key_updates_the_byte_count():
+    shared = cache.SharedCache(max_bytes=10000)
+    shared.put('k', b'x' * 100)
+    shared.put('k', b'x' * 40)
+    assert shared.current_bytes == 40
+    assert shared.pop('k') == b'x' * 40 and shared.current_bytes == 0
+
+
+def test_shared_arrays_are_counted_once():
+    vi = np.zeros(1000)
+    entry = {'vi_data_overall': vi, 'vis': {'NDVI': vi}}
+    assert cache.estimate_nbytes(entry) < 2 * vi.nbytes
+
+
+def test_make_key_is_stable_and_order_insensitive_for_dicts():
+    assert cache.make_key('a', {'x': 1, 'y': 2}) == cache.make_key('a', {'y': 2, 'x': 1})
+    assert cache.make_key('a', 1) != cache.make_key('a', 2)
@@ -0,0 +1,96 @@
+import pystac_client
+import pytest
+
+import catalog
+import utils
+
+BBOX = [100.4, 13.6, 100.7, 13.9]
+
+
+def _item(item_id, date, bbox=(100.0, 13.0, 101.0, 14.0), cloud_cover=5.0):
+    minx, miny, maxx, maxy = bbox
+    return {
+        'type': 'Feature', 'stac_version': '1.0.0', 'id': item_id, 'collection': catalog.COLLECTION,
+        'bbox': list(bbox), 'properties': {'datetime': f"{date}T03:30:00Z", 'eo:cloud_cover': cloud_cover},
+        'geometry': {'type': 'Polygon', 'coordinates': [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy],
+                                                         [minx, miny]]]},
+        'links': [], 'assets': {'B04': {'href': f"https://example.blob.core.windows.net/{item_id}/B04.tif"}},
+    }
+
+
+class _FakeClient:
+    """Stands in for the Planetary Computer STAC API: records searches, returns fixed items."""
+
+    def __init__(self, items, fail=False):
+        self.items, self.fail, self.searches = items, fail, []
+
+    def open(self, url, **kwargs):
+        if self.fail:
+            raise ConnectionError("unreachable")
+        return self
+
+    def search(self, **kwargs):
+        import pystac
+
+        self.searches.append(kwargs)
+        return type('Search', (), {
+            'items': lambda _: (pystac.Item.from_dict(d) for d in self.items),
+            'get_items': lambda _: (pystac.Item.from_dict(d) for d in self.items),
+        })()
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    db = tmp_path / 'scenes.db'
+    monkeypatch.setenv('PALANTIR_CATALOG_DB', str(db))
+    monkeypatch.setenv('PALANTIR_MIRROR_DIR', str(tmp_path / 'mirror'))
+    return catalog.get_local_catalog()
+
+
+def test_search_filters_by_footprint_date_and_cloud_cover(local):
+    local.add_items([_item('in', '2024-03-01'), _item('late', '2024-06-01'), _item('cloudy', '2024-03-02', cloud_cover=80),
+                     _item('far', '2024-03-03', bbox=(10.0, 50.0, 11.0, 51.0))])
+    found = local.search(BBOX, '2024-02-01', '2024-04-01', cloud_cover_max=15)
+    assert [item.id for item in found] == ['in']
+
+
+def test_mirrored_assets_resolve_to_local_files(local, tmp_path):
+    (tmp_path / 'mirror' / 'in').mkdir(parents=True)
+    (tmp_path / 'mirror' / 'in' / 'B04.tif').write_bytes(b'')
+    local.add_items([_item('in', '2024-03-01')])
+    assert local.search(BBOX, '2024-02-01', '2024-04-01')[0].assets['B04'].href == str(tmp_path / 'mirror' / 'in' / 'B04.tif')
+
+
+def test_sync_continues_per_area_and_needs_a_bbox(local, monkeypatch):
+    client = _FakeClient([_item('a', '2024-03-01')])
+    monkeypatch.setattr(pystac_client, 'Client', client)
+    assert catalog.sync(local, bbox=BBOX, end='2024-05-01') == 1
+    assert client.searches[-1]['datetime'].startswith('2015-06-23')
+
+    catalog.sync(local, bbox=BBOX, end='2024-06-01')
+    assert client.searches[-1]['datetime'].startswith('2024-05-01')
+    # A second area starts from the beginning of the archive, not from the first area's last sync
+    catalog.sync(local, bbox=[101.0, 14.0, 101.2, 14.2], end='2024-06-01')
+    assert client.searches[-1]['datetime'].startswith('2015-06-23')
+    assert local.covers(BBOX, '2020-01-01', '2024-06-01') and not local.covers(BBOX, '2020-01-01', '2024-07-01')
+
+    with pytest.raises(ValueError):
+        catalog.sync(local, end='2024-06-01')
+
+
+def test_search_items_prefers_the_planetary_computer_outside_synced_windows(local, monkeypatch):
+    local.add_items([_item('stale', '2024-03-01')])
+    monkeypatch.setattr(pystac_client, 'Client', _FakeClient([_item('stale', '2024-03-01'), _item('new', '2024-04-20')]))
+    assert {item.id for item in utils.search_items(BBOX, '2024-05-01', days_back=90)} == {'stale', 'new'}
+
+    monkeypatch.setattr(pystac_client, 'Client', _FakeClient([], fail=True))
+    assert [item.id for item in utils.search_items(BBOX, '2024-05-01', days_back=90)] == ['stale']
+
+
+def test_search_items_answers_synced_windows_locally(local, monkeypatch):
+    local.add_items([_item('a', '2024-03-01')])
+    local.mark_synced(BBOX, '2024-01-01', '2024-06-01')
+    client = _FakeClient([])
+    monkeypatch.setattr(pystac_client, 'Client', client)
+    assert [item.id for item in utils.search_items(BBOX, '2024-05-01', days_back=90)] == ['a']
+    assert client.searches == []
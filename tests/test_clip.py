@@ -0,0 +1,35 @@
+import numpy as np
+import rioxarray  # noqa: F401
+import xarray as xr
+from pyproj import Transformer
+
+import utils
+
+
+def _band(values):
+    x = 600000 + 10 * np.arange(values.shape[1]) + 5
+    y = 1500000 - 10 * np.arange(values.shape[0]) - 5
+    da = xr.DataArray(values.astype('uint16'), coords={'y': y, 'x': x}, dims=('y', 'x'), attrs={'_FillValue': 0})
+    return da.rio.write_crs('EPSG:32647')
+
+
+def _polygon():
+    to_lonlat = Transformer.from_crs(32647, 4326, always_xy=True)
+    ring = [to_lonlat.transform(*p) for p in [(600100, 1499900), (600300, 1499900), (600300, 1499700),
+                                              (600100, 1499700), (600100, 1499900)]]
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+def test_pixels_outside_the_polygon_are_nan_on_every_path():
+    rng = np.random.default_rng(0)
+    bands = {'B04': _band(rng.integers(200, 3000, (40, 40))), 'B08': _band(rng.integers(1000, 6000, (40, 40)))}
+    lazy = {name: band.chunk(16) for name, band in bands.items()}
+    for source in (bands, lazy):
+        clipped = utils.clip_to_geometry(utils.calculate_vis(source, ['NDVI'])['NDVI'], _polygon()).compute()
+        assert utils.compute_stats(clipped)['count'] == 400
+        assert not (clipped.values == 0).any()
+
+
+def test_raw_bands_keep_their_integer_fill_value():
+    clipped = utils.clip_to_geometry(_band(np.full((40, 40), 500)), _polygon())
+    assert clipped.dtype == np.uint16 and (clipped.values == 0).sum() == 40 * 40 - 400
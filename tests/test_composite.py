@@ -0,0 +1,52 @@
+import warnings
+
+import numpy as np
+
+import utils
+
+
+def _layers(count, shape=(64, 64), seed=0):
+    rng = np.random.default_rng(seed)
+    layers = rng.uniform(-1, 1, (count,) + shape).astype(np.float32)
+    layers[rng.random(layers.shape) < 0.2] = np.nan  # clouds
+    layers[:, 0, 0] = np.nan  # never clear
+    return layers
+
+
+def test_median_is_within_one_histogram_bin_of_the_exact_median():
+    layers = _layers(12)
+    reducer = utils._CompositeReducer('median', layers.shape[1:], median_bins=32)
+    for layer in layers:
+        reducer.add(layer)
+
+    result = reducer.result()
+    width = reducer.edges[1] - reducer.edges[0]  # ~0.09 for 32 bins over [-1, 1] plus headroom
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN pixel
+        exact = np.nanmedian(layers, axis=0)
+    assert np.isnan(result[0, 0])
+    assert np.nanmax(np.abs(result - exact)) <= width
+    assert np.nanmean(np.abs(result - exact)) < width / 4
+
+
+def test_max_and_weighted_mean_are_exact():
+    layers = _layers(6)
+    weights = np.linspace(0.5, 1.0, len(layers))
+    maximum = utils._CompositeReducer('max', layers.shape[1:])
+    mean = utils._CompositeReducer('mean', layers.shape[1:])
+    for layer, weight in zip(layers, weights):
+        maximum.add(layer)
+        mean.add(layer, weight)
+
+    clear = np.isfinite(layers)
+    expected_mean = (np.where(clear, layers, 0) * weights[:, None, None]).sum(0) / (clear * weights[:, None, None]).sum(0)
+    np.testing.assert_allclose(maximum.result()[1:], np.nanmax(layers[:, 1:], axis=0))
+    np.testing.assert_allclose(mean.result().ravel()[1:], expected_mean.ravel()[1:], rtol=1e-6)
+    assert np.isnan(maximum.result()[0, 0]) and np.isnan(mean.result()[0, 0])
+    assert (maximum.count == clear.sum(0)).all()
+
+
+def test_median_without_any_clear_layer_is_nan():
+    reducer = utils._CompositeReducer('median', (4, 4))
+    reducer.add(np.full((4, 4), np.nan, dtype=np.float32))
+    assert np.isnan(reducer.result()).all()
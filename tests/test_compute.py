@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import compute
+
+
+def _ndvi(blocks):
+    nir, red = blocks['B08'], blocks['B04']
+    return {'NDVI': (nir - red) / (nir + red), 'SUM': nir + red}
+
+
+@pytest.mark.parametrize('shape', [(1000, 333), (7, 5), (1, 70000), ()])
+def test_row_blocks_cover_every_row_once(shape):
+    blocks = compute.row_blocks(shape, tile_pixels=4096)
+    covered = np.zeros(shape[0] if shape else 1, dtype=int)
+    for rows in blocks:
+        covered[rows] += 1
+    assert (covered == 1).all()
+    if shape and shape[1:]:
+        assert all(rows.stop - rows.start <= max(1, 4096 // shape[1]) for rows in blocks)
+
+
+@pytest.mark.parametrize('threads', ['1', '4'])
+def test_tiled_result_equals_the_whole_array_formula(monkeypatch, threads):
+    monkeypatch.setenv('PALANTIR_COMPUTE_THREADS', threads)
+    rng = np.random.default_rng(1)
+    arrays = {'B08': rng.uniform(0.1, 0.5, (600, 500)), 'B04': rng.uniform(0.01, 0.2, (600, 500))}
+    out = compute.run(_ndvi, arrays, ['NDVI', 'SUM'], dtype=np.float32, tile_pixels=10000)
+    expected = _ndvi(arrays)
+    assert out['NDVI'].dtype == np.float32
+    np.testing.assert_allclose(out['NDVI'], expected['NDVI'], rtol=1e-6)
+    np.testing.assert_allclose(out['SUM'], expected['SUM'], rtol=1e-6)
+
+
+def test_kernel_errors_propagate(monkeypatch):
+    monkeypatch.setenv('PALANTIR_COMPUTE_THREADS', '4')
+
+    def kernel(blocks):
+        if (blocks['B08'] < 0).any():
+            raise ValueError("negative reflectance")
+        return {'NDVI': blocks['B08']}
+
+    arrays = {'B08': np.ones((400, 100))}
+    arrays['B08'][350, 3] = -1
+    with pytest.raises(ValueError, match="negative reflectance"):
+        compute.run(kernel, arrays, ['NDVI'], tile_pixels=1000)
+
+
+def test_thread_setting_falls_back_to_the_cpu_count(monkeypatch):
+    monkeypatch.setenv('PALANTIR_COMPUTE_THREADS', 'many')
+    assert compute.threads() >= 1
+    monkeypatch.setenv('PALANTIR_COMPUTE_THREADS', '3')
+    assert compute.threads() == 3
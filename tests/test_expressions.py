@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import expressions
+
+
+def test_huge_constant_power_is_rejected():
+    with pytest.raises(expressions.ExpressionError):
+        expressions.compile_expression('B08 * 9**9**9**9')
+
+
+@pytest.mark.parametrize('expression', ['B08 ** B04', 'B08 ** 9', 'B08 ** -9', 'B08 ** (2 + 1)'])
+def test_exponent_must_be_a_small_literal(expression):
+    with pytest.raises(expressions.ExpressionError):
+        expressions.parse(expression)
+
+
+def test_small_powers_evaluate():
+    kernel = expressions.compile_expression('B08 ** 2 + B04 ** -0.5 + 2 ** 8')
+    out = kernel({'B08': np.array([10000.0]), 'B04': np.array([2500.0])})
+    np.testing.assert_allclose(out, [1 + 2 + 256])
+
+
+def test_expression_size_is_bounded():
+    with pytest.raises(expressions.ExpressionError):
+        expressions.parse(' + '.join(['B08'] * (expressions.MAX_NODES // 2)))
+    with pytest.raises(expressions.ExpressionError):
+        expressions.parse('B08' + ' ' * expressions.MAX_LENGTH)
+
+
+def test_probe_evaluates_one_pixel():
+    assert expressions.probe('(B08 - B04) / (B08 + B04)').bands == ['B04', 'B08']
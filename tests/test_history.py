@@ -0,0 +1,89 @@
+import datetime
+import glob
+import os
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import history
+
+
+def _stats(mean):
+    return {'count': 100, 'mean': mean, 'min': 0.0, 'max': 1.0, 'std': 0.1,
+            'percentiles': {q: mean for q in history.PERCENTILES}}
+
+
+def _rows(geometry_hash, date, means, field_id=None, item_id=None):
+    metadata = {'item_id': item_id or f"S2_{date:%Y%m%d}", 'item_date': date, 'cloud_cover': 3.0,
+                'expressions': {'X': 'B08 / B04'}}
+    return history.rows_from_result(metadata, {name: _stats(m) for name, m in means.items()}, geometry_hash,
+                                    field_id=field_id)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return history.HistoryStore(str(tmp_path))
+
+
+def test_rows_round_trip_through_parquet(store):
+    date = datetime.date(2024, 3, 5)
+    assert store.append(_rows('h1', date, {'NDVI': 0.6, 'X': 1.5}, field_id='north')) == 2
+
+    frame = store.query(geometry_hash='h1')
+    assert frame['index'].tolist() == ['NDVI', 'X']
+    row = frame.iloc[0]
+    assert (row['field_id'], row['item_id'], row['date']) == ('north', 'S2_20240305', date)
+    assert row['mean'] == 0.6 and row['p50'] == 0.6 and row['cloud_cover'] == 3.0
+    assert frame.iloc[1]['expression'] == 'B08 / B04'
+    assert store.query(field_id='north').shape[0] == 2 and store.query(field_id='south').empty
+
+
+def test_rows_are_partitioned_by_month_and_queried_by_range(store):
+    for day in range(0, 120, 10):
+        store.append(_rows('h1', datetime.date(2024, 1, 1) + datetime.timedelta(days=day), {'NDVI': day / 100}))
+    store.append(_rows('h2', datetime.date(2024, 2, 10), {'NDVI': 0.9}))
+
+    months = sorted(os.path.basename(path) for path in glob.glob(os.path.join(store.root, 'month=*')))
+    assert months == ['month=2024-01', 'month=2024-02', 'month=2024-03', 'month=2024-04']
+
+    frame = store.query(geometry_hash='h1', index='NDVI', start=datetime.date(2024, 2, 1),
+                        end=datetime.date(2024, 3, 15), columns=['mean'])
+    assert frame['date'].min() >= datetime.date(2024, 2, 1) and frame['date'].max() <= datetime.date(2024, 3, 15)
+    assert len(frame) == 4 and frame['date'].is_monotonic_increasing  # Feb 10, 20, Mar 1, 11
+    assert 'std' not in frame.columns
+
+
+def test_re_recorded_scene_keeps_only_the_latest_row(store):
+    date = datetime.date(2024, 5, 1)
+    store.append(_rows('h1', date, {'NDVI': 0.2}))
+    store.append(_rows('h1', date, {'NDVI': 0.7}))
+    frame = store.query(geometry_hash='h1')
+    assert len(frame) == 1 and frame.iloc[0]['mean'] == 0.7
+
+
+def test_empty_statistics_are_stored_as_nulls(store):
+    metadata = {'item_id': 'S2_A', 'item_date': datetime.date(2024, 6, 1)}
+    store.append(history.rows_from_result(metadata, {'NDVI': {'count': 0}}, 'abcdef0123456789'))
+    row = store.query(index='NDVI').iloc[0]
+    assert row['count'] == 0 and row['mean'] != row['mean']  # NaN
+    assert row['field_id'] == 'abcdef012345'  # defaults to the geometry hash prefix
+
+
+def test_compaction_merges_a_month_without_losing_rows(store, monkeypatch):
+    monkeypatch.setattr(history, 'MAX_FILES_PER_MONTH', 4)
+    for day in range(1, 6):
+        store.append(_rows(f"h{day % 2}", datetime.date(2024, 7, day), {'NDVI': day / 10}))
+
+    stats = store.stats()
+    assert (stats['months'], stats['files']) == (1, 1)
+    assert len(store.query()) == 5
+    assert store.query(geometry_hash='h1')['mean'].tolist() == [0.1, 0.3, 0.5]
+
+
+def test_store_is_configured_from_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, '_store', None)
+    monkeypatch.setenv('PALANTIR_HISTORY_DIR', '')
+    assert history.get_history_store() is None
+    monkeypatch.setenv('PALANTIR_HISTORY_DIR', str(tmp_path / 'history'))
+    assert history.get_history_store().root == str(tmp_path / 'history')
@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+import jobs
+
+
+def _blocking(release):
+    def fn(progress):
+        progress('start', "Started", 0.0)
+        release.wait(5)
+        progress('work', "Working", 0.5)  # Raises JobCancelled once cancelled
+        return 'done'
+    return fn
+
+
+def test_queue_full_is_raised_beyond_max_pending():
+    manager = jobs.JobManager(max_workers=1, max_pending=2)
+    release = threading.Event()
+    try:
+        manager.submit(_blocking(release))
+        manager.submit(_blocking(release))
+        with pytest.raises(jobs.QueueFull):
+            manager.submit(_blocking(release))
+    finally:
+        release.set()
+
+
+def test_running_job_is_cancelled_at_its_next_progress_report():
+    manager = jobs.JobManager(max_workers=1, max_pending=4)
+    release = threading.Event()
+    job = manager.submit(_blocking(release))
+    while not job.events:
+        threading.Event().wait(0.01)
+    manager.cancel(job.id)
+    release.set()
+    assert job.wait(5) and job.state == jobs.CANCELLED
+
+
+def test_queued_job_is_dropped_on_cancel():
+    manager = jobs.JobManager(max_workers=1, max_pending=4)
+    release = threading.Event()
+    running = manager.submit(_blocking(release))
+    queued = manager.submit(lambda progress: 'never')
+    queued.cancel()
+    release.set()
+    assert running.wait(5) and running.state == jobs.DONE and running.result == 'done'
+    assert queued.wait(5) and queued.state == jobs.CANCELLED and queued.result is None
+
+
+def test_failures_are_recorded_on_the_job():
+    manager = jobs.JobManager(max_workers=1, max_pending=4)
+
+    def fail(progress):
+        raise ValueError("no scene")
+
+    job = manager.submit(fail)
+    assert job.wait(5) and job.state == jobs.FAILED and job.error == "no scene"
+    assert manager.stats()[jobs.FAILED] == 1
@@ -0,0 +1,64 @@
+import math
+
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, Polygon, box, mapping
+
+import cache
+import lod
+
+
+def _circle(vertices, cx=100.5, cy=14.5, radius=0.05):
+    # A wobbly circle, so simplification cannot collapse it to a handful of points
+    return Polygon([(cx + radius * (1 + 0.002 * math.sin(40 * t)) * math.cos(t),
+                     cy + radius * (1 + 0.002 * math.sin(40 * t)) * math.sin(t))
+                    for t in (2 * math.pi * i / vertices for i in range(vertices))])
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(cache, 'shared', cache.SharedCache(max_bytes=64 * 1024 * 1024))
+
+
+def test_small_geometry_is_returned_exactly():
+    geometry = mapping(box(100.0, 14.0, 100.1, 14.1))
+    geom, vertices, exact = lod.simplified(geometry, 100)
+    assert vertices == exact == 5 and geom.equals(box(100.0, 14.0, 100.1, 14.1))
+    assert lod.to_geojson(geometry) is geometry
+
+
+@pytest.mark.parametrize('budget', [5000, 1000, 200])
+def test_large_geometry_fits_the_vertex_budget(budget):
+    geometry = mapping(_circle(20000))
+    geom, vertices, exact = lod.simplified(geometry, budget)
+    assert exact == 20001 and vertices <= budget
+    assert vertices == shapely.get_num_coordinates(geom)
+    # Display versions stay close to the exact boundary
+    assert geom.is_valid and geom.symmetric_difference(_circle(20000)).area < 0.01 * geom.area
+
+
+def test_levels_are_cached_and_reused(monkeypatch):
+    geometry = mapping(_circle(20000))
+    coarse = lod.simplified(geometry, 200)
+    levels = cache.shared.get(cache.make_key('lod', lod.utils.geometry_hash(geometry)))
+    assert levels[0][1] == 20001 and levels[-1][0] is coarse[0]
+
+    calls = []
+    simplify = shapely.simplify
+    monkeypatch.setattr(shapely, 'simplify', lambda *a, **k: calls.append(a) or simplify(*a, **k))
+    # Any budget the cached levels already satisfy is answered without simplifying again
+    assert lod.simplified(geometry, 5000)[0] is coarse[0]
+    assert lod.simplified(geometry, 10 ** 6)[1] == 20001
+    assert not calls
+    # A tighter budget extends the cached levels from the coarsest one
+    assert lod.simplified(geometry, 20)[1] <= 20
+    assert calls and calls[0][0] is coarse[0]
+
+
+def test_multipart_rings_and_wkt_keep_every_part():
+    geometry = mapping(MultiPolygon([_circle(5000, cx=100.2), _circle(5000, cx=100.8)]))
+    rings = lod.rings(geometry, max_vertices=500)
+    assert len(rings) == 2 and sum(len(r) for r in rings) <= 500
+
+    text, shown, exact = lod.to_wkt(geometry, max_vertices=500)
+    assert text.startswith('MULTIPOLYGON') and shown <= 500 < exact
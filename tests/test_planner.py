@@ -0,0 +1,86 @@
+import pytest
+
+import planner
+
+BBOX = [100.0, 14.0, 100.1, 14.1]  # ~10.8 x 11.1 km
+# Per-chunk buffers only pay off on very large grids (~1e9 pixels here)
+LARGE_BBOX = [100.0, 14.0, 103.0, 17.0]
+BANDS = ['B04', 'B08']
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def _plan(memory, transfer, result, bbox=BBOX, **kwargs):
+    return planner.plan(bbox, BANDS, memory_budget_bytes=memory, transfer_budget_bytes=transfer,
+                        result_budget_bytes=result, **kwargs)
+
+
+def test_estimate_counts_pixels_on_the_finest_band_grid():
+    native = planner.estimate(BBOX, BANDS)
+    width, height = planner.bbox_size_m(BBOX)
+    assert native['pixels'] == pytest.approx(width * height / 100, rel=0.01)
+    assert native['band_pixels']['SCL'] == pytest.approx(native['pixels'] / 4, rel=0.01)
+    coarse = planner.estimate(BBOX, BANDS, overview_level=0)
+    assert coarse['pixels'] == pytest.approx(native['pixels'] / 4, rel=0.01)
+    assert coarse['transfer_bytes'] < native['transfer_bytes'] / 3
+
+
+def test_windows_cut_the_transfer_but_not_the_memory():
+    windows = [[100.0, 14.0, 100.01, 14.01], [100.09, 14.09, 100.1, 14.1]]
+    native = planner.estimate(BBOX, BANDS)
+    parts = planner.estimate(BBOX, BANDS, windows=windows)
+    assert parts['read_fraction'] == pytest.approx(0.02, rel=0.05)
+    assert parts['transfer_bytes'] == pytest.approx(native['transfer_bytes'] * parts['read_fraction'], abs=1)
+    assert parts['envelope_transfer_bytes'] == native['transfer_bytes']
+    assert parts['peak_bytes'] == native['peak_bytes']
+
+
+def test_full_resolution_when_everything_fits():
+    p = _plan(4096 * MB, 4096 * MB, 4096 * MB)
+    assert p['mode'] == planner.FULL and p['overview_level'] is None
+
+
+def test_chunked_when_only_the_in_memory_peak_is_over_budget():
+    native = planner.estimate(LARGE_BBOX, BANDS)
+    assert native['chunked_peak_bytes'] < native['peak_bytes']
+    p = _plan(native['chunked_peak_bytes'], 64 * GB, 64 * GB, bbox=LARGE_BBOX)
+    assert p['mode'] == planner.CHUNKED and 'memory budget' in p['reason']
+    assert p['peak_bytes'] == native['chunked_peak_bytes']
+    assert p['result_bytes'] == native['chunked_result_bytes']
+
+
+def test_chunked_when_only_the_cached_result_is_over_budget():
+    native = planner.estimate(BBOX, BANDS)
+    p = _plan(4096 * MB, 4096 * MB, native['chunked_result_bytes'])
+    assert p['mode'] == planner.CHUNKED and 'cache budget' in p['reason']
+
+
+def test_overview_without_a_chunked_path_or_over_the_transfer_budget():
+    native = planner.estimate(LARGE_BBOX, BANDS)
+    p = _plan(native['chunked_peak_bytes'], 64 * GB, 64 * GB, bbox=LARGE_BBOX, allow_chunked=False)
+    assert p['mode'] == planner.OVERVIEW and p['overview_level'] == 0
+    assert p['peak_bytes'] <= native['chunked_peak_bytes']
+
+    native = planner.estimate(BBOX, BANDS)
+
+    p = _plan(4096 * MB, native['transfer_bytes'] // 10, 4096 * MB)
+    assert p['mode'] == planner.OVERVIEW and p['overview_level'] == 1
+    assert 'transfer budget' in p['reason'] and p['transfer_bytes'] <= p['transfer_budget']
+
+
+def test_refused_when_even_the_coarsest_overview_is_over_budget():
+    p = _plan(1024, 1024, 1024)
+    assert p['mode'] == planner.TOO_LARGE
+    assert 'too large' in planner.describe(p).lower()
+
+
+def test_result_budget_defaults_to_the_shared_cache(monkeypatch):
+    monkeypatch.setattr(planner.cache.shared, 'max_bytes', 1234)
+    assert planner.plan(BBOX, BANDS)['result_budget'] == 1234
+
+
+def test_budgets_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv('PALANTIR_MEMORY_BUDGET_MB', '512')
+    monkeypatch.setenv('PALANTIR_TRANSFER_BUDGET_MB', 'lots')
+    assert planner.memory_budget() == 512 * MB
+    assert planner.transfer_budget() == planner.DEFAULT_TRANSFER_BUDGET_MB * MB
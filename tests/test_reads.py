@@ -0,0 +1,12 @@
+import reads
+from test_signing import HREF
+
+
+def test_5xx_on_a_dated_href_is_retried():
+    assert reads.is_transient(OSError(f"'/vsicurl/{HREF}' HTTP response code: 503"))
+    assert reads.is_transient(RuntimeError(f"{HREF}: HTTP response code: 502"))
+
+
+def test_missing_asset_is_not_retried():
+    assert not reads.is_transient(OSError(f"'/vsicurl/{HREF}' HTTP response code: 404"))
+    assert not reads.is_transient(reads.ReadTimeout())
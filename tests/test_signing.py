@@ -0,0 +1,68 @@
+import urllib.error
+
+import signing
+
+HREF = ("https://sentinel2l2a01.blob.core.windows.net/sentinel2-l2/47/P/PR/2024/04/03/"
+        "S2A_MSIL2A_20240403T033529_N0510_R061_T47PPR_20240403T080217.SAFE/GRANULE/"
+        "L2A_T47PPR_A045885_20240403T034521/IMG_DATA/R10m/T47PPR_20240403T033529_B04_10m.tif")
+
+
+def test_status_in_href_is_not_an_auth_error():
+    exc = OSError(f"'/vsicurl/{HREF}' HTTP response code: 503")
+    assert not signing.is_auth_error(exc)
+
+
+def test_rejected_token_is_an_auth_error():
+    assert signing.is_auth_error(OSError(f"'/vsicurl/{HREF}' HTTP response code: 403"))
+    assert signing.is_auth_error(OSError("Server failed to authenticate the request. AuthenticationFailed"))
+    assert signing.is_auth_error(urllib.error.HTTPError(HREF, 403, "Forbidden", {}, None))
+    assert not signing.is_auth_error(urllib.error.HTTPError(HREF, 503, "Service Unavailable", {}, None))
+
+
+def _item_with_band(tmp_path):
+    import numpy as np
+    import pystac
+    import rasterio
+    from rasterio.transform import from_origin
+
+    path = str(tmp_path / 'B04.tif')
+    data = np.arange(300 * 300, dtype='uint16').reshape(300, 300)
+    with rasterio.open(path, 'w', driver='GTiff', width=300, height=300, count=1, dtype='uint16',
+                       crs='EPSG:32647', transform=from_origin(600000, 1500000, 10, 10)) as dst:
+        dst.write(data, 1)
+    item = pystac.Item('S2_TEST', geometry=None, bbox=None, datetime=__import__('datetime').datetime(2024, 4, 3),
+                       properties={})
+    item.add_asset('B04', pystac.Asset(path))
+    return item, data
+
+
+def test_chunks_are_re_signed_when_the_token_expires_before_compute(tmp_path, monkeypatch):
+    import numpy as np
+    from pyproj import Transformer
+
+    import utils
+
+    item, data = _item_with_band(tmp_path)
+    to_lonlat = Transformer.from_crs(32647, 4326, always_xy=True)
+    bbox = [*to_lonlat.transform(600505, 1497505), *to_lonlat.transform(601995, 1499495)]
+    band = utils.load_bands_chunked(item, ['B04'], bbox, chunk_size=64)['B04']
+
+    # The token expires after opening: the first chunk read is refused once, then re-signed
+    invalidated = []
+    monkeypatch.setattr(signing, 'is_blob_href', lambda href: True)
+    monkeypatch.setattr(signing.tokens, 'invalidate', invalidated.append)
+    monkeypatch.setattr(signing, 'sign_href', lambda href, collection=None: href)
+    refused = []
+    read_block = utils._read_block
+
+    def expiring(href, window):
+        if not refused:
+            refused.append(window)
+            raise OSError(f"'/vsicurl/{HREF}' HTTP response code: 403")
+        return read_block(href, window)
+
+    monkeypatch.setattr(utils, '_read_block', expiring)
+    values = band.compute(scheduler='synchronous').values
+    assert invalidated and refused
+    row, col = round((1500000 - band.y.values[0] - 5) / 10), round((band.x.values[0] - 600000 - 5) / 10)
+    np.testing.assert_array_equal(values, data[row:row + values.shape[0], col:col + values.shape[1]])
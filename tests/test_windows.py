@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from shapely.geometry import MultiPolygon, box, mapping
+
+import utils
+
+
+def _fields(*boxes):
+    return mapping(MultiPolygon([box(*b) for b in boxes]))
+
+
+def test_single_part_and_nearby_parts_use_one_envelope_read():
+    assert utils.read_windows(mapping(box(100.0, 14.0, 100.1, 14.1))) is None
+    assert utils.read_windows(None) is None
+    # Two touching-ish fields: splitting would skip far less than MIN_WINDOW_SAVING
+    assert utils.read_windows(_fields((100.0, 14.0, 100.1, 14.1), (100.11, 14.0, 100.2, 14.1))) is None
+
+
+def test_distant_parts_are_read_as_separate_windows():
+    geometry = _fields((100.0, 14.0, 100.01, 14.01), (100.5, 14.5, 100.51, 14.51))
+    windows = utils.read_windows(geometry)
+    assert sorted(windows) == [[100.0, 14.0, 100.01, 14.01], [100.5, 14.5, 100.51, 14.51]]
+    assert utils.read_windows(geometry) is windows  # cached per geometry
+
+
+def test_clusters_of_parts_merge_into_one_window_each():
+    west = [(100.0 + 0.011 * i, 14.0, 100.01 + 0.011 * i, 14.01) for i in range(3)]
+    east = [(100.8 + 0.011 * i, 14.8, 100.81 + 0.011 * i, 14.81) for i in range(3)]
+    windows = utils._merge_windows([box(*b) for b in west + east], (100.0, 14.0, 100.832, 14.81))
+    assert sorted(windows) == [[100.0, 14.0, 100.032, 14.01], [100.8, 14.8, 100.832, 14.81]]
+
+
+def test_merging_stops_at_the_window_limit():
+    # A grid of isolated parts: merging is forced until at most MAX_READ_WINDOWS remain
+    parts = [box(100 + i, 14 + j, 100.01 + i, 14.01 + j) for i in range(5) for j in range(5)]
+    windows = utils._merge_windows(parts, (100, 14, 104.01, 18.01))
+    assert windows is not None and len(windows) <= utils.MAX_READ_WINDOWS
+    covered = MultiPolygon([box(*w) for w in windows])
+    assert all(covered.contains(part) for part in parts)
+
+
+def test_too_many_parts_fall_back_to_the_envelope():
+    parts = [(100 + 0.1 * i, 14.0, 100.001 + 0.1 * i, 14.001) for i in range(utils.MAX_WINDOW_PARTS + 1)]
+    assert utils.read_windows(_fields(*parts)) is None
+
+
+def test_parts_are_pasted_onto_the_envelope_grid(tmp_path):
+    import geopandas as gpd
+    import rasterio
+    from pyproj import Transformer
+    from rasterio.transform import from_origin
+
+    path = str(tmp_path / 'B04.tif')
+    data = np.arange(1, 200 * 200 + 1, dtype='uint16').reshape(200, 200)
+    with rasterio.open(path, 'w', driver='GTiff', width=200, height=200, count=1, dtype='uint16',
+                       crs='EPSG:32647', transform=from_origin(600000, 1500000, 10, 10), nodata=0) as dst:
+        dst.write(data, 1)
+
+    to_lonlat = Transformer.from_crs(32647, 4326, always_xy=True)
+
+    def lonlat_box(x0, y0, x1, y1):
+        return gpd.GeoDataFrame(geometry=[box(*to_lonlat.transform(x0, y0), *to_lonlat.transform(x1, y1))],
+                                crs='EPSG:4326')
+
+    envelope = lonlat_box(600205, 1498205, 601795, 1499795)
+    parts = [lonlat_box(600205, 1498205, 600495, 1498495), lonlat_box(601505, 1499505, 601795, 1499795)]
+    with ThreadPoolExecutor(2) as pool:
+        pasted = utils._read_parts(path, envelope, parts, None, pool)
+    whole = utils._read_window(path, envelope)
+
+    assert pasted.shape == whole.shape
+    np.testing.assert_array_equal(pasted.x.values, whole.x.values)
+    inside = pasted.values > 0
+    # Only the two windows were filled, each with exactly the envelope read's pixels
+    assert 0 < inside.sum() < whole.size / 4
+    np.testing.assert_array_equal(pasted.values[inside], whole.values[inside])
+    assert inside[-30:, :30].any() and inside[:30, -30:].any() and not inside[60:-60, 60:-60].any()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import rioxarray  # noqa: F401
+import xarray as xr
+from pyproj import Transformer
+from shapely.geometry import box, mapping, shape
+
+import utils
+import zoning
+
+# 100 x 100 pixels of 10 m in UTM 47N
+ORIGIN_X, ORIGIN_Y = 600000, 1500000
+
+
+def _raster(values):
+    rows, cols = values.shape
+    da = xr.DataArray(values.astype(np.float32), dims=('y', 'x'),
+                      coords={'y': ORIGIN_Y - 5 - 10 * np.arange(rows), 'x': ORIGIN_X + 5 + 10 * np.arange(cols)})
+    return da.rio.write_crs('EPSG:32647')
+
+
+def _lonlat_box(col0, row0, col1, row1):
+    to_lonlat = Transformer.from_crs(32647, 4326, always_xy=True)
+    west, north = to_lonlat.transform(ORIGIN_X + 10 * col0, ORIGIN_Y - 10 * row0)
+    east, south = to_lonlat.transform(ORIGIN_X + 10 * col1, ORIGIN_Y - 10 * row1)
+    return mapping(box(west, south, east, north))
+
+
+def test_jenks_finds_the_gaps_between_clusters():
+    values = np.concatenate([np.full(500, 0.2), np.full(300, 0.5), np.full(200, 0.8)])
+    values = values + np.linspace(-0.02, 0.02, values.size)
+    zones = zoning.classify(values, zoning.jenks_breaks(utils.compute_stats(values), 3))
+    assert np.bincount(zones).tolist() == [0, 500, 300, 200]
+
+
+def test_quantile_breaks_split_pixels_evenly():
+    values = np.linspace(0, 1, 10000)
+    breaks = zoning.quantile_breaks(utils.compute_stats(values), 4)
+    zones = zoning.classify(values, breaks)
+    counts = np.bincount(zones, minlength=5)[1:]
+    assert counts.min() > 0.23 * values.size and counts.max() < 0.27 * values.size
+
+
+def test_classify_leaves_missing_pixels_at_zero():
+    zones = zoning.classify(np.array([np.nan, 0.1, 0.5, 0.9]), [0.3, 0.7])
+    assert zones.tolist() == [0, 1, 2, 3]
+
+
+def test_sieve_merges_small_patches_and_keeps_no_data():
+    zones = np.ones((20, 20), dtype=np.uint8)
+    zones[:, 10:] = 2
+    zones[5:7, 3:5] = 2  # 4-pixel island in zone 1
+    zones[0, :] = 0  # outside the field
+    sieved = zoning.sieve(zones, min_pixels=10)
+    assert (sieved[5:7, 3:5] == 1).all()
+    assert (sieved[0] == 0).all() and (sieved[1:, 10:] == 2).all()
+
+
+def test_polygonize_returns_one_lonlat_multipolygon_per_zone():
+    zones = np.zeros((10, 10), dtype=np.uint8)
+    zones[:, :5], zones[:, 5:] = 1, 2
+    zones[0, 0] = 0
+    transform = _raster(np.zeros((10, 10))).rio.transform()
+    polygons = zoning.polygonize(zones, transform, 'EPSG:32647')
+    assert sorted(polygons) == [1, 2]
+    assert all(geom.geom_type == 'MultiPolygon' for geom in polygons.values())
+    assert polygons[1].bounds[2] == pytest.approx(polygons[2].bounds[0])  # side by side along x
+    assert polygons[1].area == pytest.approx(shape(_lonlat_box(0, 0, 5, 10)).area, rel=0.05)
+
+
+def test_zone_field_reports_every_zone():
+    values = np.tile(np.linspace(0, 1, 100), (100, 1))
+    result = zoning.zone_field(_raster(values), n_zones=4, min_area_m2=1000)
+    properties = [f['properties'] for f in result['features']['features']]
+    assert [p['zone'] for p in properties] == [1, 2, 3, 4]
+    assert sum(p['pixels'] for p in properties) == values.size
+    assert sum(p['area_ha'] for p in properties) == pytest.approx(100.0)
+    with pytest.raises(ValueError):
+        zoning.zone_field(_raster(values), method='kmeans')
+
+
+def test_zone_fields_zones_each_field_on_its_own_breaks():
+    values = np.tile(np.linspace(0, 1, 100), (100, 1))
+    vi_data = _raster(values)
+    fields = {'west': _lonlat_box(0, 0, 40, 100), 'east': _lonlat_box(60, 0, 100, 100)}
+    results, features = zoning.zone_fields(vi_data, fields, n_zones=2, min_area_m2=0)
+
+    assert [f['properties']['field'] for f in features['features']] == ['west', 'west', 'east', 'east']
+    # Breaks follow each field's own values, not the whole raster's
+    assert results['west']['breaks'][0] < 0.4 < 0.6 < results['east']['breaks'][0]
+
+    merged = zoning.merge_zones(vi_data, results)
+    assert merged.shape == vi_data.shape and merged.rio.nodata == 0
+    assert (merged.values[:, 42:58] == 0).all()
+    assert set(np.unique(merged.values[:, 2:38])) == {1, 2} and set(np.unique(merged.values[:, 62:98])) == {1, 2}
+
+
+def test_kml_placemarks_become_named_fields():
+    polygon = "<Polygon><outerBoundaryIs><LinearRing><coordinates>{}</coordinates></LinearRing></outerBoundaryIs></Polygon>"
+    ring = "100.0,14.0 100.1,14.0 100.1,14.1 100.0,14.0"
+    kml = ('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+           f'<Placemark><name>North</name>{polygon.format(ring)}</Placemark>'
+           f'<Placemark><name>North</name>{polygon.format(ring)}</Placemark>'
+           f'<Placemark>{polygon.format(ring)}</Placemark>'
+           '<Placemark><name>Well</name><Point><coordinates>100.05,14.05</coordinates></Point></Placemark>'
+           '</Document></kml>')
+    fields = utils.parse_kml_fields(kml.encode())
+    assert list(fields) == ['North', 'North (2)', 'Field 3']
+    assert fields['North']['type'] == 'Polygon'
+    assert utils.parse_kml_to_geometry(kml)['type'] == 'MultiPolygon'
+    assert utils.parse_kml_fields(b'not xml') == {}
@@ -1,51 +1,265 @@
-import pystac_client
-import planetary_computer as pc
-import rioxarray
-import xarray as xr
+# Heavy geospatial and rendering libraries (pystac_client, pystac,
+# rioxarray, xarray, geopandas, shapely, matplotlib) are imported inside the
+# functions that need them so that importing this module stays cheap on cold start.
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import shape, box
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import io
-import matplotlib.pyplot as plt
+import threading
 
-def get_best_item(bbox, target_date, cloud_cover_max=15, days_back=150):
-    """Search for the Sentinel-2 item closest to the target_date within days_back window."""
-    catalog = pystac_client.Client.open("https://planetarycomputer.microsoft.com/api/stac/v1", modifier=pc.sign_inplace)
-    
-    # Calculate start date
+import bandstore
+import cache
+import catalog
+import compute
+import expressions
+import history
+import planner
+import reads
+import signing
+
+def _target_datetime(target_date):
+    """Convert a date or ISO string to a UTC datetime at midnight."""
     if isinstance(target_date, str):
-        target_dt = datetime.fromisoformat(target_date).replace(tzinfo=timezone.utc)
-    else:
-        target_dt = datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
+        return datetime.fromisoformat(target_date).replace(tzinfo=timezone.utc)
+    return datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
+
+# Planetary Computer STAC requests give up after this long (the local index is then used, if any)
+STAC_TIMEOUT_SECONDS = 30
+
+def search_items(bbox, target_date, cloud_cover_max=15, days_back=150):
+    """Return all Sentinel-2 items over bbox within days_back before target_date.
+    With a local scene index (catalog.py), windows inside an area synced up to the window
+    end are answered locally; otherwise the Planetary Computer is queried (mirrored assets
+    still read locally) and the local index is the fallback when that fails or times out.
+    """
+    # Calculate start date
+    target_dt = _target_datetime(target_date)
+    start_dt = target_dt - timedelta(days=days_back)
+    
+    local = catalog.get_local_catalog()
+    if local is not None and local.covers(bbox, start_dt, target_dt):
+        return local.search(bbox, start_dt, target_dt, cloud_cover_max=cloud_cover_max)
+    
+    import pystac_client
+
+    try:
+        # Items are not signed here; load_bands() signs just the assets it reads (see signing.py)
+        client = pystac_client.Client.open(catalog.STAC_API_URL, timeout=STAC_TIMEOUT_SECONDS)
+        
+        # Format for STAC
+        date_range = f"{start_dt.isoformat()}/{target_dt.isoformat()}"
         
-    start_dt = target_dt - pd.Timedelta(days=days_back)
+        search = client.search(
+            collections=[catalog.COLLECTION],
+            bbox=bbox,
+            datetime=date_range,
+            query={"eo:cloud_cover": {"lt": cloud_cover_max}}
+        )
+        items = list(search.get_items())
+    except Exception as e:
+        if local is None:
+            raise
+        print(f"Planetary Computer search failed ({e}); using the local scene index")
+        return local.search(bbox, start_dt, target_dt, cloud_cover_max=cloud_cover_max)
     
-    # Format for STAC
-    date_range = f"{start_dt.isoformat()}/{target_dt.isoformat()}"
+    return items if local is None else [local.localize(item) for item in items]
+
+# Items whose footprint covers at least this share of the AOI count as full coverage
+MIN_COVERAGE = 0.99
+
+def footprint_coverage(items, aoi):
+    """Fraction of the AOI (shapely geometry) covered by each item's footprint geometry,
+    as a dict of item id -> 0..1. Uses prepared geometries so the common cases (footprint
+    fully covers or misses the AOI) need no polygon intersection.
+    """
+    from shapely.geometry import shape
+    from shapely.prepared import prep
     
-    search = catalog.search(
-        collections=["sentinel-2-l2a"],
-        bbox=bbox,
-        datetime=date_range,
-        query={"eo:cloud_cover": {"lt": cloud_cover_max}}
-    )
+    prepared_aoi = prep(aoi)
+    coverage = {}
+    for item in items:
+        footprint = shape(item.geometry)
+        if not prepared_aoi.intersects(footprint):
+            coverage[item.id] = 0.0
+        elif prep(footprint).covers(aoi):
+            coverage[item.id] = 1.0
+        else:
+            coverage[item.id] = footprint.intersection(aoi).area / aoi.area if aoi.area else 0.0
+    return coverage
+
+def rank_by_coverage(items, aoi, target_date, min_coverage=MIN_COVERAGE):
+    """Order items for a single-scene analysis before any raster is read: items that
+    cover the AOI (>= min_coverage) nearest to target_date first, then partial items by
+    decreasing coverage. Items that miss the AOI are dropped. Returns (items, coverage).
+    """
+    target_dt = _target_datetime(target_date)
+    coverage = footprint_coverage(items, aoi)
+    
+    def rank(item):
+        partial = coverage[item.id] < min_coverage
+        return (partial, -coverage[item.id] if partial else 0.0, abs(item.datetime - target_dt))
     
-    items = list(search.get_items())
+    return sorted((item for item in items if coverage[item.id] > 0), key=rank), coverage
+
+def get_best_item(bbox, target_date, cloud_cover_max=15, days_back=150, geometry=None):
+    """Search for the Sentinel-2 item closest to the target_date within days_back window.
+    The search is by bbox, so candidates are ranked by how much of the AOI (geometry, or
+    bbox) their footprint actually covers: the nearest fully covering item wins, and a
+    partial item is only returned when none covers the AOI.
+    """
+    from shapely.geometry import shape, box
+    
+    items = search_items(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back)
     if not items:
         return None
-        
-    # Find item closest to target_date
-    closest_item = min(
-        items,
-        key=lambda item: abs(item.datetime - target_dt)
-    )
     
-    return closest_item
+    aoi = shape(geometry) if geometry else box(*bbox)
+    ranked, coverage = rank_by_coverage(items, aoi, target_date)
+    if not ranked:
+        return None
+    best = ranked[0]
+    if coverage[best.id] < MIN_COVERAGE:
+        print(f"No image fully covers the AOI; using {best.id} ({coverage[best.id]:.0%} coverage)")
+    return best
+
+def get_mosaic_items(bbox, target_date, cloud_cover_max=15, days_back=150, geometry=None, priority='cloud'):
+    """Select the smallest set of items whose footprints together cover the AOI.
+    Items from a single acquisition date are preferred, nearest date first; if no
+    single date covers the AOI, items from the nearest dates are combined.
+    Returns items in compositing order: least cloudy first (priority='cloud') or
+    nearest date first (priority='date'). Returns [] if nothing was found.
+    """
+    from shapely.geometry import shape, box
+    
+    items = search_items(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back)
+    if not items:
+        return []
+    
+    aoi = shape(geometry) if geometry else box(*bbox)
+    target_dt = _target_datetime(target_date)
+    
+    # Drop items whose footprint misses the AOI before doing any polygon set operations
+    coverage = footprint_coverage(items, aoi)
+    items = [item for item in items if coverage[item.id] > 0]
+    if not items:
+        return []
+    footprints = {item.id: shape(item.geometry) for item in items}
+    
+    # A single item covering the AOI needs no mosaic
+    full = [item for item in items if coverage[item.id] >= MIN_COVERAGE]
+    if full:
+        return [min(full, key=lambda it: abs(it.datetime - target_dt))]
+    
+    def sort_key(item):
+        date_distance = abs(item.datetime - target_dt)
+        if priority == 'date':
+            return (date_distance, item.properties['eo:cloud_cover'])
+        return (item.properties['eo:cloud_cover'], date_distance)
+    
+    def greedy_cover(candidates):
+        # Repeatedly take the footprint that covers the most still-uncovered area
+        remaining = aoi
+        chosen = []
+        candidates = sorted(candidates, key=sort_key)
+        while candidates and remaining.area > aoi.area * 1e-3:
+            best = max(candidates, key=lambda it: footprints[it.id].intersection(remaining).area)
+            gain = footprints[best.id].intersection(remaining).area
+            if gain <= 0:
+                break
+            chosen.append(best)
+            candidates.remove(best)
+            remaining = remaining.difference(footprints[best.id])
+        return chosen, remaining.area <= aoi.area * 1e-3
+    
+    # Same-date sets, nearest date first
+    by_date = {}
+    for item in items:
+        by_date.setdefault(item.datetime.date(), []).append(item)
+    for day in sorted(by_date, key=lambda d: abs(by_date[d][0].datetime - target_dt)):
+        chosen, covered = greedy_cover(by_date[day])
+        if covered:
+            return sorted(chosen, key=sort_key)
+    
+    # Otherwise combine nearest dates until the AOI is covered (or nothing more helps)
+    chosen = []
+    remaining = aoi
+    for item in sorted(items, key=lambda it: abs(it.datetime - target_dt)):
+        footprint = footprints[item.id]
+        if footprint.intersection(remaining).area > 0:
+            chosen.append(item)
+            remaining = remaining.difference(footprint)
+            if remaining.area <= aoi.area * 1e-3:
+                break
+    return sorted(chosen, key=sort_key)
+
+# Multi-part AOIs (see read_windows): nearby parts are grouped while a group's box is at most
+# WINDOW_MERGE_WASTE empty, and the groups are read as separate windows only when that skips
+# at least MIN_WINDOW_SAVING of the envelope
+WINDOW_MERGE_WASTE = 0.5
+MIN_WINDOW_SAVING = 0.25
+MAX_READ_WINDOWS = 16
+MAX_WINDOW_PARTS = 256
+
+def read_windows(geometry, bbox=None):
+    """Lon/lat boxes covering the parts of a MultiPolygon AOI, one per cluster of nearby parts,
+    or None when a single read of the envelope (bbox) is about as cheap (one part, parts close
+    together or too many parts). Parts are merged greedily, cheapest merge first.
+    """
+    from shapely.geometry import shape
+
+    if not geometry:
+        return None
+    # Pure function of the geometry, asked for on every rerun (pre-flight plan) and every run
+    key = cache.make_key('read_windows', geometry_hash(geometry), bbox)
+    cached = cache.shared.get(key)
+    if cached is not None:
+        return cached[0]
+    
+    geom = shape(geometry)
+    parts = [part for part in getattr(geom, 'geoms', [geom]) if not part.is_empty]
+    windows = None
+    if 2 <= len(parts) <= MAX_WINDOW_PARTS:
+        windows = _merge_windows(parts, bbox if bbox is not None else geom.bounds)
+    cache.shared.put(key, (windows,))
+    return windows
+
+def _merge_windows(parts, envelope):
+    """read_windows() for 2..MAX_WINDOW_PARTS parts and the envelope bbox."""
+
+    boxes = np.array([part.bounds for part in parts], dtype=np.float64)
+
+    def area(b):
+        return (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+
+    while len(boxes) > 1:
+        # Union box of every pair and the empty area it would add
+        union = np.concatenate([np.minimum(boxes[:, None, :2], boxes[None, :, :2]),
+                                np.maximum(boxes[:, None, 2:], boxes[None, :, 2:])], axis=-1)
+        union_area = area(union)
+        waste = union_area - area(boxes)[:, None] - area(boxes)[None, :]
+        waste[np.diag_indices(len(boxes))] = np.inf
+        i, j = np.unravel_index(np.argmin(waste), waste.shape)
+        if waste[i, j] > WINDOW_MERGE_WASTE * union_area[i, j] and len(boxes) <= MAX_READ_WINDOWS:
+            break
+        boxes = np.vstack([np.delete(boxes, [i, j], axis=0), union[i, j]])
+
+    envelope = np.array(envelope, dtype=np.float64)
+    if len(boxes) < 2 or area(boxes).sum() > (1 - MIN_WINDOW_SAVING) * area(envelope):
+        return None
+    return [[round(float(v), 6) for v in b] for b in boxes]
+
+def load_bands(item, bands, bbox, progress=None, overview_level=None, max_workers=4, geometry=None):
+    """Load specific bands for the item, clipped to bbox, up to max_workers bands at a time.
+    progress(band_name, done, total) is called after each band if given.
+    overview_level reads a coarser COG overview instead of full resolution
+    (0 = 1/2 resolution, 1 = 1/4, 2 = 1/8, ...).
+    For scattered multi-part AOIs (see read_windows) only the windows around the parts are
+    read, concurrently, and placed on the bbox grid with nodata (0) in between, so the bytes
+    read scale with the fields rather than their envelope.
+    """
+    import geopandas as gpd
+    from shapely.geometry import box
 
-def load_bands(item, bands, bbox):
-    """Load specific bands for the item, clipped to bbox."""
     # We use the item's assets directly
     # bands is a list like ['B04', 'B08']
     
@@ -53,43 +267,1155 @@ def load_bands(item, bands, bbox):
     bands_to_load = list(set(bands + ['SCL']))
     
     loaded_bands = {}
+    store = bandstore.get_band_store()
     
     # Create bbox gdf for clipping
     bbox_geom = box(*bbox)
     bbox_gdf = gpd.GeoDataFrame(geometry=[bbox_geom], crs="EPSG:4326")
+    windows = read_windows(geometry, bbox)
+    window_gdfs = [gpd.GeoDataFrame(geometry=[box(*w)], crs="EPSG:4326") for w in windows or ()]
+    
+    def read(href):
+        # Each window read has a deadline, is hedged when slow and retried on transient errors
+        if not windows:
+            return reads.reader.call(_read_window, href, bbox_gdf, overview_level)
+        return _read_parts(href, bbox_gdf, window_gdfs, overview_level, parts_pool)
+    
+    def load(band_name):
+        # Shared across sessions: the same item/band/bbox is only downloaded once per process
+        key = band_cache_key(item.id, band_name, bbox, overview_level=overview_level, windows=windows)
+        cached = cache.shared.get(key)
+        if cached is not None:
+            return cached
+        
+        # Then the on-disk store of decoded windows (memory-mapped, survives restarts)
+        data = store.get(key) if store is not None else None
+        if data is not None:
+            # Pixels of a memmap live in the page cache, not the heap: charge only the coordinates
+            cache.shared.put(key, data, nbytes=data['y'].nbytes + data['x'].nbytes)
+            return data
+        
+        # Sign only the asset being read, with the cached collection token; re-sign once on 403
+        href = item.assets[band_name].href
+        collection = item.collection_id or catalog.COLLECTION
+        try:
+            data = read(signing.sign_href(href, collection))
+        except Exception as e:
+            if not (signing.is_blob_href(href) and signing.is_auth_error(e)):
+                raise
+            signing.tokens.invalidate(collection)
+            data = read(signing.sign_href(href, collection))
+        if store is not None:
+            store.put(key, data, item.id, band_name, [round(float(v), 6) for v in bbox], resolution=overview_level)
+        
+        cache.shared.put(key, data)
+        return data
+    
+    # Bands are independent reads, so fetch them concurrently
+    names = [band_name for band_name in bands_to_load if band_name in item.assets]
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names))), thread_name_prefix="bands")
+    # Windows of one band are read concurrently too (a separate pool: band reads wait on them)
+    parts_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="parts") if windows else None
+    try:
+        futures = {pool.submit(load, band_name): band_name for band_name in names}
+        for future in as_completed(futures):
+            loaded_bands[futures[future]] = future.result()
+            if progress is not None:
+                progress(futures[future], len(loaded_bands), len(names))
+    finally:
+        # On an error or a cancelled job, drop the reads that have not started yet
+        pool.shutdown(wait=True, cancel_futures=True)
+        if parts_pool is not None:
+            parts_pool.shutdown(wait=True, cancel_futures=True)
+    
+    return {band_name: loaded_bands[band_name] for band_name in names}
+
+def _read_window(href, bbox_gdf, overview_level=None):
+    """Read the part of a single-band raster covered by bbox_gdf into memory."""
+    import rioxarray
+    
+    # Open with rioxarray; lock=False: the default process-wide lock serializes reads, so
+    # concurrent band/part reads (and hedged duplicates, see reads.py) would queue behind each other
+    with rioxarray.open_rasterio(href, overview_level=overview_level, lock=False) as da:
+        # Reproject bbox to raster CRS
+        raster_crs = da.rio.crs
+        bbox_reproj = bbox_gdf.to_crs(raster_crs)
+        minx, miny, maxx, maxy = bbox_reproj.geometry[0].bounds
+        
+        # Clip to bbox
+        clipped = da.rio.clip_box(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+        
+        # Squeeze to remove band dimension (1, y, x) -> (y, x)
+        # and read the window now so the cached copy holds real data
+        return clipped.squeeze().load()
+
+def _empty_window(href, bbox_gdf, overview_level=None):
+    """Zero-filled grid of the window _read_window() would read, and the pixel size.
+    Only the raster header is read.
+    """
+    import rioxarray
+    
+    with rioxarray.open_rasterio(href, overview_level=overview_level) as da:
+        minx, miny, maxx, maxy = bbox_gdf.to_crs(da.rio.crs).geometry[0].bounds
+        envelope = da.rio.clip_box(minx=minx, miny=miny, maxx=maxx, maxy=maxy).squeeze()
+        return envelope.copy(data=np.zeros(envelope.shape, dtype=envelope.dtype)), da.rio.resolution()
+
+def _read_parts(href, bbox_gdf, window_gdfs, overview_level, pool):
+    """Read only the windows in window_gdfs (concurrently, on pool) and paste them onto the
+    grid _read_window() would return for bbox_gdf, filled with 0 (nodata) elsewhere.
+    """
+    from rioxarray.exceptions import NoDataInBounds
+    
+    out, (res_x, res_y) = reads.reader.call(_empty_window, href, bbox_gdf, overview_level)
+    
+    def read(gdf):
+        try:
+            return reads.reader.call(_read_window, href, gdf, overview_level)
+        except NoDataInBounds:
+            return None  # Part outside this scene
+    
+    x0, y0 = float(out.x[0]), float(out.y[0])
+    height, width = out.shape
+    for part in pool.map(read, window_gdfs):
+        if part is None or part.ndim != 2:
+            continue
+        # Same raster, so the window is a pixel-aligned offset into the envelope grid
+        col = int(round((float(part.x[0]) - x0) / res_x))
+        row = int(round((float(part.y[0]) - y0) / res_y))
+        top, left = max(row, 0), max(col, 0)
+        bottom, right = min(row + part.shape[0], height), min(col + part.shape[1], width)
+        if bottom > top and right > left:
+            out.values[top:bottom, left:right] = part.values[top - row:bottom - row, left - col:right - col]
+    return out
+
+def _read_block(href, window):
+    """One window of band 1 of a raster (a chunk of load_bands_chunked)."""
+    import rasterio
+    
+    with rasterio.open(href) as src:
+        return src.read(1, window=window)
+
+def load_bands_chunked(item, bands, bbox, chunk_size=None):
+    """Open bands (plus SCL) clipped to bbox as lazy dask-backed arrays in chunk_size tiles.
+    Nothing is read until the result is computed, then only chunk by chunk. Used for
+    areas too large for load_bands (see planner.py); bypasses the band caches.
+    Every chunk is signed when it is read (and re-signed once on 403), so a token that
+    expires between opening and computing does not fail the run.
+    """
+    import dask.array
+    import geopandas as gpd
+    import rioxarray
+    from rasterio.windows import Window
+    from shapely.geometry import box
+    
+    chunk_size = chunk_size or planner.CHUNK_SIZE
+    bbox_gdf = gpd.GeoDataFrame(geometry=[box(*bbox)], crs="EPSG:4326")
+    collection = item.collection_id or catalog.COLLECTION
+    
+    def signed(fn, href):
+        try:
+            return fn(signing.sign_href(href, collection))
+        except Exception as e:
+            if not (signing.is_blob_href(href) and signing.is_auth_error(e)):
+                raise
+            signing.tokens.invalidate(collection)
+            return fn(signing.sign_href(href, collection))
+    
+    def open_band(href):
+        # Opened once for the grid and metadata; the pixels are read per chunk below
+        da = rioxarray.open_rasterio(href, chunks={'band': 1, 'y': chunk_size, 'x': chunk_size}, lock=False)
+        minx, miny, maxx, maxy = bbox_gdf.to_crs(da.rio.crs).geometry[0].bounds
+        clipped = da.rio.clip_box(minx=minx, miny=miny, maxx=maxx, maxy=maxy).squeeze('band', drop=True)
+        full, window = da.rio.transform(), clipped.rio.transform()
+        offset = (round((window.f - full.f) / full.e), round((window.c - full.c) / full.a))
+        return clipped, offset
+    
+    def lazy_band(href, clipped, offset):
+        def read_chunk(block_info=None):
+            (row_start, row_stop), (col_start, col_stop) = block_info[None]['array-location']
+            window = Window(offset[1] + col_start, offset[0] + row_start, col_stop - col_start, row_stop - row_start)
+            return signed(lambda signed_href: reads.reader.call(_read_block, signed_href, window), href)
+        
+        data = dask.array.map_blocks(read_chunk, chunks=clipped.data.chunks, dtype=clipped.dtype,
+                                     meta=np.empty((0, 0), dtype=clipped.dtype))
+        return clipped.copy(data=data)
     
-    for band_name in bands_to_load:
+    loaded = {}
+    for band_name in dict.fromkeys(list(bands) + ['SCL']):
         if band_name not in item.assets:
             continue
-            
         href = item.assets[band_name].href
-        # Open with rioxarray
+        loaded[band_name] = lazy_band(href, *signed(open_band, href))
+    return loaded
+
+def _grid_template(bbox, crs, resolution):
+    """Empty (NaN) DataArray covering bbox (EPSG:4326) on a grid in crs with the given
+    pixel size, snapped to multiples of the pixel size so it lines up with Sentinel-2 tiles.
+    """
+    import math
+    import xarray as xr
+    import rioxarray  # noqa: F401  (registers the .rio accessor)
+    from affine import Affine
+    from rasterio.warp import transform_bounds
+    
+    xres, yres = abs(resolution[0]), abs(resolution[1])
+    minx, miny, maxx, maxy = transform_bounds("EPSG:4326", crs, *bbox)
+    minx = math.floor(minx / xres) * xres
+    maxy = math.ceil(maxy / yres) * yres
+    width = max(1, math.ceil((maxx - minx) / xres))
+    height = max(1, math.ceil((maxy - miny) / yres))
+    
+    template = xr.DataArray(
+        np.full((height, width), np.nan, dtype="float32"),
+        coords={'y': maxy - (np.arange(height) + 0.5) * yres, 'x': minx + (np.arange(width) + 0.5) * xres},
+        dims=('y', 'x')
+    )
+    template = template.rio.write_crs(crs)
+    return template.rio.write_transform(Affine(xres, 0, minx, 0, -yres, maxy))
+
+def _reproject_to_grid(da, template, nodata=0):
+    """Reproject a band onto template's grid; nodata pixels become NaN."""
+    from rasterio.enums import Resampling
+    
+    data = da.astype("float32").where(da != nodata)
+    data = data.rio.write_nodata(np.nan, encoded=False)
+    reprojected = data.rio.reproject_match(template, resampling=Resampling.nearest)
+    # Reprojection recomputes coordinates from the transform; reuse the template's exactly
+    return reprojected.assign_coords(x=template.x, y=template.y)
+
+def load_bands_mosaic(items, bands, bbox, max_workers=4, progress=None):
+    """Load bands from several items onto one common grid and composite them.
+    items must be in priority order (see get_mosaic_items): each pixel takes its value
+    from the first item that has valid data there. The grid uses the CRS of the first
+    item and each band's native resolution. Item windows are read in parallel.
+    progress(done, total) is called after each item is read if given.
+    """
+    per_item = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mosaic") as pool:
+        futures = {pool.submit(load_bands, item, bands, bbox): idx for idx, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            per_item[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(items))
+    
+    mosaic = {}
+    for band_name in set(bands + ['SCL']):
+        layers = [loaded[band_name] for loaded in per_item if band_name in loaded]
+        if not layers:
+            continue
+        
+        template = _grid_template(bbox, layers[0].rio.crs, layers[0].rio.resolution())
+        composite = template
+        for layer in layers:
+            composite = composite.fillna(_reproject_to_grid(layer, template))
+        mosaic[band_name] = composite.rio.write_crs(template.rio.crs).rio.write_transform(template.rio.transform())
+    
+    return mosaic
+
+def band_cache_key(item_id, band_name, bbox, overview_level=None, windows=None):
+    """Shared-cache key for one band of an item clipped to bbox (at an optional overview level,
+    and read only within windows for multi-part AOIs, see read_windows)."""
+    key = ['band', item_id, band_name, [round(float(v), 6) for v in bbox], overview_level]
+    return cache.make_key(*key, windows) if windows else cache.make_key(*key)
+
+def result_cache_key(item_id, vi_name, bbox, geometry=None, overview_level=None):
+    """Shared-cache key for an index computed from an item over bbox/geometry."""
+    geom_key = geometry_hash(geometry) if geometry else None
+    return cache.make_key('result', item_id, vi_name, [round(float(v), 6) for v in bbox], geom_key, overview_level)
+
+def _vi_key(vi_name, expression=None):
+    """Index identity for cache keys: a custom expression is part of it, not just its label."""
+    return vi_name if expression is None else f"{vi_name}={expressions.normalize(expression)}"
+
+def _vi_keys(vi_name, expression=None):
+    """_vi_key() for one index or a list of indices computed together (see run_analysis)."""
+    vi_names, vi_expressions = _vi_request(vi_name, expression)
+    return "+".join(_vi_key(name, vi_expressions.get(name)) for name in vi_names)
+
+# geometry_hash() results by id() of the GeoJSON dict, which is kept so the id cannot be reused.
+# Geometry dicts are replaced, never modified in place, so every Streamlit rerun (and every
+# call during one analysis) hashes a large boundary only once
+_GEOMETRY_HASH_MEMO_MAX = 64
+_geometry_hash_memo = {}
+_geometry_hash_lock = threading.Lock()
+
+def geometry_hash(geometry):
+    """Stable hash of a GeoJSON geometry (coordinates rounded to ~1 cm)."""
+    import hashlib
+    import shapely
+    from shapely.geometry import shape
+    
+    with _geometry_hash_lock:
+        memo = _geometry_hash_memo.get(id(geometry))
+    if memo is not None and memo[0] is geometry:
+        return memo[1]
+    
+    geom = shapely.set_precision(shape(geometry), 1e-7).normalize()
+    digest = hashlib.sha1(geom.wkb).hexdigest()
+    with _geometry_hash_lock:
+        _geometry_hash_memo[id(geometry)] = (geometry, digest)
+        if len(_geometry_hash_memo) > _GEOMETRY_HASH_MEMO_MAX:
+            del _geometry_hash_memo[next(iter(_geometry_hash_memo))]
+    return digest
+
+# Speculative prefetch: scene searches (and optionally band reads) started in a
+# background worker as soon as the AOI or date changes, keyed by the search inputs.
+_PREFETCH_MAX_ENTRIES = 32
+_prefetch_lock = threading.Lock()
+_prefetch_executor = None
+_prefetch_futures = {}
+
+def _prefetch_key(bbox, target_date, cloud_cover_max, days_back, geometry=None):
+    return (tuple(round(float(v), 6) for v in bbox), str(target_date), cloud_cover_max, days_back,
+            geometry_hash(geometry) if geometry else None)
+
+def _prefetch_worker(bbox, target_date, cloud_cover_max, days_back, bands, geometry=None):
+    item = get_best_item(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back,
+                         geometry=geometry)
+    bands_data = None
+    if item is not None and bands and planner.plan(bbox, bands, windows=read_windows(geometry, bbox))['mode'] == planner.FULL:
+        bands_data = load_bands(item, list(bands), bbox, geometry=geometry)
+    return {'item': item, 'bands': tuple(bands), 'bands_data': bands_data}
+
+def prefetch_scene(bbox, target_date, cloud_cover_max=15, days_back=150, bands=None, geometry=None):
+    """Start searching for the best item (and optionally loading bands) in the background.
+    Repeated calls with the same inputs reuse the running or finished prefetch.
+    Returns a concurrent.futures.Future.
+    """
+    global _prefetch_executor
+    bands = tuple(sorted(bands or ()))
+    key = _prefetch_key(bbox, target_date, cloud_cover_max, days_back, geometry) + (bands,)
+    
+    with _prefetch_lock:
+        future = _prefetch_futures.get(key)
+        if future is not None:
+            return future
+        
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+        future = _prefetch_executor.submit(_prefetch_worker, bbox, target_date, cloud_cover_max, days_back,
+                                           bands, geometry)
+        _prefetch_futures[key] = future
         
-        with rioxarray.open_rasterio(href) as da:
-            # Reproject bbox to raster CRS
-            raster_crs = da.rio.crs
-            bbox_reproj = bbox_gdf.to_crs(raster_crs)
-            minx, miny, maxx, maxy = bbox_reproj.geometry[0].bounds
+        # Forget the oldest prefetches (dicts keep insertion order)
+        while len(_prefetch_futures) > _PREFETCH_MAX_ENTRIES:
+            _prefetch_futures.pop(next(iter(_prefetch_futures)))
+    
+    # Outside the lock: the callback runs right away if the prefetch already finished
+    future.add_done_callback(lambda f: _forget_failed_prefetch(key, f))
+    return future
+
+def _forget_failed_prefetch(key, future):
+    """Drop a prefetch that failed or found nothing (often a transient search error), so the
+    next prefetch or analysis for these inputs searches again.
+    """
+    if future.cancelled() or future.exception() is not None or future.result()['item'] is None:
+        with _prefetch_lock:
+            if _prefetch_futures.get(key) is future:
+                del _prefetch_futures[key]
+
+def get_prefetched_scene(bbox, target_date, cloud_cover_max=15, days_back=150, bands=None, timeout=None,
+                         geometry=None):
+    """Return a prefetched result dict with 'item' and 'bands_data' for these search inputs.
+    Waits for a prefetch that is still running. 'bands_data' is None unless the prefetch
+    loaded all requested bands. Returns None if nothing was prefetched or it failed.
+    """
+    scene_key = _prefetch_key(bbox, target_date, cloud_cover_max, days_back, geometry)
+    wanted = set(bands or ())
+    
+    with _prefetch_lock:
+        candidates = [(key[-1], fut) for key, fut in _prefetch_futures.items() if key[:-1] == scene_key]
+    if not candidates:
+        return None
+    
+    # Prefer a prefetch that already covers the requested bands
+    candidates.sort(key=lambda c: not wanted.issubset(c[0]))
+    try:
+        result = candidates[0][1].result(timeout=timeout)
+    except Exception as e:
+        print(f"Prefetch failed: {e}")
+        return None
+    if result['item'] is None:
+        # Searched again by the caller rather than trusting a possibly transient empty result
+        return None
+    
+    bands_data = result['bands_data'] if wanted and wanted.issubset(result['bands']) else None
+    return {'item': result['item'], 'bands_data': bands_data}
+
+def plan_analysis(bbox, vi_name, bands, expression=None, analysis='single', mosaic=False, method='max',
+                  max_workers=4, geometry=None):
+    """Pre-flight plan (planner.plan) for run_analysis ('single'), run_change_detection
+    ('change') or run_composite ('composite') with the same arguments. No I/O.
+    """
+    # Multi-part AOIs read only the windows around their parts (mosaics read the envelope)
+    windows = None if mosaic else read_windows(geometry, bbox)
+    if analysis == 'change':
+        # Both dates are held in memory at once, and there is no chunked path for the comparison.
+        # Result: float64 index of both dates, difference and ratio
+        return planner.plan(bbox, bands, scenes=2, allow_chunked=False, windows=windows, result_bytes_per_pixel=32)
+    if analysis == 'composite':
+        # The first scene plus max_workers scenes in flight, and the reducer state.
+        # Result: float32 composite and clear-observation count
+        return planner.plan(bbox, bands, scenes=max_workers + 1, allow_chunked=False,
+                            extra_bytes_per_pixel=_COMPOSITE_STATE_BYTES[method], windows=windows,
+                            result_bytes_per_pixel=8)
+    
+    vi_names, vi_expressions = _vi_request(vi_name, expression)
+    # The chunked path evaluates indices block by block, which needs their bands on one grid
+    same_grid = all(
+        len({expressions.BANDS.get(b) for b in vi_required_bands(name, vi_expressions.get(name))}) == 1
+        for name in vi_names
+    )
+    return planner.plan(bbox, bands, n_indices=len(vi_names), allow_chunked=same_grid and not mosaic,
+                        windows=windows)
+
+class AnalysisError(Exception):
+    """Raised when an analysis cannot produce a result (e.g. no suitable image)."""
+
+def _store_result(result_key, entry):
+    """Put a result's arrays in the shared cache. Returns the extra metadata: {} when cached,
+    {'data': entry} when the entry is larger than the whole cache budget, so the result is
+    handed over with the job instead of being dropped (see result_data).
+    """
+    if cache.shared.put(result_key, entry):
+        return {}
+    print(f"Result {result_key[:12]} is larger than the shared cache budget (PALANTIR_CACHE_MB); not cached")
+    return {'data': entry}
+
+def result_data(metadata):
+    """Arrays and statistics of an analysis result: carried in the metadata when they did not
+    fit the shared cache, otherwise looked up there. None once evicted.
+    """
+    if metadata.get('data') is not None:
+        return metadata['data']
+    return cache.shared.get(metadata['result_key'])
+
+def run_analysis(bbox, geometry, target_date, vi_name, bands, cloud_cover_max=15, days_back=150,
+                 use_prefetch=False, mosaic=False, mosaic_priority='cloud', progressive=False,
+                 preview_level=2, expression=None, progress=None, field_id=None):
+    """Full pipeline for one index: search -> load bands -> calculate -> clip to geometry.
+    Arrays are stored in the shared cache; the returned dict holds only the cache key
+    ('result_key') and small metadata. progress(stage, message, fraction) is called at
+    each stage and after each band. With mosaic=True, all items needed to cover the AOI
+    are composited (see get_mosaic_items). With progressive=True, a coarse result is first
+    computed from COG overview level preview_level and passed on as
+    progress('preview', message, fraction, partial=<metadata>) before the full-resolution
+    run. expression computes a user-defined index labelled vi_name (see expressions.py).
+    vi_name may also be a list of index names: the scene is resolved and the union of
+    their bands (the bands argument) is loaded once, then all indices are calculated in
+    one pass; expression is then a dict of name -> expression for user-defined ones.
+    Before any I/O the run is planned against the memory/transfer budgets (planner.py):
+    large areas are computed chunk by chunk or from a COG overview, and areas too large
+    for any of these are refused. The plan is returned under 'plan'.
+    The statistics of the result are appended to the history store (history.py) under
+    field_id (default: a prefix of the geometry hash).
+    Raises AnalysisError when no result can be produced.
+    """
+    plan = plan_analysis(bbox, vi_name, bands, expression=expression, mosaic=mosaic, geometry=geometry)
+    if plan['mode'] == planner.TOO_LARGE:
+        raise AnalysisError(planner.describe(plan))
+    
+    if mosaic:
+        if plan['mode'] != planner.FULL:
+            raise AnalysisError(f"Area too large for mosaic mode ({planner.describe(plan)}). "
+                                f"Turn off mosaic to analyse it at reduced resolution.")
+        result = _run_mosaic_analysis(bbox, geometry, target_date, vi_name, bands, cloud_cover_max,
+                                      days_back, mosaic_priority, progress, expression=expression)
+        _record_history(result, geometry, field_id)
+        return {**result, 'plan': plan}
+    
+    def report(stage, message, fraction):
+        if progress is not None:
+            progress(stage, message, fraction)
+    
+    report('plan', planner.describe(plan), 0.0)
+    overview_level = plan['overview_level']
+    chunked = plan['mode'] == planner.CHUNKED
+    
+    # 1. Search for best image (reuse the background prefetch when available)
+    prefetched = None
+    if use_prefetch:
+        prefetched = get_prefetched_scene(bbox, target_date, cloud_cover_max=cloud_cover_max,
+                                          days_back=days_back, bands=bands, geometry=geometry)
+    if prefetched is not None:
+        report('search', "Using prefetched image search...", 0.0)
+        item = prefetched['item']
+    else:
+        report('search', f"Searching for best image (last {days_back} days)...", 0.0)
+        item = get_best_item(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back,
+                             geometry=geometry)
+    
+    if item is None:
+        raise AnalysisError(
+            f"No suitable images found within {days_back} days of target date (Cloud Cover < {cloud_cover_max}%)."
+        )
+    
+    report('search', f"Found Image: **{item.datetime.date()}** (Cloud Cover: {item.properties['eo:cloud_cover']:.1f}%)", 0.1)
+    # Prefetched bands are full resolution; they only apply when the plan reads full resolution in memory
+    prefetched_bands = prefetched['bands_data'] if prefetched is not None and plan['mode'] == planner.FULL else None
+    
+    if progressive and prefetched_bands is None and (overview_level is None or overview_level < preview_level):
+        # Coarse overview first so there is something to look at within a couple of seconds
+        preview = _analyze_item(item, bbox, geometry, vi_name, bands, report, overview_level=preview_level,
+                                start=0.1, end=0.3, label="preview ", expression=expression)
+        if progress is not None:
+            progress('preview', "Preview ready, computing full resolution...", 0.3, partial=preview)
+        result = _analyze_item(item, bbox, geometry, vi_name, bands, report, overview_level=overview_level,
+                               chunked=chunked, start=0.3, expression=expression)
+    else:
+        result = _analyze_item(item, bbox, geometry, vi_name, bands, report, prefetched_bands=prefetched_bands,
+                               overview_level=overview_level, chunked=chunked, expression=expression)
+    
+    report('done', "Analysis Complete!", 1.0)
+    _record_history(result, geometry, field_id)
+    return {**result, 'plan': plan}
+
+# Result keys already written to the history store by this process (bounded, oldest dropped first)
+_HISTORY_RECORDED_MAX = 4096
+_history_recorded = {}
+_history_lock = threading.Lock()
+
+def _record_history(metadata, geometry, field_id=None):
+    """Append the statistics of a finished analysis to the history store, once per result.
+    Failures are printed and do not fail the analysis.
+    """
+    store = history.get_history_store()
+    entry = result_data(metadata)
+    if store is None or not geometry or entry is None:
+        return
+    with _history_lock:
+        if metadata['result_key'] in _history_recorded:
+            return
+        _history_recorded[metadata['result_key']] = True
+        if len(_history_recorded) > _HISTORY_RECORDED_MAX:
+            del _history_recorded[next(iter(_history_recorded))]
+    try:
+        store.append(history.rows_from_result(metadata, entry['vi_stats'], geometry_hash(geometry), field_id,
+                                              metadata.get('overview_level')))
+    except Exception as e:
+        print(f"Could not record history: {e}")
+
+def _vi_request(vi_name, expression=None):
+    """(names, {name: expression}) for one index name or a list of names (see run_analysis)."""
+    if isinstance(vi_name, (list, tuple)):
+        return list(vi_name), dict(expression or {})
+    return [vi_name], ({vi_name: expression} if expression is not None else {})
+
+def _calculate_result(bands_data, vi_name, expression, geometry, report, at, label="", chunked=False):
+    """Calculate and clip the requested indices (steps 3-4 of run_analysis).
+    Returns the shared-cache entry: the first index as 'vi_data_overall'/'stats' and
+    all of them in 'vis'/'vi_stats'. With chunked=True, bands_data holds lazy arrays
+    (load_bands_chunked); the indices are computed chunk by chunk into float32 arrays
+    and the raw bands are not kept.
+    """
+    vi_names, vi_expressions = _vi_request(vi_name, expression)
+    
+    # 3. Calculate VIs from bbox-clipped bands (bands converted once for all indices)
+    report('calculate', f"Calculating {label}{', '.join(vi_names)}...", at(0.8))
+    vis = calculate_vis(bands_data, vi_names, vi_expressions)
+    failed = [name for name, vi in vis.items() if vi is None]
+    if failed:
+        raise AnalysisError(f"Failed to calculate {', '.join(failed)}. Please check if all required bands are available.")
+    
+    # 4. Clip VIs to polygon (if drawn)
+    if geometry:
+        report('clip', f"Clipping {label}result to polygon boundary...", at(0.9))
+        vis = {name: clip_to_geometry(vi, geometry) for name, vi in vis.items()}
+    
+    if chunked:
+        import dask
+        
+        report('calculate', f"Computing {label}{', '.join(vi_names)} chunk by chunk...", at(0.9))
+        # One graph for all indices, so every band chunk is read once
+        computed = dask.compute(*(vi.astype(np.float32) for vi in vis.values()),
+                                scheduler='threads', num_workers=planner.CHUNK_WORKERS)
+        vis = dict(zip(vis, computed))
+        bands_data = {}
+    
+    vi_stats = {name: compute_stats(vi) for name, vi in vis.items()}
+    return {
+        'vi_data_overall': vis[vi_names[0]], 'bands_data': bands_data, 'stats': vi_stats[vi_names[0]],
+        'vis': vis, 'vi_stats': vi_stats,
+    }
+
+def _result_metadata(vi_name, expression):
+    vi_names, vi_expressions = _vi_request(vi_name, expression)
+    return {
+        'selected_vi': vi_names[0],
+        'selected_vis': vi_names,
+        'expression': vi_expressions.get(vi_names[0]),
+        'expressions': vi_expressions,
+    }
+
+def _analyze_item(item, bbox, geometry, vi_name, bands, report, prefetched_bands=None, overview_level=None,
+                  start=0.1, end=1.0, label="", expression=None, chunked=False):
+    """Load bands, calculate and clip the index (or indices) for a resolved item
+    (steps 2-4 of run_analysis). Progress fractions are reported within [start, end].
+    chunked=True reads full resolution lazily and computes chunk by chunk (planner.py).
+    Returns result metadata.
+    """
+    def at(fraction):
+        return start + (end - start) * fraction
+    
+    # Results are shared across sessions; another user may already have computed this one
+    result_key = result_cache_key(item.id, _vi_keys(vi_name, expression), bbox, geometry, overview_level=overview_level)
+    uncached = {}
+    if result_key in cache.shared:
+        report('cache', f"Reusing cached {label}results for this image and area...", at(0.9))
+    else:
+        # 2. Load Bands (bbox clipped)
+        if prefetched_bands is not None:
+            report('download', "Using prefetched band data...", at(0.8))
+            bands_data = prefetched_bands
+        elif chunked:
+            report('download', f"Opening {label}band data for chunked reading...", at(0.0))
+            bands_data = load_bands_chunked(item, bands, bbox)
+        else:
+            report('download', f"Downloading {label}band data...", at(0.0))
+            bands_data = load_bands(
+                item, bands, bbox, overview_level=overview_level, geometry=geometry,
+                progress=lambda band, done, total: report(
+                    'download', f"Downloaded {label}{band} ({done}/{total})", at(0.8 * done / total)
+                )
+            )
+        
+        uncached = _store_result(result_key, _calculate_result(bands_data, vi_name, expression, geometry, report,
+                                                               at, label, chunked=chunked))
+    
+    return {
+        'result_key': result_key,
+        'item_id': item.id,
+        'item_date': item.datetime.date(),
+        'cloud_cover': item.properties['eo:cloud_cover'],
+        **_result_metadata(vi_name, expression),
+        'overview_level': overview_level,
+        'geometry': geometry,  # Store for polygon plotting
+        **uncached
+    }
+
+def _run_mosaic_analysis(bbox, geometry, target_date, vi_name, bands, cloud_cover_max, days_back,
+                         priority, progress, expression=None):
+    """run_analysis() for AOIs that need several items composited onto one grid."""
+    def report(stage, message, fraction):
+        if progress is not None:
+            progress(stage, message, fraction)
+    
+    report('search', f"Searching for images covering the AOI (last {days_back} days)...", 0.0)
+    items = get_mosaic_items(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back,
+                             geometry=geometry, priority=priority)
+    if not items:
+        raise AnalysisError(
+            f"No suitable images found within {days_back} days of target date (Cloud Cover < {cloud_cover_max}%)."
+        )
+    
+    item_dates = sorted({item.datetime.date() for item in items})
+    cloud_cover = max(item.properties['eo:cloud_cover'] for item in items)
+    report('search', f"Found {len(items)} images for the mosaic: " + ", ".join(str(d) for d in item_dates), 0.1)
+    
+    result_key = result_cache_key("+".join(item.id for item in items), _vi_keys(vi_name, expression), bbox, geometry)
+    uncached = {}
+    if result_key in cache.shared:
+        report('cache', "Reusing cached results for this image and area...", 0.9)
+    else:
+        report('download', "Downloading and compositing band data...", 0.1)
+        bands_data = load_bands_mosaic(
+            items, bands, bbox,
+            progress=lambda done, total: report(
+                'download', f"Read image {done}/{total}", 0.1 + 0.7 * done / total
+            )
+        )
+        
+        uncached = _store_result(result_key, _calculate_result(bands_data, vi_name, expression, geometry, report,
+                                                               at=lambda fraction: fraction))
+    
+    report('done', "Analysis Complete!", 1.0)
+    return {
+        'result_key': result_key,
+        'item_id': "+".join(item.id for item in items),
+        'item_date': item_dates[-1],
+        'item_dates': item_dates,
+        'scene_count': len(items),
+        'cloud_cover': cloud_cover,
+        **_result_metadata(vi_name, expression),
+        'geometry': geometry,
+        **uncached
+    }
+
+def align_bands(bands_a, bands_b, bbox):
+    """Reproject two band dicts (e.g. two dates) onto one shared grid per band.
+    The grid uses the CRS of bands_a and each band's native resolution, so scenes
+    from different tiles or UTM zones line up pixel for pixel.
+    """
+    aligned_a, aligned_b = {}, {}
+    for band_name in bands_a:
+        if band_name not in bands_b:
+            continue
+        template = _grid_template(bbox, bands_a[band_name].rio.crs, bands_a[band_name].rio.resolution())
+        aligned_a[band_name] = _reproject_to_grid(bands_a[band_name], template)
+        aligned_b[band_name] = _reproject_to_grid(bands_b[band_name], template)
+    return aligned_a, aligned_b
+
+def compute_change(vi_before, vi_after, epsilon=1e-6):
+    """Difference (after - before) and ratio (after / before) of two aligned index arrays.
+    Both are computed from one valid-pixel mask in a single vectorized pass.
+    Returns (diff, ratio) as DataArrays on the grid of vi_before.
+    """
+    before = vi_before.values
+    after = vi_after.values
+    valid = np.isfinite(before) & np.isfinite(after)
+    
+    diff = np.full(before.shape, np.nan, dtype="float32")
+    ratio = np.full(before.shape, np.nan, dtype="float32")
+    np.subtract(after, before, out=diff, where=valid)
+    np.divide(after, before, out=ratio, where=valid & (np.abs(before) > epsilon))
+    
+    return vi_before.copy(data=diff), vi_before.copy(data=ratio)
+
+def change_statistics(diff, threshold=0.05):
+    """Summary of an index difference raster: mean/min/max/std change, the share of
+    pixels that increased or decreased by more than threshold, and the valid pixel count.
+    """
+    stats = compute_stats(diff)
+    if stats['count'] == 0:
+        return {'valid_count': 0}
+    
+    values = diff.values
+    with np.errstate(invalid='ignore'):
+        increased = int(np.count_nonzero(values > threshold))
+        decreased = int(np.count_nonzero(values < -threshold))
+    count = stats['count']
+    return {
+        'valid_count': count,
+        'mean': stats['mean'],
+        'min': stats['min'],
+        'max': stats['max'],
+        'std': stats['std'],
+        'percentiles': stats['percentiles'],
+        'threshold': threshold,
+        'increased_pct': increased / count * 100,
+        'decreased_pct': decreased / count * 100,
+        'stable_pct': (count - increased - decreased) / count * 100,
+    }
+
+def run_change_detection(bbox, geometry, date_before, date_after, vi_name, bands, cloud_cover_max=15,
+                         days_back=150, threshold=0.05, expression=None, progress=None):
+    """Compare an index between two dates on one aligned grid.
+    Resolves a scene for each date, loads both dates' bands concurrently (reusing
+    bands cached by single-date runs), computes difference and ratio and their
+    statistics. Arrays go to the shared cache; returns metadata with 'result_key'.
+    Both dates are read from a COG overview when full resolution exceeds the budgets
+    (planner.py); the plan is returned under 'plan'.
+    """
+    def report(stage, message, fraction):
+        if progress is not None:
+            progress(stage, message, fraction)
+    
+    plan = plan_analysis(bbox, vi_name, bands, expression=expression, analysis='change', geometry=geometry)
+    if plan['mode'] == planner.TOO_LARGE:
+        raise AnalysisError(planner.describe(plan))
+    report('plan', planner.describe(plan), 0.0)
+    overview_level = plan['overview_level']
+    
+    report('search', "Searching for images for both dates...", 0.0)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="change") as pool:
+        search_before = pool.submit(get_best_item, bbox, date_before, cloud_cover_max, days_back, geometry)
+        search_after = pool.submit(get_best_item, bbox, date_after, cloud_cover_max, days_back, geometry)
+        item_before, item_after = search_before.result(), search_after.result()
+    
+    for item, target in ((item_before, date_before), (item_after, date_after)):
+        if item is None:
+            raise AnalysisError(
+                f"No suitable images found within {days_back} days of {target} (Cloud Cover < {cloud_cover_max}%)."
+            )
+    if item_before.id == item_after.id:
+        raise AnalysisError("Both dates resolved to the same image. Choose dates further apart.")
+    
+    report('search', f"Found Images: **{item_before.datetime.date()}** and **{item_after.datetime.date()}**", 0.1)
+    
+    result_key = cache.make_key('change', item_before.id, item_after.id, _vi_key(vi_name, expression),
+                                [round(float(v), 6) for v in bbox],
+                                geometry_hash(geometry) if geometry else None, threshold, overview_level)
+    uncached = {}
+    if result_key in cache.shared:
+        report('cache', "Reusing cached results for these images and area...", 0.9)
+    else:
+        report('download', "Downloading band data for both dates...", 0.1)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="change") as pool:
+            load_before = pool.submit(load_bands, item_before, bands, bbox, overview_level=overview_level,
+                                      geometry=geometry)
+            load_after = pool.submit(load_bands, item_after, bands, bbox, overview_level=overview_level,
+                                     geometry=geometry)
+            bands_before, bands_after = load_before.result(), load_after.result()
+        
+        report('align', "Aligning both dates onto a common grid...", 0.7)
+        bands_before, bands_after = align_bands(bands_before, bands_after, bbox)
+        
+        report('calculate', f"Calculating {vi_name} change...", 0.8)
+        vi_before = calculate_vi_single(bands_before, vi_name, expression=expression)
+        vi_after = calculate_vi_single(bands_after, vi_name, expression=expression)
+        if vi_before is None or vi_after is None:
+            raise AnalysisError(f"Failed to calculate {vi_name}. Please check if all required bands are available.")
+        
+        if geometry:
+            report('clip', "Clipping to polygon boundary...", 0.9)
+            vi_before = clip_to_geometry(vi_before, geometry)
+            vi_after = clip_to_geometry(vi_after, geometry)
+        
+        diff, ratio = compute_change(vi_before, vi_after)
+        stats = change_statistics(diff, threshold=threshold)
+        uncached = _store_result(result_key, {
+            'vi_before': vi_before, 'vi_after': vi_after, 'diff': diff, 'ratio': ratio, 'stats': stats
+        })
+    
+    report('done', "Analysis Complete!", 1.0)
+    return {
+        'mode': 'change',
+        'result_key': result_key,
+        'item_date_before': item_before.datetime.date(),
+        'item_date_after': item_after.datetime.date(),
+        'cloud_cover_before': item_before.properties['eo:cloud_cover'],
+        'cloud_cover_after': item_after.properties['eo:cloud_cover'],
+        'selected_vi': vi_name,
+        'expression': expression,
+        'plan': plan,
+        'geometry': geometry,
+        **uncached
+    }
+
+# Scene classification (SCL) classes treated as clear: vegetation, bare soil, water, unclassified
+CLEAR_SCL_CLASSES = (4, 5, 6, 7)
+
+COMPOSITE_METHODS = ('max', 'median', 'mean')
+
+# Reducer state per output pixel (see _CompositeReducer), for planning
+_COMPOSITE_STATE_BYTES = {'max': 6, 'mean': 18, 'median': 2 + 2 * 32}
+
+class _CompositeReducer:
+    """Online per-pixel reduction of index layers on one grid. Memory depends on the grid
+    size only, not on how many layers are added:
+    'max' keeps the running maximum, 'mean' quality-weighted running sums, and 'median'
+    a small per-pixel histogram (range fixed from the first layer) that is interpolated
+    like approx_percentile() at the end.
+    """
+    
+    def __init__(self, method, shape, median_bins=32):
+        self.method = method
+        self.count = np.zeros(shape, dtype=np.uint16)
+        if method == 'max':
+            self.value = np.full(shape, np.nan, dtype=np.float32)
+        elif method == 'mean':
+            self.weighted_sum = np.zeros(shape, dtype=np.float64)
+            self.weight = np.zeros(shape, dtype=np.float64)
+        else:
+            self.bins = median_bins
+            self.edges = None
+            self.hist = None
+    
+    def add(self, values, weight=1.0):
+        valid = np.isfinite(values)
+        self.count += valid
+        if self.method == 'max':
+            np.fmax(self.value, values, out=self.value)
+        elif self.method == 'mean':
+            self.weighted_sum += np.where(valid, values, 0.0) * weight
+            self.weight += valid * weight
+        else:
+            if self.edges is None:
+                if not valid.any():
+                    return
+                # Fix the histogram range from the first layer, with headroom for other dates
+                low, high = np.percentile(values[valid], [1, 99])
+                pad = (high - low) * 0.25 or 0.5
+                self.edges = np.linspace(low - pad, high + pad, self.bins + 1)
+                self.hist = np.zeros((self.bins,) + values.shape, dtype=np.uint16)
+            rows, cols = np.nonzero(valid)
+            idx = np.clip(np.searchsorted(self.edges, values[valid], side='right') - 1, 0, self.bins - 1)
+            # At most one increment per pixel per layer, so plain fancy indexing is safe
+            self.hist[idx, rows, cols] += 1
+    
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.method == 'max':
+                return self.value
+            if self.method == 'mean':
+                return np.where(self.weight > 0, self.weighted_sum / self.weight, np.nan).astype(np.float32)
             
-            # Clip to bbox
-            clipped = da.rio.clip_box(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+            out = np.full(self.count.shape, np.nan, dtype=np.float32)
+            if self.hist is None:
+                return out
+            width = self.edges[1] - self.edges[0]
             
-            # Squeeze to remove band dimension (1, y, x) -> (y, x)
-            loaded_bands[band_name] = clipped.squeeze()
+            def value_at_rank(hist, cumulative, rank):
+                # Value of the rank-th smallest sample (1-based), spread evenly inside its bin
+                idx = np.minimum((cumulative < rank).sum(axis=0), self.bins - 1)
+                below = np.where(idx > 0, np.take_along_axis(cumulative, np.maximum(idx - 1, 0)[None], 0)[0], 0)
+                in_bin = np.maximum(np.take_along_axis(hist, idx[None], 0)[0], 1)
+                return self.edges[idx] + (rank - below - 0.5) / in_bin * width
             
-    return loaded_bands
+            # Row blocks keep the temporary cumulative counts small
+            for start in range(0, out.shape[0], 256):
+                hist = self.hist[:, start:start + 256]
+                count = self.count[start:start + 256]
+                cumulative = np.cumsum(hist, axis=0, dtype=np.uint16)
+                # Median of n samples: mean of ranks ceil(n/2) and floor(n/2) + 1
+                lower = value_at_rank(hist, cumulative, (count + 1) // 2)
+                upper = value_at_rank(hist, cumulative, count // 2 + 1)
+                out[start:start + 256] = np.where(count > 0, (lower + upper) / 2, np.nan)
+            return out
 
-def calculate_vi_single(bands_dict, vi_name):
-    """Calculate VI for a single image dictionary.
-    Supports 30 vegetation indices with proper error handling.
+def _composite_layer(item, bbox, vi_name, bands, template, expression=None, overview_level=None, geometry=None):
+    """One scene's index on the composite grid with non-clear pixels (SCL) set to NaN.
+    Returns (values, weight); weight is the share of clear pixels in the window.
+    """
+    bands_data = load_bands(item, bands, bbox, max_workers=2, overview_level=overview_level, geometry=geometry)
+    vi = calculate_vi_single(bands_data, vi_name, expression=expression)
+    if vi is None:
+        return None, 0.0
+    values = _reproject_to_grid(vi, template, nodata=np.nan).values
+    
+    if 'SCL' not in bands_data:
+        return values, 1.0 - item.properties['eo:cloud_cover'] / 100.0
+    scl = _reproject_to_grid(bands_data['SCL'], template).values
+    clear = np.isin(scl, CLEAR_SCL_CLASSES)
+    observed = np.count_nonzero(np.isfinite(scl))
+    weight = np.count_nonzero(clear) / observed if observed else 0.0
+    return np.where(clear, values, np.nan), weight
+
+def run_composite(bbox, geometry, target_date, vi_name, bands, method='max', cloud_cover_max=60,
+                  days_back=150, max_workers=4, expression=None, progress=None):
+    """Per-pixel composite of an index over all scenes in the days_back window.
+    method: 'max' (e.g. max-NDVI), 'median' (approximate, from per-pixel histograms) or
+    'mean' (weighted by each scene's share of clear pixels). Cloud, shadow and other
+    non-clear pixels are masked with the scene classification layer (SCL) first.
+    Scenes are read in parallel and folded into the composite one at a time, so at
+    most max_workers scenes are held in memory; scenes are read from a COG overview when
+    that is still too much for the memory/transfer budgets (planner.py; estimated for the
+    scenes held at once, not the whole season). Returns metadata with 'result_key' and 'plan'.
     """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from shapely.geometry import shape, box
+    
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f"Unknown composite method: {method}")
+    
+    def report(stage, message, fraction):
+        if progress is not None:
+            progress(stage, message, fraction)
+    
+    plan = plan_analysis(bbox, vi_name, bands, expression=expression, analysis='composite', method=method,
+                         max_workers=max_workers, geometry=geometry)
+    if plan['mode'] == planner.TOO_LARGE:
+        raise AnalysisError(planner.describe(plan))
+    report('plan', planner.describe(plan), 0.0)
+    overview_level = plan['overview_level']
+    
+    report('search', f"Searching for all images in the last {days_back} days...", 0.0)
+    items = search_items(bbox, target_date, cloud_cover_max=cloud_cover_max, days_back=days_back)
+    aoi = shape(geometry) if geometry else box(*bbox)
+    coverage = footprint_coverage(items, aoi)
+    items = sorted((item for item in items if coverage[item.id] > 0), key=lambda item: item.datetime)
+    if not items:
+        raise AnalysisError(
+            f"No suitable images found within {days_back} days of target date (Cloud Cover < {cloud_cover_max}%)."
+        )
+    
+    item_dates = sorted({item.datetime.date() for item in items})
+    report('search', f"Found {len(items)} images from {item_dates[0]} to {item_dates[-1]}", 0.05)
     
-    # Helper to get band as float
+    result_key = cache.make_key('composite', [item.id for item in items], _vi_key(vi_name, expression),
+                                [round(float(v), 6) for v in bbox], geometry_hash(geometry) if geometry else None,
+                                method, overview_level)
+    uncached = {}
+    if result_key in cache.shared:
+        report('cache', "Reusing cached composite for these images and area...", 0.9)
+    else:
+        # The first scene fixes the output grid: its CRS and the index's native resolution
+        first = calculate_vi_single(load_bands(items[0], bands, bbox, overview_level=overview_level,
+                                               geometry=geometry), vi_name, expression=expression)
+        if first is None:
+            raise AnalysisError(f"Failed to calculate {vi_name}. Please check if all required bands are available.")
+        template = _grid_template(bbox, first.rio.crs, first.rio.resolution())
+        reducer = _CompositeReducer(method, template.shape)
+        
+        # Keep at most max_workers scenes in flight; each is folded in and dropped as it arrives
+        pending = iter(items)
+        done = 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="composite") as pool:
+            in_flight = {}
+            for item in pending:
+                in_flight[pool.submit(_composite_layer, item, bbox, vi_name, bands, template, expression,
+                                      overview_level, geometry)] = item
+                if len(in_flight) >= max_workers:
+                    break
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = in_flight.pop(future)
+                    values, weight = future.result()
+                    if values is not None and weight > 0:
+                        reducer.add(values, weight)
+                    done += 1
+                    report('download', f"Added {item.datetime.date()} ({done}/{len(items)})",
+                           0.05 + 0.8 * done / len(items))
+                    next_item = next(pending, None)
+                    if next_item is not None:
+                        in_flight[pool.submit(_composite_layer, next_item, bbox, vi_name, bands, template,
+                                              expression, overview_level, geometry)] = next_item
+        
+        report('calculate', f"Computing {method} composite...", 0.85)
+        composite = template.copy(data=reducer.result())
+        clear_count = template.copy(data=reducer.count.astype(np.float32))
+        if geometry:
+            report('clip', "Clipping to polygon boundary...", 0.9)
+            composite = clip_to_geometry(composite, geometry)
+            clear_count = clip_to_geometry(clear_count, geometry)
+        
+        uncached = _store_result(result_key, {
+            'vi_data_overall': composite, 'clear_count': clear_count, 'stats': compute_stats(composite)
+        })
+    
+    report('done', "Analysis Complete!", 1.0)
+    return {
+        'mode': 'composite',
+        'result_key': result_key,
+        'method': method,
+        'item_date': item_dates[-1],
+        'item_dates': item_dates,
+        'scene_count': len(items),
+        'cloud_cover': max(item.properties['eo:cloud_cover'] for item in items),
+        'selected_vi': vi_name,
+        'expression': expression,
+        'plan': plan,
+        'geometry': geometry,
+        **uncached
+    }
+
+def calculate_vis(bands_dict, vi_names, vi_expressions=None):
+    """Calculate several indices from one band dictionary in a single pass.
+    vi_expressions maps names of user-defined indices to their expression.
+    In-memory bands are aligned to the finest grid each index needs and computed
+    tile by tile on the compute pool (compute.py); indices on the same grid share
+    one pass, so each band tile is converted to reflectance once for all of them.
+    Returns {vi_name: DataArray, or None if that index could not be calculated}.
+    """
+    import xarray as xr
+    
+    if any(da.chunks is not None for da in bands_dict.values()):
+        return _calculate_vis_lazy(bands_dict, vi_names, vi_expressions)
+    
+    results = {}
+    groups = {}  # (shape, resolution) of the output grid -> [(vi_name, kernel or None, bands)]
+    for vi_name in vi_names:
+        expression = (vi_expressions or {}).get(vi_name)
+        try:
+            if expression is not None or vi_name in expressions.PRESETS:
+                kernel = expressions.compile_expression(expression or expressions.PRESETS[vi_name])
+                required = list(kernel.bands)
+            else:
+                kernel, required = None, vi_required_bands(vi_name)
+            missing = [band for band in required if band not in bands_dict]
+            if missing:
+                raise ValueError(f"Missing bands for {vi_name} ({', '.join(missing)})")
+        except Exception as e:
+            print(f"Error calculating {vi_name}: {e}")
+            results[vi_name] = None
+            continue
+        finest = min((bands_dict[band] for band in required), key=lambda da: abs(da.rio.resolution()[0]))
+        groups.setdefault((finest.shape, finest.rio.resolution()), []).append((vi_name, kernel, required))
+    
+    for members in groups.values():
+        aligned = _align_to_finest({band: bands_dict[band] for _, _, required in members for band in required})
+        reference = min(aligned.values(), key=lambda da: abs(da.rio.resolution()[0]))
+        names = [vi_name for vi_name, _, _ in members]
+        
+        def tile_kernel(blocks, members=members):
+            reflectance = {}
+            
+            # Band tile as reflectance (converted once, reused by every index of the tile)
+            def get(b):
+                if b not in blocks:
+                    return None
+                if b not in reflectance:
+                    reflectance[b] = blocks[b].astype(float) / 10000.0
+                return reflectance[b]
+            
+            return {vi_name: _compute_vi(vi_name, get) if kernel is None else kernel(blocks)
+                    for vi_name, kernel, _ in members}
+        
+        try:
+            computed = compute.run(tile_kernel, {band: da.values for band, da in aligned.items()}, names)
+        except Exception as e:
+            print(f"Error calculating {', '.join(names)}: {e}")
+            computed = dict.fromkeys(names)
+        for vi_name, values in computed.items():
+            results[vi_name] = None if values is None else xr.DataArray(values, coords=reference.coords,
+                                                                        dims=reference.dims)
+    return {vi_name: results[vi_name] for vi_name in vi_names}
+
+def _calculate_vis_lazy(bands_dict, vi_names, vi_expressions=None):
+    """calculate_vis() for lazy (dask) bands: the formulas build a graph that dask
+    evaluates chunk by chunk later.
+    """
+    reflectance = {}
+    
+    # Helper to get band as float (converted once, reused by every index)
     def get(b):
-        if b in bands_dict:
-            return bands_dict[b].astype(float) / 10000.0
-        return None
+        if b not in bands_dict:
+            return None
+        if b not in reflectance:
+            reflectance[b] = bands_dict[b].astype(float) / 10000.0
+        return reflectance[b]
+    
+    results = {}
+    for vi_name in vi_names:
+        expression = (vi_expressions or {}).get(vi_name)
+        try:
+            # Expressions run as one compiled kernel and convert only the bands they use
+            if expression is not None or vi_name in expressions.PRESETS:
+                results[vi_name] = evaluate_expression(expression or expressions.PRESETS[vi_name], bands_dict)
+            else:
+                results[vi_name] = _compute_vi(vi_name, get)
+        except Exception as e:
+            print(f"Error calculating {vi_name}: {e}")
+            results[vi_name] = None
+    return results
 
+# Bands read by the built-in formulas in _compute_vi
+_VI_FORMULA_BANDS = ('B02', 'B03', 'B04', 'B05', 'B07', 'B08', 'B11', 'B12')
+_vi_bands_cache = {}
+
+def vi_required_bands(vi_name, expression=None):
+    """Sorted band names needed for an index (built-in, preset, or expression).
+    Built-in formulas are probed once on scalars: a band is required if the formula
+    fails without it. Raises ValueError for unknown indices or invalid expressions.
+    """
+    if expression is not None or vi_name in expressions.PRESETS:
+        return expressions.required_bands(expression or expressions.PRESETS[vi_name])
+    if vi_name not in _vi_bands_cache:
+        one = np.ones(1)
+        _compute_vi(vi_name, lambda b: one)  # unknown index -> ValueError
+        required = []
+        for band in _VI_FORMULA_BANDS:
+            try:
+                with np.errstate(all='ignore'):
+                    _compute_vi(vi_name, lambda b: None if b == band else one)
+            except ValueError:
+                required.append(band)
+        _vi_bands_cache[vi_name] = required
+    return list(_vi_bands_cache[vi_name])
+
+def calculate_vi_single(bands_dict, vi_name, expression=None):
+    """Calculate VI for a single image dictionary.
+    Supports 30 vegetation indices with proper error handling.
+    With expression (see expressions.py), vi_name is only a label and the index is
+    computed from the expression; expression presets (NDRE, NBR) work by name.
+    """
+    return calculate_vis(bands_dict, [vi_name], {vi_name: expression} if expression is not None else None)[vi_name]
+
+def _compute_vi(vi_name, get):
+    """Built-in index formulas. get(band) returns the band as reflectance, or None if not loaded.
+    Raises ValueError for missing bands or an unknown index.
+    """
     # Load all possible bands
     b2 = get("B02")    # Blue
     b3 = get("B03")    # Green  
@@ -103,140 +1429,166 @@ def calculate_vi_single(bands_dict, vi_name):
     vi = None
     epsilon = 1e-6  # Avoid division by zero
     
-    try:
-        # A
-        if vi_name == 'ARVI':
-            if b8 is None or b4 is None or b2 is None: 
-                raise ValueError("Missing bands for ARVI (B02, B04, B08)")
-            gamma = 1.0
-            vi = (b8 - (b4 - gamma * (b2 - b4))) / (b8 + (b4 - gamma * (b2 - b4)) + epsilon)
-        
-        # D
-        elif vi_name == 'DVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for DVI (B04, B08)")
-            vi = b8 - b4
-        
-        # E
-        elif vi_name == 'EVI':
-            if b8 is None or b4 is None or b2 is None: 
-                raise ValueError("Missing bands for EVI (B02, B04, B08)")
-            vi = 2.5 * ((b8 - b4) / (b8 + 6 * b4 - 7.5 * b2 + 1 + epsilon))
-        
-        elif vi_name == 'EVI2':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for EVI2 (B04, B08)")
-            vi = 2.5 * ((b8 - b4) / (b8 + 2.4 * b4 + 1 + epsilon))
-        
-        # G
-        elif vi_name == 'GARI':
-            if b8 is None or b3 is None or b2 is None or b4 is None: 
-                raise ValueError("Missing bands for GARI (B02, B03, B04, B08)")
-            gamma = 1.0
-            vi = (b8 - (b3 - gamma * (b2 - b4))) / (b8 + (b3 - gamma * (b2 - b4)) + epsilon)
-        
-        elif vi_name == 'GCI':
-            if b8 is None or b3 is None: 
-                raise ValueError("Missing bands for GCI (B03, B08)")
-            vi = (b8 / (b3 + epsilon)) - 1
-        
-        elif vi_name == 'GDVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for GDVI (B04, B08)")
-            vi = (b8**2 - b4**2) / (b8**2 + b4**2 + epsilon)
-        
-        elif vi_name == 'GNDVI':
-            if b8 is None or b3 is None: 
-                raise ValueError("Missing bands for GNDVI (B03, B08)")
-            vi = (b8 - b3) / (b8 + b3 + epsilon)
-        
-        elif vi_name == 'GRRVI':
-            if b3 is None or b4 is None: 
-                raise ValueError("Missing bands for GRRVI (B03, B04)")
-            vi = (b3 - b4) / (b3 + b4 + epsilon)
-        
-        # I
-        elif vi_name == 'IPVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for IPVI (B04, B08)")
-            vi = b8 / (b8 + b4 + epsilon)
-        
-        # M
-        elif vi_name == 'MSAVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for MSAVI (B04, B08)")
-            vi = (2 * b8 + 1 - np.sqrt((2 * b8 + 1)**2 - 8 * (b8 - b4) + epsilon)) / 2
-        
-        elif vi_name == 'MSR':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for MSR (B04, B08)")
-            sr = b8 / (b4 + epsilon)
-            vi = (sr - 1) / (np.sqrt(sr + epsilon) + epsilon)
-        
-        # N
-        elif vi_name == 'NDVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for NDVI (B04, B08)")
-            vi = (b8 - b4) / (b8 + b4 + epsilon)
-        
-        elif vi_name == 'NDWI':
-            if b3 is None or b8 is None: 
-                raise ValueError("Missing bands for NDWI (B03, B08)")
-            vi = (b3 - b8) / (b3 + b8 + epsilon)
-        
-        # O
-        elif vi_name == 'OSAVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for OSAVI (B04, B08)")
-            vi = (b8 - b4) / (b8 + b4 + 0.16 + epsilon)
-        
-        # R
-        elif vi_name == 'RDVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for RDVI (B04, B08)")
-            vi = (b8 - b4) / (np.sqrt(b8 + b4 + epsilon) + epsilon)
-        
-        elif vi_name == 'RECI':
-            if b7 is None or b5 is None: 
-                raise ValueError("Missing bands for RECI (B05, B07)")
-            vi = (b7 / (b5 + epsilon)) - 1
-        
-        # S
-        elif vi_name == 'SAVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for SAVI (B04, B08)")
-            vi = ((b8 - b4) / (b8 + b4 + 0.5 + epsilon)) * 1.5
-        
-        elif vi_name == 'SIPI':
-            if b8 is None or b2 is None or b4 is None: 
-                raise ValueError("Missing bands for SIPI (B02, B04, B08)")
-            vi = (b8 - b2) / (b8 - b4 + epsilon)
-        
-        elif vi_name == 'SIPI2':
-            if b8 is None or b2 is None or b4 is None: 
-                raise ValueError("Missing bands for SIPI2 (B02, B04, B08)")
-            vi = (b8 - b2) / (b8 + b4 + epsilon)
-        
-        elif vi_name == 'SR':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for SR (B04, B08)")
-            vi = b8 / (b4 + epsilon)
-        
-        # W
-        elif vi_name == 'WDRVI':
-            if b8 is None or b4 is None: 
-                raise ValueError("Missing bands for WDRVI (B04, B08)")
-            vi = (0.1 * b8 - b4) / (0.1 * b8 + b4 + epsilon)
-        
-        else:
-            raise ValueError(f"Unknown VI: {vi_name}")
-            
-    except Exception as e:
-        print(f"Error calculating {vi_name}: {e}")
-        return None
-        
+    # A
+    if vi_name == 'ARVI':
+        if b8 is None or b4 is None or b2 is None: 
+            raise ValueError("Missing bands for ARVI (B02, B04, B08)")
+        gamma = 1.0
+        vi = (b8 - (b4 - gamma * (b2 - b4))) / (b8 + (b4 - gamma * (b2 - b4)) + epsilon)
+    
+    # D
+    elif vi_name == 'DVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for DVI (B04, B08)")
+        vi = b8 - b4
+    
+    # E
+    elif vi_name == 'EVI':
+        if b8 is None or b4 is None or b2 is None: 
+            raise ValueError("Missing bands for EVI (B02, B04, B08)")
+        vi = 2.5 * ((b8 - b4) / (b8 + 6 * b4 - 7.5 * b2 + 1 + epsilon))
+    
+    elif vi_name == 'EVI2':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for EVI2 (B04, B08)")
+        vi = 2.5 * ((b8 - b4) / (b8 + 2.4 * b4 + 1 + epsilon))
+    
+    # G
+    elif vi_name == 'GARI':
+        if b8 is None or b3 is None or b2 is None or b4 is None: 
+            raise ValueError("Missing bands for GARI (B02, B03, B04, B08)")
+        gamma = 1.0
+        vi = (b8 - (b3 - gamma * (b2 - b4))) / (b8 + (b3 - gamma * (b2 - b4)) + epsilon)
+    
+    elif vi_name == 'GCI':
+        if b8 is None or b3 is None: 
+            raise ValueError("Missing bands for GCI (B03, B08)")
+        vi = (b8 / (b3 + epsilon)) - 1
+    
+    elif vi_name == 'GDVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for GDVI (B04, B08)")
+        vi = (b8**2 - b4**2) / (b8**2 + b4**2 + epsilon)
+    
+    elif vi_name == 'GNDVI':
+        if b8 is None or b3 is None: 
+            raise ValueError("Missing bands for GNDVI (B03, B08)")
+        vi = (b8 - b3) / (b8 + b3 + epsilon)
+    
+    elif vi_name == 'GRRVI':
+        if b3 is None or b4 is None: 
+            raise ValueError("Missing bands for GRRVI (B03, B04)")
+        vi = (b3 - b4) / (b3 + b4 + epsilon)
+    
+    # I
+    elif vi_name == 'IPVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for IPVI (B04, B08)")
+        vi = b8 / (b8 + b4 + epsilon)
+    
+    # M
+    elif vi_name == 'MSAVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for MSAVI (B04, B08)")
+        vi = (2 * b8 + 1 - np.sqrt((2 * b8 + 1)**2 - 8 * (b8 - b4) + epsilon)) / 2
+    
+    elif vi_name == 'MSR':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for MSR (B04, B08)")
+        sr = b8 / (b4 + epsilon)
+        vi = (sr - 1) / (np.sqrt(sr + epsilon) + epsilon)
+    
+    # N
+    elif vi_name == 'NDVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for NDVI (B04, B08)")
+        vi = (b8 - b4) / (b8 + b4 + epsilon)
+    
+    elif vi_name == 'NDWI':
+        if b3 is None or b8 is None: 
+            raise ValueError("Missing bands for NDWI (B03, B08)")
+        vi = (b3 - b8) / (b3 + b8 + epsilon)
+    
+    # O
+    elif vi_name == 'OSAVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for OSAVI (B04, B08)")
+        vi = (b8 - b4) / (b8 + b4 + 0.16 + epsilon)
+    
+    # R
+    elif vi_name == 'RDVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for RDVI (B04, B08)")
+        vi = (b8 - b4) / (np.sqrt(b8 + b4 + epsilon) + epsilon)
+    
+    elif vi_name == 'RECI':
+        if b7 is None or b5 is None: 
+            raise ValueError("Missing bands for RECI (B05, B07)")
+        vi = (b7 / (b5 + epsilon)) - 1
+    
+    # S
+    elif vi_name == 'SAVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for SAVI (B04, B08)")
+        vi = ((b8 - b4) / (b8 + b4 + 0.5 + epsilon)) * 1.5
+    
+    elif vi_name == 'SIPI':
+        if b8 is None or b2 is None or b4 is None: 
+            raise ValueError("Missing bands for SIPI (B02, B04, B08)")
+        vi = (b8 - b2) / (b8 - b4 + epsilon)
+    
+    elif vi_name == 'SIPI2':
+        if b8 is None or b2 is None or b4 is None: 
+            raise ValueError("Missing bands for SIPI2 (B02, B04, B08)")
+        vi = (b8 - b2) / (b8 + b4 + epsilon)
+    
+    elif vi_name == 'SR':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for SR (B04, B08)")
+        vi = b8 / (b4 + epsilon)
+    
+    # W
+    elif vi_name == 'WDRVI':
+        if b8 is None or b4 is None: 
+            raise ValueError("Missing bands for WDRVI (B04, B08)")
+        vi = (0.1 * b8 - b4) / (0.1 * b8 + b4 + epsilon)
+    
+    else:
+        raise ValueError(f"Unknown VI: {vi_name}")
+    
     return vi
 
+def _align_to_finest(bands_dict):
+    """Reproject bands onto the grid of the finest-resolution one (e.g. 20 m B05 onto 10 m B08)."""
+    from rasterio.enums import Resampling
+    
+    reference = min(bands_dict.values(), key=lambda da: abs(da.rio.resolution()[0]))
+    return {
+        name: da if da.shape == reference.shape else da.rio.reproject_match(reference, resampling=Resampling.nearest)
+        for name, da in bands_dict.items()
+    }
+
+def evaluate_expression(expression, bands_dict):
+    """Evaluate a user-defined index expression (see expressions.py) over loaded bands.
+    Bands of mixed resolution are aligned to the finest one first.
+    """
+    import xarray as xr
+    
+    kernel = expressions.compile_expression(expression)
+    missing = [band for band in kernel.bands if band not in bands_dict]
+    if missing:
+        raise ValueError(f"Missing bands for expression ({', '.join(missing)})")
+    
+    aligned = _align_to_finest({band: bands_dict[band] for band in kernel.bands})
+    reference = aligned[kernel.bands[0]]
+    if reference.chunks is not None:
+        # Lazy (chunked) bands: run the kernel block by block
+        return xr.apply_ufunc(lambda *arrays: kernel(dict(zip(kernel.bands, arrays))),
+                              *(aligned[band] for band in kernel.bands),
+                              dask='parallelized', output_dtypes=[np.float64])
+    return xr.DataArray(kernel({band: da.values for band, da in aligned.items()}),
+                        coords=reference.coords, dims=reference.dims)
+
 def calculate_area(geometry):
     """Calculate area of geometry in multiple units.
     Returns dict with area in: sq_m, sq_wa, rai, ngan, hectare, acre
@@ -244,6 +1596,12 @@ def calculate_area(geometry):
     from shapely.geometry import shape
     from pyproj import Geod
     
+    # Shown on every rerun; the geodesic area of a large boundary takes a while
+    key = cache.make_key('area', geometry_hash(geometry))
+    cached = cache.shared.get(key)
+    if cached is not None:
+        return dict(cached)
+    
     # Convert GeoJSON to shapely geometry
     geom = shape(geometry)
     
@@ -258,7 +1616,7 @@ def calculate_area(geometry):
     area_hectare = area_sq_m / 10000  # 1 เฮกแตร์ = 10,000 ตร.ม.
     area_acre = area_sq_m / 4046.86  # 1 เอเคอร์ = 4,046.86 ตร.ม.
     
-    return {
+    area = {
         'sq_m': area_sq_m,
         'sq_wa': area_sq_wa,
         'ngan': area_ngan,
@@ -266,6 +1624,8 @@ def calculate_area(geometry):
         'hectare': area_hectare,
         'acre': area_acre
     }
+    cache.shared.put(key, area)
+    return dict(area)
 
 def clip_to_geometry(xr_data, geometry):
     """Clip the xarray data to the exact polygon geometry.
@@ -273,6 +1633,7 @@ def clip_to_geometry(xr_data, geometry):
     """
     from shapely.geometry import shape
     import geopandas as gpd
+    import rioxarray  # noqa: F401  (registers the .rio accessor)
     
     # geometry is GeoJSON dict
     # Convert to shapely
@@ -282,15 +1643,105 @@ def clip_to_geometry(xr_data, geometry):
     # Reproject GDF to raster CRS
     gdf_reproj = gdf.to_crs(xr_data.rio.crs)
     
+    # Indices can inherit a band's integer _FillValue (0, a valid index value) through xarray
+    # arithmetic, and clip() fills with it; float data is always filled with NaN instead
+    if np.issubdtype(xr_data.dtype, np.floating):
+        xr_data = xr_data.copy(deep=False)
+        xr_data.encoding.pop('_FillValue', None)
+        xr_data = xr_data.rio.write_nodata(np.nan, encoded=False)
+    
     # Clip - pixels outside geometry become NaN
     clipped = xr_data.rio.clip(gdf_reproj.geometry, gdf_reproj.crs, drop=False, all_touched=False)
     
     return clipped
 
-def normalize_to_image(xr_data, min_val=None, max_val=None, colormap='RdYlGn', custom_palette=None):
+STATS_PERCENTILES = (2, 5, 25, 50, 75, 95, 98)
+
+def _iter_blocks(arr):
+    """Yield in-memory numpy blocks of an array; dask arrays are computed one chunk at a time."""
+    if hasattr(arr, 'numblocks'):
+        for index in np.ndindex(*arr.numblocks):
+            yield np.asarray(arr.blocks[index].compute())
+    else:
+        yield np.asarray(arr)
+
+def compute_stats(data, bins=256, hist_range=None):
+    """Fused statistics over the finite values of an array in one pass.
+    Returns a dict with count, mean, min, max, std, a fixed-bin histogram
+    ('hist', 'bin_edges') and approximate 'percentiles' derived from it.
+    data may be a numpy array or an xarray DataArray (numpy- or dask-backed).
+    Chunked (dask) data is reduced chunk by chunk; without hist_range it needs
+    a second chunked pass for the histogram once min/max are known.
+    """
+    arr = data.data if hasattr(data, 'dims') else data
+    chunked = hasattr(arr, 'numblocks')
+    
+    count = 0
+    total = 0.0
+    total_sq = 0.0
+    vmin, vmax = np.inf, -np.inf
+    hist = np.zeros(bins, dtype=np.int64)
+    values = None
+    
+    for block in _iter_blocks(arr):
+        # One finite mask per block; every reduction then works on the compact valid values
+        values = block[np.isfinite(block)].astype(np.float64, copy=False)
+        if values.size == 0:
+            continue
+        count += values.size
+        total += values.sum()
+        total_sq += np.dot(values, values)
+        vmin = min(vmin, values.min())
+        vmax = max(vmax, values.max())
+        if hist_range is not None:
+            hist += np.histogram(values, bins=bins, range=hist_range)[0]
+    
+    if count == 0:
+        return {'count': 0}
+    
+    if hist_range is None:
+        hist_range = (vmin, vmax) if vmax > vmin else (vmin - 0.5, vmax + 0.5)
+        if chunked:
+            for block in _iter_blocks(arr):
+                hist += np.histogram(block[np.isfinite(block)], bins=bins, range=hist_range)[0]
+        else:
+            hist = np.histogram(values, bins=bins, range=hist_range)[0]
+    
+    mean = total / count
+    stats = {
+        'count': int(count),
+        'mean': float(mean),
+        'min': float(vmin),
+        'max': float(vmax),
+        'std': float(np.sqrt(max(total_sq / count - mean * mean, 0.0))),
+        'hist': hist,
+        'bin_edges': np.linspace(hist_range[0], hist_range[1], bins + 1),
+    }
+    stats['percentiles'] = {q: approx_percentile(stats, q) for q in STATS_PERCENTILES}
+    return stats
+
+def approx_percentile(stats, q):
+    """Approximate q-th percentile (0-100) from the histogram in a compute_stats() result,
+    interpolating linearly inside the bin. Accurate to about one bin width.
+    """
+    hist = stats['hist']
+    edges = stats['bin_edges']
+    cumulative = np.cumsum(hist)
+    target = q / 100.0 * cumulative[-1]
+    idx = int(np.searchsorted(cumulative, target, side='left'))
+    idx = min(idx, len(hist) - 1)
+    below = cumulative[idx - 1] if idx > 0 else 0
+    in_bin = hist[idx]
+    fraction = (target - below) / in_bin if in_bin else 0.0
+    value = edges[idx] + fraction * (edges[idx + 1] - edges[idx])
+    return float(min(max(value, stats['min']), stats['max']))
+
+def normalize_to_image(xr_data, min_val=None, max_val=None, colormap='RdYlGn', custom_palette=None, stats=None):
     """Normalize xarray data to 0-255 image with colormap or custom palette.
     NaN values will be rendered as transparent (alpha=0).
+    Pass a compute_stats() result as stats to auto-scale without rescanning the data.
     """
+    import matplotlib.pyplot as plt
     from matplotlib.colors import ListedColormap
     
     data = xr_data.values
@@ -299,10 +1750,12 @@ def normalize_to_image(xr_data, min_val=None, max_val=None, colormap='RdYlGn', c
     nan_mask = np.isnan(data)
     
     # Auto-scale if not provided
+    if (min_val is None or max_val is None) and stats is None:
+        stats = compute_stats(data)
     if min_val is None:
-        min_val = np.nanmin(data)
+        min_val = stats['min']
     if max_val is None:
-        max_val = np.nanmax(data)
+        max_val = stats['max']
         
     # Normalize data to 0-1
     norm_data = (data - min_val) / (max_val - min_val + 1e-10)  # Add epsilon to avoid division by zero
@@ -336,10 +1789,12 @@ def normalize_to_image(xr_data, min_val=None, max_val=None, colormap='RdYlGn', c
     img_uint8 = (colored_data * 255).astype(np.uint8)
     return img_uint8
 
-def create_vi_plot(xr_data, vi_name, min_val=None, max_val=None, figsize=(8, 8), dpi=150):
+def create_vi_plot(xr_data, vi_name, min_val=None, max_val=None, figsize=(8, 8), dpi=150, stats=None):
     """Create a matplotlib plot with colorbar for VI visualization.
+    Pass a compute_stats() result as stats to auto-scale without rescanning the data.
     Returns image bytes suitable for display in Streamlit.
     """
+    import matplotlib.pyplot as plt
     from matplotlib.colors import ListedColormap
     
     # Custom color palette (blue -> green -> yellow -> red)
@@ -365,10 +1820,12 @@ def create_vi_plot(xr_data, vi_name, min_val=None, max_val=None, figsize=(8, 8),
     cmap.set_bad(color='white', alpha=1)  # NaN values will be solid white
     
     # Auto-scale if not provided
+    if (min_val is None or max_val is None) and stats is None:
+        stats = compute_stats(xr_data)
     if min_val is None:
-        min_val = float(np.nanmin(xr_data.values))
+        min_val = stats['min']
     if max_val is None:
-        max_val = float(np.nanmax(xr_data.values))
+        max_val = stats['max']
     
     # Create figure with white background
     fig, ax = plt.subplots(figsize=figsize, facecolor='white', dpi=dpi)
@@ -400,25 +1857,172 @@ def create_vi_plot(xr_data, vi_name, min_val=None, max_val=None, figsize=(8, 8),
     
     return buf.getvalue()
 
+def create_change_plot(diff, vi_name, limit=None, figsize=(8, 8), dpi=150, stats=None):
+    """Plot an index difference map with a diverging palette centred on zero
+    (red = decrease, green = increase). limit sets the symmetric colour range;
+    by default the larger of |2nd| and |98th| percentile of the change is used,
+    taken from stats (a compute_stats() or change_statistics() result) if given.
+    Returns PNG bytes.
+    """
+    import matplotlib.pyplot as plt
+    
+    values = diff.values
+    if limit is None:
+        if stats is None:
+            stats = compute_stats(diff)
+        percentiles = stats.get('percentiles')
+        limit = max(abs(percentiles[2]), abs(percentiles[98])) if percentiles else 1.0
+        limit = limit or 1.0
+    
+    cmap = plt.get_cmap('RdYlGn').copy()
+    cmap.set_bad(color='white', alpha=1)  # NaN values will be solid white
+    
+    fig, ax = plt.subplots(figsize=figsize, facecolor='white', dpi=dpi)
+    ax.set_facecolor('white')
+    im = ax.imshow(values, cmap=cmap, vmin=-limit, vmax=limit, interpolation='nearest')
+    
+    cbar = plt.colorbar(im, ax=ax, label=f"{vi_name} change", fraction=0.046, pad=0.04)
+    cbar.ax.tick_params(labelsize=10)
+    
+    ax.set_title(f"{vi_name} Change Map", fontsize=14, fontweight='bold', pad=10)
+    ax.set_xlabel("Pixel X", fontsize=11)
+    ax.set_ylabel("Pixel Y", fontsize=11)
+    ax.tick_params(axis='both', which='major', labelsize=9)
+    plt.tight_layout()
+    
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', dpi=dpi, bbox_inches='tight', facecolor='white')
+    plt.close(fig)
+    buf.seek(0)
+    
+    return buf.getvalue()
+
+def create_zone_plot(zones, vi_name, breaks, figsize=(8, 8), dpi=150, n_zones=None):
+    """Plot a management zone raster (see zoning.zone_field) with one colour per zone,
+    low to high index (red to green), and the zone value ranges in the legend.
+    breaks=None (fields zoned on their own breaks, see zoning.merge_zones) needs n_zones
+    and labels the zones by rank only. Returns PNG bytes.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap
+    from matplotlib.patches import Patch
+    
+    n_zones = len(breaks) + 1 if breaks is not None else n_zones
+    colors = plt.get_cmap('RdYlGn')(np.linspace(0, 1, n_zones))
+    cmap = ListedColormap(colors)
+    cmap.set_bad(color='white', alpha=1)
+    
+    values = np.ma.masked_equal(np.asarray(zones.values), 0)
+    fig, ax = plt.subplots(figsize=figsize, facecolor='white', dpi=dpi)
+    ax.set_facecolor('white')
+    ax.imshow(values, cmap=cmap, vmin=0.5, vmax=n_zones + 0.5, interpolation='nearest')
+    
+    if breaks is not None:
+        bounds = ['min'] + [f"{b:.3f}" for b in breaks] + ['max']
+        labels = [f"Zone {i + 1}: {bounds[i]} - {bounds[i + 1]}" for i in range(n_zones)]
+        title = vi_name
+    else:
+        labels = [f"Zone {i + 1}" for i in range(n_zones)]
+        title = f"{vi_name} (breaks per field)"
+    handles = [Patch(color=colors[i], label=label) for i, label in enumerate(labels)]
+    ax.legend(handles=handles, loc='upper left', bbox_to_anchor=(1.02, 1), fontsize=9, title=title)
+    
+    ax.set_title(f"{vi_name} Management Zones", fontsize=14, fontweight='bold', pad=10)
+    ax.set_xlabel("Pixel X", fontsize=11)
+    ax.set_ylabel("Pixel Y", fontsize=11)
+    ax.tick_params(axis='both', which='major', labelsize=9)
+    plt.tight_layout()
+    
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', dpi=dpi, bbox_inches='tight', facecolor='white')
+    plt.close(fig)
+    buf.seek(0)
+    
+    return buf.getvalue()
+
+# Image delivery profiles: name -> (max width in px or None for the render size, format).
+# 'png8' is a 256-colour palette PNG; maps use a 29-colour palette, so it is visually lossless
+IMAGE_PROFILES = {
+    'full': (None, 'png'),
+    'compact': (1000, 'png8'),
+    'data_saver': (560, 'webp'),
+}
+IMAGE_FORMATS = {'png': ('image/png', 'png'), 'png8': ('image/png', 'png'), 'webp': ('image/webp', 'webp')}
+
+def encode_image(png_bytes, fmt='png8', max_width=None, quality=75):
+    """Re-encode a rendered PNG for delivery: downscale to max_width pixels, then store as
+    a palette PNG ('png8'), WebP ('webp', lossy or lossless, whichever is smaller) or plain
+    PNG ('png').
+    """
+    from PIL import Image
+    
+    if fmt == 'png' and max_width is None:
+        return png_bytes
+    image = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+    if max_width and image.width > max_width:
+        image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+    
+    buf = io.BytesIO()
+    if fmt == 'webp':
+        # Lossy wins on smooth fields; maps of small fields are blocks of single colours,
+        # which lossless WebP stores in a fraction of the lossy size
+        image.save(buf, format='WEBP', quality=quality, method=6)
+        lossless = io.BytesIO()
+        image.save(lossless, format='WEBP', lossless=True, method=6)
+        if lossless.tell() < buf.tell():
+            buf = lossless
+    elif fmt == 'png8':
+        image.quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE).save(
+            buf, format='PNG', optimize=True)
+    else:
+        image.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+def render_image(key, render, profile='full', dpi=150, width_in=10):
+    """(bytes, mime type, file extension) of a plot for a delivery profile (IMAGE_PROFILES).
+    render(dpi) must return PNG bytes; smaller profiles render at the dpi that fits their
+    width instead of downscaling a full-size render. Encodes are kept in the shared cache
+    per (key, profile), so reruns and download buttons reuse them.
+    """
+    max_width, fmt = IMAGE_PROFILES[profile]
+    cache_key = cache.make_key('image', key, profile, dpi)
+    cached = cache.shared.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    render_dpi = dpi if max_width is None else min(dpi, max(50, max_width / width_in))
+    image = (encode_image(render(render_dpi), fmt, max_width), *IMAGE_FORMATS[fmt])
+    cache.shared.put(cache_key, image)
+    return image
+
 def export_geotiff(xr_data):
     """Export xarray data to GeoTIFF bytes."""
+    import rioxarray  # noqa: F401  (registers the .rio accessor)
+
     buffer = io.BytesIO()
     xr_data.rio.to_raster(buffer, driver="GTiff")
     buffer.seek(0)
     return buffer
 
 def export_bands_geotiff(bands_dict):
-    """Export multiple bands to a multi-band GeoTIFF."""
+    """Export multiple bands (or indices) to a multi-band GeoTIFF.
+    Layers of different resolution are aligned to the finest grid first.
+    """
+    import xarray as xr
+    import rioxarray  # noqa: F401  (registers the .rio accessor)
+
     # Stack bands into one DataArray
     # bands_dict values are (y, x)
     # We want (band, y, x)
     
     band_names = list(bands_dict.keys())
-    das = [bands_dict[b] for b in band_names]
+    aligned = _align_to_finest(bands_dict)
+    das = [aligned[b].drop_vars('band', errors='ignore') for b in band_names]
     
     # Stack
     stacked = xr.concat(das, dim="band")
     stacked.coords["band"] = band_names
+    stacked.attrs["long_name"] = tuple(band_names)  # written as band descriptions
     
     # Ensure CRS (take from first band)
     if stacked.rio.crs is None:
@@ -426,7 +2030,42 @@ def export_bands_geotiff(bands_dict):
         
     return export_geotiff(stacked)
 
-    return export_geotiff(stacked)
+def _kml_local(tag):
+    """Tag name without the namespace (some KML files don't use one)."""
+    return tag.rsplit('}', 1)[-1]
+
+def _kml_polygons(element):
+    """Every Polygon under a KML element (also inside MultiGeometry), with its holes, as shapely Polygons."""
+    from shapely.geometry import Polygon
+    
+    def ring(boundary):
+        # Parse coordinates (format: lon,lat,alt or lon,lat)
+        for elem in boundary.iter():
+            if _kml_local(elem.tag) == 'coordinates' and elem.text:
+                coord_pairs = []
+                for coord in elem.text.split():
+                    parts = coord.split(',')
+                    if len(parts) >= 2:
+                        coord_pairs.append((float(parts[0]), float(parts[1])))
+                return coord_pairs
+        return []
+    
+    polygons = []
+    for elem in element.iter():
+        if _kml_local(elem.tag) != 'Polygon':
+            continue
+        outer, holes = [], []
+        for boundary in elem:
+            if _kml_local(boundary.tag) == 'outerBoundaryIs':
+                outer = ring(boundary)
+            elif _kml_local(boundary.tag) == 'innerBoundaryIs':
+                hole = ring(boundary)
+                if len(hole) >= 3:
+                    holes.append(hole)
+        if len(outer) >= 3:  # Need at least 3 points for a polygon
+            polygons.append(Polygon(outer, holes))
+    return polygons
+
 def parse_kml_to_geometry(kml_content):
     """
     Parse KML file content and return GeoJSON geometry
@@ -439,10 +2078,11 @@ def parse_kml_to_geometry(kml_content):
     Returns:
     --------
     dict or None
-        GeoJSON geometry dictionary or None if parsing fails
+        GeoJSON Polygon (MultiPolygon if the file has several polygons)
+        or None if parsing fails
     """
     import xml.etree.ElementTree as ET
-    from shapely.geometry import Polygon, mapping
+    from shapely.geometry import MultiPolygon, mapping
     
     try:
         # Decode if bytes
@@ -452,43 +2092,72 @@ def parse_kml_to_geometry(kml_content):
         # Parse XML
         root = ET.fromstring(kml_content)
         
-        # Define KML namespace
-        ns = {'kml': 'http://www.opengis.net/kml/2.2'}
-        
-        # Try to find Polygon coordinates
-        coords_elem = root.find('.//kml:Polygon/kml:outerBoundaryIs/kml:LinearRing/kml:coordinates', ns)
-        
-        # Also try without namespace (some KML files don't use it)
-        if coords_elem is None:
-            coords_elem = root.find('.//Polygon/outerBoundaryIs/LinearRing/coordinates')
-        
-        if coords_elem is None:
-            # Try Placemark/Polygon pattern
-            coords_elem = root.find('.//Placemark/Polygon/outerBoundaryIs/LinearRing/coordinates')
-        
-        if coords_elem is not None and coords_elem.text:
-            # Parse coordinates (format: lon,lat,alt or lon,lat)
-            coords_text = coords_elem.text.strip()
-            coord_pairs = []
-            
-            for coord in coords_text.split():
-                parts = coord.split(',')
-                if len(parts) >= 2:
-                    lon, lat = float(parts[0]), float(parts[1])
-                    coord_pairs.append((lon, lat))
-            
-            if len(coord_pairs) >= 3:  # Need at least 3 points for a polygon
-                # Create Shapely Polygon
-                poly = Polygon(coord_pairs)
-                # Convert to GeoJSON
-                return mapping(poly)
-        
-        return None
+        polygons = _kml_polygons(root)
+        if not polygons:
+            return None
+        # Convert to GeoJSON
+        return mapping(polygons[0] if len(polygons) == 1 else MultiPolygon(polygons))
         
     except Exception as e:
         print(f"Error parsing KML: {e}")
         return None
 
+def parse_kml_fields(kml_content):
+    """Field boundaries of a KML file, one per Placemark with a polygon: {name: GeoJSON geometry}
+    in file order. Placemarks without a <name> become 'Field N'; repeated names get a suffix.
+    Returns {} if the file cannot be parsed.
+    """
+    import xml.etree.ElementTree as ET
+    from shapely.geometry import MultiPolygon, mapping
+    
+    try:
+        if isinstance(kml_content, bytes):
+            kml_content = kml_content.decode('utf-8')
+        root = ET.fromstring(kml_content)
+    except Exception as e:
+        print(f"Error parsing KML: {e}")
+        return {}
+    
+    fields = {}
+    for placemark in (elem for elem in root.iter() if _kml_local(elem.tag) == 'Placemark'):
+        polygons = _kml_polygons(placemark)
+        if not polygons:
+            continue
+        name = next((child.text.strip() for child in placemark
+                     if _kml_local(child.tag) == 'name' and child.text and child.text.strip()), None)
+        name = name or f"Field {len(fields) + 1}"
+        unique, n = name, 2
+        while unique in fields:
+            unique, n = f"{name} ({n})", n + 1
+        fields[unique] = mapping(polygons[0] if len(polygons) == 1 else MultiPolygon(polygons))
+    return fields
+
+
+def _features(geometry):
+    """(properties, shapely geometry) pairs from a GeoJSON geometry, Feature or FeatureCollection."""
+    from shapely.geometry import shape
+    
+    if geometry.get('type') == 'FeatureCollection':
+        return [(f.get('properties') or {}, shape(f['geometry'])) for f in geometry['features']]
+    if geometry.get('type') == 'Feature':
+        return [(geometry.get('properties') or {}, shape(geometry['geometry']))]
+    return [({}, shape(geometry))]
+
+def _kml_polygon(poly):
+    def ring(coords):
+        kml_coords = ' '.join([f"{x},{y},0" for x, y, *_ in coords])
+        return f"<LinearRing><coordinates>{kml_coords}</coordinates></LinearRing>"
+    
+    inner = ''.join(f"<innerBoundaryIs>{ring(r.coords)}</innerBoundaryIs>" for r in poly.interiors)
+    return f"<Polygon><outerBoundaryIs>{ring(poly.exterior.coords)}</outerBoundaryIs>{inner}</Polygon>"
+
+def _kml_geometry(geom):
+    """KML for a Polygon or MultiPolygon (MultiGeometry), None for other types."""
+    if geom.geom_type == 'Polygon':
+        return _kml_polygon(geom)
+    if geom.geom_type == 'MultiPolygon':
+        return f"<MultiGeometry>{''.join(_kml_polygon(p) for p in geom.geoms)}</MultiGeometry>"
+    return None
 
 def geometry_to_kml(geometry, name="AOI Boundary", description="Area of Interest"):
     """
@@ -497,7 +2166,9 @@ def geometry_to_kml(geometry, name="AOI Boundary", description="Area of Interest
     Parameters:
     -----------
     geometry : dict
-        GeoJSON geometry dictionary
+        GeoJSON geometry (Polygon or MultiPolygon), Feature or FeatureCollection
+        (e.g. management zones); features become one placemark each, named and
+        coloured by their 'field' and 'zone' properties
     name : str
         Name of the placemark
     description : str
@@ -508,47 +2179,53 @@ def geometry_to_kml(geometry, name="AOI Boundary", description="Area of Interest
     str
         KML formatted string
     """
-    from shapely.geometry import shape
+    from html import escape
     
     try:
-        # Convert to Shapely geometry
-        geom = shape(geometry)
+        features = _features(geometry)
+        zones = [props['zone'] for props, _ in features if 'zone' in props]
+        colors = None
+        if zones:
+            import zoning
+            colors = zoning.zone_colors(max(zones))
         
-        # Get coordinates
-        if geom.geom_type == 'Polygon':
-            coords = list(geom.exterior.coords)
-        else:
-            return None
-        
-        # Build KML string
-        kml_coords = ' '.join([f"{lon},{lat},0" for lon, lat in coords])
-        
-        kml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2">
-  <Document>
-    <name>{name}</name>
-    <Placemark>
-      <name>{name}</name>
-      <description>{description}</description>
+        placemarks = []
+        for props, geom in features:
+            kml_geom = _kml_geometry(geom)
+            if kml_geom is None:
+                return None
+            
+            if props:
+                parts = [str(props['field'])] if 'field' in props else []
+                if 'zone' in props:
+                    parts.append(f"Zone {props['zone']}")
+                label = ' - '.join(parts) or name
+                text = ', '.join(f"{k}: {v:.4g}" if isinstance(v, float) else f"{k}: {v}" for k, v in props.items())
+            else:
+                label, text = name, description
+            fill = colors[props['zone'] - 1] if colors and 'zone' in props else '3f0000ff'
+            
+            placemarks.append(f"""    <Placemark>
+      <name>{escape(str(label))}</name>
+      <description>{escape(text)}</description>
       <Style>
         <LineStyle>
           <color>ff0000ff</color>
           <width>2</width>
         </LineStyle>
         <PolyStyle>
-          <color>3f0000ff</color>
+          <color>{fill}</color>
         </PolyStyle>
       </Style>
-      <Polygon>
-        <outerBoundaryIs>
-          <LinearRing>
-            <coordinates>
-              {kml_coords}
-            </coordinates>
-          </LinearRing>
-        </outerBoundaryIs>
-      </Polygon>
-    </Placemark>
+      {kml_geom}
+    </Placemark>""")
+        
+        # Build KML string
+        kml = f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <name>{escape(name)}</name>
+{chr(10).join(placemarks)}
   </Document>
 </kml>"""
         
@@ -566,7 +2243,8 @@ def geometry_to_shapefile(geometry, name="boundary"):
     Parameters:
     -----------
     geometry : dict
-        GeoJSON geometry dictionary
+        GeoJSON geometry, Feature or FeatureCollection (feature properties
+        become attribute columns, e.g. field, zone, mean, area_ha)
     name : str
         Name for the shapefile
         
@@ -576,17 +2254,20 @@ def geometry_to_shapefile(geometry, name="boundary"):
         ZIP file containing shapefile components (.shp, .shx, .dbf, .prj)
     """
     import geopandas as gpd
-    from shapely.geometry import shape
     import tempfile
     import os
     import zipfile
     
     try:
-        # Convert to Shapely geometry
-        geom = shape(geometry)
+        features = _features(geometry)
         
-        # Create GeoDataFrame
-        gdf = gpd.GeoDataFrame({'name': [name], 'geometry': [geom]}, crs='EPSG:4326')
+        # Create GeoDataFrame (one row per feature)
+        if any(props for props, _ in features):
+            gdf = gpd.GeoDataFrame([props for props, _ in features], geometry=[geom for _, geom in features],
+                                   crs='EPSG:4326')
+        else:
+            gdf = gpd.GeoDataFrame({'name': [name] * len(features), 'geometry': [geom for _, geom in features]},
+                                   crs='EPSG:4326')
         
         # Create temporary directory
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -0,0 +1,227 @@
+"""Management zones from a clipped index raster.
+
+Pixels are classified into N zones with breaks taken from the fixed-bin
+histogram that compute_stats() already produces (quantile breaks, or Jenks
+natural breaks solved on the histogram bins instead of on every pixel), small
+patches are removed with a sieve filter, and all zones are polygonized in a
+single rasterio.features.shapes() pass. The result is a GeoJSON
+FeatureCollection (lon/lat) that the KML and Shapefile exporters accept.
+
+zone_fields() zones many field boundaries cut from one index raster in a
+single batch and merges them into one FeatureCollection; merge_zones() puts
+their zone rasters back on the index grid for plotting and GeoTIFF export.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ZONING_METHODS = ('quantile', 'jenks')
+
+# Zones are stored as uint8 with 0 for pixels outside the field / without data
+MAX_ZONES = 20
+
+
+def zone_colors(n_zones):
+    """KML-style 'aabbggrr' fill colours for zones 1..n_zones, from low (red) to high (green)."""
+    import matplotlib
+
+    cmap = matplotlib.colormaps['RdYlGn']
+    colors = []
+    for i in range(n_zones):
+        r, g, b, _ = (int(round(c * 255)) for c in cmap(i / max(n_zones - 1, 1)))
+        colors.append(f"b0{b:02x}{g:02x}{r:02x}")
+    return colors
+
+
+def quantile_breaks(stats, n_zones):
+    """n_zones - 1 interior breaks with (approximately) equal pixel counts per zone."""
+    from utils import approx_percentile
+
+    return [approx_percentile(stats, 100.0 * i / n_zones) for i in range(1, n_zones)]
+
+
+def jenks_breaks(stats, n_zones):
+    """n_zones - 1 interior Jenks (Fisher) natural breaks, solved exactly on the histogram
+    bins weighted by their pixel counts. Breaks fall on bin edges, so they are accurate to
+    one bin width; the cost does not depend on the number of pixels.
+    """
+    hist = np.asarray(stats['hist'], dtype=np.float64)
+    edges = np.asarray(stats['bin_edges'], dtype=np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    # Drop empty bins: they cannot change any class variance
+    used = np.flatnonzero(hist)
+    weights, values = hist[used], centers[used]
+    n = len(used)
+    if n <= n_zones:
+        return [float(edges[i + 1]) for i in used[:-1]]
+
+    # Within-class sum of squared deviations for every run of bins i..j from prefix sums
+    w = np.concatenate([[0.0], np.cumsum(weights)])
+    s = np.concatenate([[0.0], np.cumsum(weights * values)])
+    ss = np.concatenate([[0.0], np.cumsum(weights * values * values)])
+    i, j = np.triu_indices(n)
+    cost = np.full((n, n), np.inf)
+    count = w[j + 1] - w[i]
+    total = s[j + 1] - s[i]
+    cost[i, j] = ss[j + 1] - ss[i] - total * total / count
+
+    # best[k, j]: lowest cost of k + 1 classes over bins 0..j; start[k, j]: first bin of the last class
+    best = np.empty((n_zones, n))
+    start = np.zeros((n_zones, n), dtype=np.intp)
+    best[0] = cost[0]
+    for k in range(1, n_zones):
+        # candidate[i, j] = best[k - 1, i - 1] + cost[i, j] for a last class starting at bin i >= 1
+        candidate = best[k - 1, :-1, None] + cost[1:]
+        start[k] = np.argmin(candidate, axis=0) + 1
+        best[k] = candidate[start[k] - 1, np.arange(n)]
+
+    breaks = []
+    end = n - 1
+    for k in range(n_zones - 1, 0, -1):
+        first = start[k, end]
+        breaks.append(float(edges[used[first - 1] + 1]))
+        end = first - 1
+    return breaks[::-1]
+
+
+def classify(values, breaks):
+    """Zone number (1..len(breaks) + 1) per pixel as uint8; 0 where values are not finite."""
+    values = np.asarray(values)
+    valid = np.isfinite(values)
+    zones = np.zeros(values.shape, dtype=np.uint8)
+    zones[valid] = np.digitize(values[valid], breaks) + 1
+    return zones
+
+
+def sieve(zones, min_pixels, connectivity=8):
+    """Merge patches smaller than min_pixels into their largest neighbouring zone.
+    Pixels without data stay 0.
+    """
+    from rasterio.features import sieve as rasterio_sieve
+
+    if min_pixels <= 1:
+        return zones
+    valid = zones > 0
+    sieved = rasterio_sieve(zones, size=int(min_pixels), mask=valid, connectivity=connectivity)
+    # Small patches next to the field edge may have been merged into the no-data area
+    sieved = np.where(valid & (sieved == 0), zones, sieved).astype(np.uint8)
+    sieved[~valid] = 0
+    return sieved
+
+
+def polygonize(zones, transform, crs):
+    """One MultiPolygon per zone from a zone raster, in EPSG:4326.
+    Returns {zone: shapely geometry}.
+    """
+    import geopandas as gpd
+    from rasterio.features import shapes
+    from shapely.geometry import MultiPolygon, shape
+
+    parts = {}
+    for geom, value in shapes(zones, mask=zones > 0, transform=transform):
+        parts.setdefault(int(value), []).append(shape(geom))
+    if not parts:
+        return {}
+
+    numbers = sorted(parts)
+    gdf = gpd.GeoSeries([MultiPolygon(parts[z]) for z in numbers], crs=crs).to_crs('EPSG:4326')
+    return dict(zip(numbers, gdf))
+
+
+def zone_field(vi_data, n_zones=5, method='quantile', min_area_m2=1000, stats=None, name=None):
+    """Classify one clipped index raster (e.g. from clip_to_geometry) into management zones.
+
+    Returns a dict with 'zones' (uint8 DataArray on the index grid, 0 = no data),
+    'breaks', 'stats' and 'features' (GeoJSON FeatureCollection, one MultiPolygon
+    feature per zone with zone number, value range, mean, pixel count and area),
+    or None if the raster has no valid pixels.
+    """
+    from shapely.geometry import mapping
+    from utils import compute_stats
+
+    if method not in ZONING_METHODS:
+        raise ValueError(f"Unknown zoning method: {method} (use {', '.join(ZONING_METHODS)})")
+    if not 2 <= n_zones <= MAX_ZONES:
+        raise ValueError(f"Number of zones must be between 2 and {MAX_ZONES}")
+
+    stats = stats if stats is not None else compute_stats(vi_data)
+    if stats['count'] == 0:
+        return None
+
+    if method == 'quantile':
+        breaks = quantile_breaks(stats, n_zones)
+    else:
+        # Natural breaks on a histogram spanning the 2nd-98th percentile, so a few extreme
+        # pixels do not squeeze the bulk of the field into a couple of bins (they still get
+        # classified, into the lowest or highest zone)
+        low, high = stats['percentiles'][2], stats['percentiles'][98]
+        trimmed = compute_stats(vi_data, hist_range=(low, high)) if high > low else stats
+        breaks = jenks_breaks(trimmed, n_zones)
+    values = np.asarray(vi_data.values)
+    transform = vi_data.rio.transform()
+    pixel_area = abs(transform.a * transform.e)
+
+    zones = classify(values, breaks)
+    zones = sieve(zones, max(1, round(min_area_m2 / pixel_area)))
+
+    # Per-zone pixel counts and means in one pass each
+    flat = zones.ravel()
+    counts = np.bincount(flat, minlength=n_zones + 1)
+    sums = np.bincount(flat, weights=np.nan_to_num(values.ravel()), minlength=n_zones + 1)
+
+    bounds = [stats['min']] + list(breaks) + [stats['max']]
+    features = []
+    for zone, geom in polygonize(zones, transform, vi_data.rio.crs).items():
+        properties = {
+            'zone': zone,
+            'min': float(bounds[zone - 1]),
+            'max': float(bounds[zone]),
+            'mean': float(sums[zone] / counts[zone]),
+            'pixels': int(counts[zone]),
+            'area_ha': float(counts[zone] * pixel_area / 10000),
+        }
+        if name is not None:
+            properties = {'field': name, **properties}
+        features.append({'type': 'Feature', 'properties': properties, 'geometry': mapping(geom)})
+
+    return {
+        'zones': vi_data.copy(data=zones).rio.write_nodata(0),
+        'breaks': breaks,
+        'stats': stats,
+        'features': {'type': 'FeatureCollection', 'features': features},
+    }
+
+
+def zone_fields(vi_data, fields, n_zones=5, method='quantile', min_area_m2=1000, max_workers=4):
+    """Zone many fields cut from one index raster in one batch.
+
+    fields maps a field name to its GeoJSON geometry (lon/lat). Each field is clipped
+    with clip_to_geometry and zoned on its own breaks; fields run concurrently on a
+    small thread pool (rasterio and numpy release the GIL). Returns
+    ({name: zone_field() result or None}, merged FeatureCollection in field order).
+    """
+    from utils import clip_to_geometry
+
+    def run(name):
+        return zone_field(clip_to_geometry(vi_data, fields[name]), n_zones=n_zones, method=method,
+                          min_area_m2=min_area_m2, name=name)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = dict(zip(fields, pool.map(run, fields)))
+
+    features = [f for result in results.values() if result for f in result['features']['features']]
+    return results, {'type': 'FeatureCollection', 'features': features}
+
+
+def merge_zones(vi_data, results):
+    """One uint8 zone raster on the vi_data grid from zone_fields() results (fields are
+    clipped without cropping, so every field's zones share that grid). Zone numbers keep
+    their per-field meaning; where fields overlap the later field wins.
+    """
+    merged = np.zeros(vi_data.shape, dtype=np.uint8)
+    for result in results.values():
+        if result is not None:
+            zones = np.asarray(result['zones'].values)
+            merged = np.where(zones > 0, zones, merged)
+    return vi_data.copy(data=merged).rio.write_nodata(0)